@@ -188,7 +188,9 @@ test "x$RPM_BUILD_ROOT" != "x" && rm -rf $RPM_BUILD_ROOT
 
 %files server
 %{target_bin_dir}/clustdockd
+%{target_bin_dir}/clustdock-agent
 %{target_systemd_dir}/clustdockd.service
+%{target_systemd_dir}/clustdock-agent.service
 %{target_python_lib_dir}/%{name}/[!c_]*
 
 %config(noreplace) %{target_conf_dir}/clustdockd.conf
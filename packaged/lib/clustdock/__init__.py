@@ -8,8 +8,12 @@
 @file clustdock/__init__.py
 @namespace clustdock Clustdock Module
 '''
+import os
 import re
+import signal
+import sys
 import logging
+import threading
 import subprocess as sp
 
 DOCKER_NODE = "docker"
@@ -36,6 +40,8 @@ class VirtualNode(object):
         self.after_start = kwargs.get('after_start', None)
         self.after_end = kwargs.get('after_end', None)
         self.add_iface = kwargs.get('add_iface', None)
+        # Time (in seconds) after which a hook is killed, None for no limit
+        self.hook_timeout = kwargs.get('hook_timeout', None)
 
     @classmethod
     def split_name(cls, nodename):
@@ -54,23 +60,66 @@ class VirtualNode(object):
                                self.name,
                                vtype,
                                self.host)
-        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-        (stdout, stderr) = p.communicate()
-        return (p.returncode, stdout, stderr)
+        return run_command(cmd, self.hook_timeout)
 
-    def start(self, cnx, pipe):
+    @staticmethod
+    def end_operation(rc, msg, pipe=None, fork=True):
+        """End start/stop operation
+
+        In a forked process, msg is sent through pipe and the process exits
+        with rc. Otherwise (rc, msg) is returned.
+        """
+        if fork:
+            if pipe:
+                pipe.send(msg)
+            sys.exit(rc)
+        return (rc, msg)
+
+    def start(self, pipe=None, fork=True, cnx=None):
         """Start virtual node"""
         raise NotImplementedError("Must be redefine is subclasses")
 
-    def stop(self, cnx, pipe=None, fork=True):
+    def stop(self, pipe=None, fork=True, cnx=None):
         """Stop virtual node"""
         raise NotImplementedError("Must be redefine is subclasses")
 
-    def get_ip(self, cnx):
+    def get_ip(self, cnx=None):
         """Get ip of the node"""
         raise NotImplementedError("Must be redefine is subclasses")
 
 
+def run_command(cmd, timeout=None, stdin=None):
+    """Run shell command cmd. Return (rc, stdout, stderr)
+
+    The command and its children are killed after timeout seconds.
+    """
+    _LOGGER.debug("Launching %s", cmd)
+    p = sp.Popen(cmd, stdin=sp.PIPE if stdin is not None else None,
+                 stdout=sp.PIPE, stderr=sp.PIPE, shell=True, preexec_fn=os.setsid)
+    killed = threading.Event()
+
+    def kill():
+        killed.set()
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(float(timeout), kill)
+        timer.start()
+    try:
+        (stdout, stderr) = p.communicate(stdin)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if killed.is_set():
+        stderr += "Command '%s' killed after %ss\n" % (cmd, timeout)
+        _LOGGER.error("Command '%s' killed after %ss", cmd, timeout)
+    return (p.returncode, stdout, stderr)
+
+
 def format_dict(dico, **kwargs):
     new = {}
     for key, value in dico.items():
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/agent.py
+@namespace clustdock.agent Agent running batches of operations on a managed host
+'''
+import errno
+import logging
+import os
+import socket
+import threading
+import uuid
+import Queue
+import zmq
+import zmq.auth
+from zmq.auth.thread import ThreadAuthenticator
+import msgpack
+import clustdock.ipresolver as ipresolver
+import clustdock.provision as provision
+
+_LOGGER = logging.getLogger(__name__)
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 5051
+# Number of operations run at the same time by the agent
+MAX_PARALLEL = 16
+# Time (in seconds) the client waits for the next result of a batch
+AGENT_TIMEOUT = 60
+# Delay (in milliseconds) between two checks of finished operations
+POLL_INTERVAL = 20
+# Directory of the CURVE certificates of the agents and of the daemon
+CURVE_DIR = "/etc/clustdock/curve"
+AGENT_CERT = 'agent'
+DAEMON_CERT = 'clustdockd'
+# ZAP domain of the agent sockets, so that peers are always authenticated
+ZAP_DOMAIN = 'clustdock'
+# Argument of each operation giving the file it writes or removes
+TARGETS = {
+    'overlay': 'path',
+    'remove': 'path',
+}
+
+
+class AgentError(Exception):
+    '''Batch rejected by the agent or agent not answering'''
+    pass
+
+
+def management_address():
+    """Return the address of the host name, on which agents listen by default"""
+    return socket.gethostbyname(socket.gethostname())
+
+
+def create_certificates(curve_dir=CURVE_DIR):
+    """Create the CURVE certificates of the agents and of the daemon
+
+    The directory is then copied on the daemon host and on every managed
+    host: agents accept the daemon key, the daemon checks the agent key.
+    """
+    if not os.path.isdir(curve_dir):
+        os.makedirs(curve_dir, 0o700)
+    for name in (AGENT_CERT, DAEMON_CERT):
+        zmq.auth.create_certificates(curve_dir, name)
+
+
+def _certificate(curve_dir, name, secret=False):
+    """Return (public key, secret key) of a certificate of curve_dir"""
+    return zmq.auth.load_certificate(os.path.join(
+        curve_dir, "%s.key%s" % (name, '_secret' if secret else '')))
+
+
+def in_dirs(path, dirs):
+    """Check if path is inside one of the directories dirs"""
+    path = os.path.realpath(path)
+    return any(path.startswith(os.path.join(os.path.realpath(directory), ''))
+               for directory in dirs)
+
+
+def operation(cmd, **args):
+    """Return operation running cmd with given arguments"""
+    return {'cmd': cmd, 'args': args}
+
+
+def op_overlay(base, path):
+    """Create qcow2 overlay of base image at path"""
+    err = provision.create_overlays([(base, path)], max_parallel=1)[path]
+    if err is not None:
+        raise AgentError(err)
+    return path
+
+
+def op_remove(path):
+    """Remove file at path. Return False if it did not exist"""
+    try:
+        os.remove(path)
+    except OSError as exc:
+        if exc.errno != errno.ENOENT:
+            raise
+        return False
+    return True
+
+
+def op_neighbours():
+    """Return neighbour table of the host, {mac: [ip, ...]}"""
+    return ipresolver.read_neighbours('localhost')
+
+
+OPERATIONS = {
+    'overlay': op_overlay,
+    'remove': op_remove,
+    'neighbours': op_neighbours,
+}
+
+
+class Agent(object):
+    '''Run batches of operations sent by clustdock workers
+
+    Operations of a batch are run in parallel. The result of each one is
+    sent back as soon as it is done, then the end of the batch.
+    Peers must have their address in allowed, and if curve_dir is given,
+    the daemon certificate. Files are only written or removed in
+    storage_dirs.
+    '''
+
+    def __init__(self, url, max_parallel=MAX_PARALLEL, storage_dirs=(), allowed=(),
+                 curve_dir=None):
+        self.url = url
+        self.max_parallel = max_parallel
+        self.storage_dirs = list(storage_dirs)
+        self.allowed = list(allowed)
+        self.curve_dir = curve_dir
+        self.ctx = None
+        self.sock = None
+        self.auth = None
+        self._tasks = Queue.Queue()
+        self._done = Queue.Queue()
+        self._pending = {}
+
+    def bind(self):
+        """Bind agent socket and start the threads running operations
+
+        A tcp url with port 0 is bound to a random port, self.url is then
+        updated with it. Raise AgentError if no peer can be authenticated.
+        """
+        if not self.allowed and self.curve_dir is None:
+            raise AgentError("no allowed peer address nor CURVE certificates")
+        self.ctx = zmq.Context()
+        self.auth = ThreadAuthenticator(self.ctx)
+        self.auth.start()
+        if self.allowed:
+            self.auth.allow(*self.allowed)
+        self.sock = self.ctx.socket(zmq.ROUTER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        self.sock.zap_domain = ZAP_DOMAIN
+        if self.curve_dir is not None:
+            self.auth.configure_curve(domain=ZAP_DOMAIN, location=self.curve_dir)
+            self.sock.curve_publickey, self.sock.curve_secretkey = _certificate(
+                self.curve_dir, AGENT_CERT, secret=True)
+            self.sock.curve_server = True
+        if self.url.startswith('tcp://') and self.url.endswith(':0'):
+            port = self.sock.bind_to_random_port(self.url[:-2])
+            self.url = "%s:%d" % (self.url[:-2], port)
+        else:
+            self.sock.bind(self.url)
+        for _ in xrange(self.max_parallel):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+        _LOGGER.info("Agent listening on %s", self.url)
+
+    def _work(self):
+        while True:
+            identity, req_id, index, op = self._tasks.get()
+            if op is None:
+                return
+            msg = {'v': PROTOCOL_VERSION, 'id': req_id, 'index': index}
+            try:
+                target = op['args'].get(TARGETS.get(op['cmd']))
+                if target is not None and not in_dirs(str(target), self.storage_dirs):
+                    raise AgentError("'%s' is not in a storage directory" % target)
+                msg['result'] = OPERATIONS[op['cmd']](**op['args'])
+                msg['error'] = None
+            except Exception as exc:
+                _LOGGER.debug("Operation %s failed: %s", op, exc)
+                msg['result'] = None
+                msg['error'] = str(exc) or exc.__class__.__name__
+            self._done.put((identity, msg))
+
+    def serve(self, fd=None):
+        """Serve batches until something is readable on fd"""
+        poller = zmq.Poller()
+        poller.register(self.sock, zmq.POLLIN)
+        if fd is not None:
+            poller.register(fd, zmq.POLLIN)
+        while True:
+            items = dict(poller.poll(POLL_INTERVAL))
+            if fd is not None and fd.fileno() in items:
+                break
+            if self.sock in items:
+                identity, raw = self.sock.recv_multipart()
+                self.accept(identity, raw)
+            self._send_results()
+        for _ in xrange(self.max_parallel):
+            self._tasks.put((None, None, None, None))
+        self.sock.close()
+        self.auth.stop()
+        self.ctx.term()
+
+    def accept(self, identity, raw):
+        """Queue operations of a batch, reject it if it is not valid"""
+        req_id = None
+        try:
+            batch = msgpack.unpackb(raw)
+            req_id = batch.get('id')
+            if batch.get('v') != PROTOCOL_VERSION:
+                raise AgentError("unsupported batch version")
+            ops = batch.get('ops') or []
+            for op in ops:
+                if not isinstance(op, dict) or op.get('cmd') not in OPERATIONS:
+                    raise AgentError("unknown operation '%s'" % (op,))
+                if not isinstance(op.get('args', {}), dict):
+                    raise AgentError("invalid arguments for '%s'" % op['cmd'])
+        except Exception as exc:
+            _LOGGER.error("Batch rejected: %s", exc)
+            self._send(identity, {'v': PROTOCOL_VERSION, 'id': req_id, 'end': True,
+                                  'error': str(exc)})
+            return
+        _LOGGER.debug("Batch %s: %d operations", req_id, len(ops))
+        if not ops:
+            self._send(identity, {'v': PROTOCOL_VERSION, 'id': req_id, 'end': True,
+                                  'error': None})
+            return
+        self._pending[req_id] = len(ops)
+        for index, op in enumerate(ops):
+            self._tasks.put((identity, req_id, index, {'cmd': op['cmd'],
+                                                       'args': op.get('args') or {}}))
+
+    def _send_results(self):
+        while True:
+            try:
+                identity, msg = self._done.get_nowait()
+            except Queue.Empty:
+                return
+            self._send(identity, msg)
+            self._pending[msg['id']] -= 1
+            if self._pending[msg['id']] == 0:
+                del self._pending[msg['id']]
+                self._send(identity, {'v': PROTOCOL_VERSION, 'id': msg['id'], 'end': True,
+                                      'error': None})
+
+    def _send(self, identity, msg):
+        self.sock.send_multipart([identity, msgpack.packb(msg)])
+
+
+class AgentClient(object):
+    '''Send batches of operations to the agent of a host'''
+
+    def __init__(self, host, port=DEFAULT_PORT, timeout=AGENT_TIMEOUT, url=None,
+                 curve_dir=None):
+        self.host = host
+        self.url = url or "tcp://%s:%d" % (host, port)
+        self.timeout = timeout
+        self.sock = zmq.Context.instance().socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.LINGER, 0)
+        if curve_dir is not None:
+            self.sock.curve_publickey, self.sock.curve_secretkey = _certificate(
+                curve_dir, DAEMON_CERT, secret=True)
+            self.sock.curve_serverkey, _ = _certificate(curve_dir, AGENT_CERT)
+        self.sock.connect(self.url)
+
+    def close(self):
+        """Close connexion to the agent"""
+        self.sock.close()
+
+    def batch(self, ops, callback=None):
+        """Run operations on the agent host
+
+        callback(index, result, error) is called as soon as each operation
+        is done. Return [(result, error), ...] in the order of ops.
+        Raise AgentError if the batch is rejected or the agent does not
+        answer within timeout seconds.
+        """
+        req_id = uuid.uuid4().hex
+        self.sock.send(msgpack.packb({'v': PROTOCOL_VERSION, 'id': req_id, 'ops': ops}))
+        results = [(None, "no result")] * len(ops)
+        while True:
+            if not self.sock.poll(self.timeout * 1000):
+                raise AgentError("no answer from agent on host '%s' after %ss" %
+                                 (self.host, self.timeout))
+            msg = msgpack.unpackb(self.sock.recv())
+            if msg.get('id') != req_id:
+                # late message of a previous batch
+                continue
+            if msg.get('end'):
+                if msg.get('error'):
+                    raise AgentError(msg['error'])
+                return results
+            results[msg['index']] = (msg['result'], msg['error'])
+            if callback is not None:
+                callback(msg['index'], msg['result'], msg['error'])
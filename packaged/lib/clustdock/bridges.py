@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/bridges.py
+@namespace clustdock.bridges Cache of the bridges of managed hosts
+'''
+import logging
+import threading
+import time
+from collections import namedtuple
+from ipaddr import IPv4Network
+import clustdock.sshpool as sshpool
+
+_LOGGER = logging.getLogger(__name__)
+
+BRIDGE_OVS = 'ovs'
+BRIDGE_SYSTEM = 'system'
+# Time (in seconds) after which the bridges of a host are probed again
+TOPOLOGY_TTL = 300
+# Minimum time (in seconds) between two probes of a host triggered by an
+# unknown bridge
+REFRESH_DELAY = 2
+
+# Lists openvswitch bridges, linux bridges and IPv4 addresses in one command
+PROBE_CMD = ("echo '[ovs]'; ovs-vsctl list-br 2>/dev/null; "
+             "echo '[bridge]'; ip -o link show type bridge; "
+             "echo '[inet]'; ip -o -4 addr show")
+
+# Interface of a host on which container interfaces can be plugged.
+# ip is its first IPv4 address with prefix, None if it has none
+Bridge = namedtuple('Bridge', ['name', 'kind', 'ip'])
+
+
+def parse_topology(out):
+    """Return {name: Bridge} from the output of PROBE_CMD"""
+    ovs = set()
+    names = set()
+    ips = {}
+    section = None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('[') and line.endswith(']'):
+            section = line[1:-1]
+            continue
+        if not line:
+            continue
+        if section == 'ovs':
+            ovs.add(line)
+        elif section == 'bridge':
+            # 3: br0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 ...
+            names.add(line.split(':')[1].strip().split('@')[0])
+        elif section == 'inet':
+            # 2: br0    inet 10.0.0.1/24 brd 10.0.0.255 scope global br0 ...
+            fields = line.split()
+            if len(fields) < 4 or fields[1] in ips:
+                continue
+            try:
+                IPv4Network(fields[3])
+            except ValueError:
+                continue
+            ips[fields[1]] = fields[3]
+    names.update(ovs)
+    names.update(ips)
+    return dict((name, Bridge(name, BRIDGE_OVS if name in ovs else BRIDGE_SYSTEM,
+                              ips.get(name)))
+                for name in names)
+
+
+def probe(host):
+    """Return {name: Bridge} of host. Raise RuntimeError if probe fails"""
+    rc, out, err = sshpool.run(host, PROBE_CMD)
+    if rc != 0:
+        raise RuntimeError("Cannot list bridges of host '%s': %s" % (host, err.strip()))
+    return parse_topology(out)
+
+
+class BridgeCache(object):
+    '''Bridges of each host, probed once and shared by all node starts
+
+    Threads looking up a host which is being probed wait for the probe
+    instead of running their own one. The bridges of a host are probed
+    again after ttl seconds, once invalidated, or when an unknown bridge
+    is looked up (at most every REFRESH_DELAY seconds).
+    '''
+
+    def __init__(self, ttl=TOPOLOGY_TTL, probe=probe):
+        self.ttl = ttl
+        self.probe = probe
+        self._lock = threading.Lock()
+        self._host_locks = {}
+        self._topology = {}
+        self._probed = {}
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def invalidate(self, host=None):
+        """Force next lookup on the host (or all hosts) to probe it"""
+        with self._lock:
+            if host is None:
+                self._probed.clear()
+            else:
+                self._probed.pop(host, None)
+
+    def lookup(self, host, name):
+        """Return Bridge name of host, None if it does not exist"""
+        with self._host_lock(host):
+            probed = self._probed.get(host)
+            age = time.time() - probed if probed is not None else None
+            topology = self._topology.get(host, {})
+            if age is None or age >= self.ttl or (name not in topology and
+                                                  age >= REFRESH_DELAY):
+                _LOGGER.debug("Probing bridges of host '%s'", host)
+                topology = self.probe(host)
+                with self._lock:
+                    self._topology[host] = topology
+                    self._probed[host] = time.time()
+            return topology.get(name)
+
+
+TOPOLOGY = BridgeCache()
+
+
+def lookup(host, name):
+    """Return Bridge name of host through the shared cache"""
+    return TOPOLOGY.lookup(host, name)
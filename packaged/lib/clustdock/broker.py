@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/broker.py
+@namespace clustdock.broker Dispatch of client requests to an elastic worker pool
+'''
+import logging
+import time
+from collections import deque
+import zmq
+import clustdock.client_protocol as proto
+
+_LOGGER = logging.getLogger(__name__)
+
+FAST_LANE = 'fast'
+SLOW_LANE = 'slow'
+# Read-only commands served by the fast lane
+FAST_COMMANDS = set(['list', 'get_ip', 'status'])
+
+WORKER_READY = 'READY'
+WORKER_STOP = 'STOP'
+
+MIN_WORKERS = 3
+MAX_WORKERS = 10
+FAST_WORKERS = 2
+IDLE_TIMEOUT = 60
+
+
+def worker_identity(worker_id):
+    """Return zmq identity of a worker"""
+    return "worker-%d" % worker_id
+
+
+def request_lane(request):
+    """Return the lane serving the given request"""
+    commands = proto.request_commands(request)
+    if commands and FAST_COMMANDS.issuperset(commands):
+        return FAST_LANE
+    return SLOW_LANE
+
+
+class _Worker(object):
+    '''Worker process known by the broker'''
+
+    def __init__(self, worker_id, lane, proc):
+        self.worker_id = worker_id
+        self.identity = worker_identity(worker_id)
+        self.lane = lane
+        self.proc = proc
+        self.ready = False
+        self.idle_since = None
+
+
+class Broker(object):
+    '''Load-balancing broker between clients and worker processes
+
+    Workers connect with a DEALER socket and announce themselves with
+    WORKER_READY when they can take a request. Requests are queued per
+    lane: read-only commands go to the fast lane, which is served by
+    dedicated workers (and by idle slow workers), so they never wait behind
+    long spawn/stop requests. The slow lane grows up to max_workers while
+    requests are waiting and shrinks back to min_workers when workers stay
+    idle for idle_timeout seconds.
+    '''
+
+    def __init__(self, ctx, frontend_url, backend_url, spawn_worker,
+                 min_workers=MIN_WORKERS, max_workers=MAX_WORKERS,
+                 fast_workers=FAST_WORKERS, idle_timeout=IDLE_TIMEOUT):
+        self.spawn_worker = spawn_worker
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.fast_workers = fast_workers
+        self.idle_timeout = idle_timeout
+        self.workers = {}
+        self.retired = []
+        self.idle = {FAST_LANE: deque(), SLOW_LANE: deque()}
+        self.queues = {FAST_LANE: deque(), SLOW_LANE: deque()}
+        self.next_id = 0
+        self.frontend = ctx.socket(zmq.ROUTER)
+        self.frontend.bind(frontend_url)
+        self.backend = ctx.socket(zmq.ROUTER)
+        self.backend.bind(backend_url)
+
+    def lane_size(self, lane):
+        """Return number of workers of a lane"""
+        return len([wrk for wrk in self.workers.itervalues() if wrk.lane == lane])
+
+    def start_workers(self):
+        """Start the initial workers of both lanes"""
+        for _ in xrange(self.fast_workers):
+            self._spawn(FAST_LANE)
+        for _ in xrange(self.min_workers):
+            self._spawn(SLOW_LANE)
+
+    def _spawn(self, lane):
+        worker_id = self.next_id
+        self.next_id += 1
+        _LOGGER.debug("Starting %s worker %d", lane, worker_id)
+        proc = self.spawn_worker(worker_id, lane)
+        worker = _Worker(worker_id, lane, proc)
+        self.workers[worker.identity] = worker
+        return worker
+
+    def _retire(self, worker):
+        _LOGGER.debug("Retiring idle %s worker %d", worker.lane, worker.worker_id)
+        self.idle[worker.lane].remove(worker.identity)
+        del self.workers[worker.identity]
+        self.backend.send_multipart([worker.identity, '', WORKER_STOP])
+        self.retired.append(worker.proc)
+
+    def run(self, fd=None, timeout=1000):
+        """Serve requests until something is readable on fd"""
+        poller = zmq.Poller()
+        poller.register(self.frontend, zmq.POLLIN)
+        poller.register(self.backend, zmq.POLLIN)
+        if fd is not None:
+            poller.register(fd, zmq.POLLIN)
+        while True:
+            items = dict(poller.poll(timeout))
+            if fd is not None and fd.fileno() in items:
+                return
+            if self.backend in items:
+                self.on_backend(self.backend.recv_multipart())
+            if self.frontend in items:
+                self.on_frontend(self.frontend.recv_multipart())
+            self.dispatch()
+            self.housekeeping()
+
+    def on_frontend(self, frames):
+        """Queue a client request: [client, '', request]
+
+        The time it was received goes with it to the worker, which computes
+        its deadline from it.
+        """
+        client, request = frames[0], frames[-1]
+        lane = request_lane(request)
+        _LOGGER.debug("Request %r queued on %s lane", request, lane)
+        self.queues[lane].append((client, repr(time.time()), request))
+
+    def on_backend(self, frames):
+        """Handle worker message
+
+        [worker, '', READY] or [worker, '', client, '', reply]
+        """
+        identity = frames[0]
+        worker = self.workers.get(identity)
+        if len(frames) == 3 and frames[2] == WORKER_READY:
+            if worker is None:
+                _LOGGER.warning("Unknown worker '%s' ready. Ignoring", identity)
+                return
+            worker.ready = True
+            worker.idle_since = time.time()
+            self.idle[worker.lane].append(identity)
+        elif len(frames) >= 5:
+            self.frontend.send_multipart(frames[2:])
+
+    def _idle_worker(self, lane):
+        if self.idle[lane]:
+            return self.workers[self.idle[lane].popleft()]
+        if lane == FAST_LANE and self.idle[SLOW_LANE]:
+            return self.workers[self.idle[SLOW_LANE].popleft()]
+        return None
+
+    def dispatch(self):
+        """Give queued requests to idle workers, grow the slow lane if needed"""
+        for lane in (FAST_LANE, SLOW_LANE):
+            queue = self.queues[lane]
+            while queue:
+                worker = self._idle_worker(lane)
+                if worker is None:
+                    break
+                client, received, request = queue.popleft()
+                worker.idle_since = None
+                self.backend.send_multipart([worker.identity, '', client, '', received,
+                                             request])
+        starting = len([wrk for wrk in self.workers.itervalues()
+                        if wrk.lane == SLOW_LANE and not wrk.ready])
+        waiting = len(self.queues[SLOW_LANE]) - starting
+        while waiting > 0 and self.lane_size(SLOW_LANE) < self.max_workers:
+            _LOGGER.info("%d requests waiting, adding a worker",
+                         len(self.queues[SLOW_LANE]))
+            self._spawn(SLOW_LANE)
+            waiting -= 1
+
+    def housekeeping(self):
+        """Replace dead workers and retire idle ones"""
+        now = time.time()
+        for worker in self.workers.values():
+            if not worker.proc.is_alive():
+                _LOGGER.error("%s worker %d died", worker.lane, worker.worker_id)
+                if worker.identity in self.idle[worker.lane]:
+                    self.idle[worker.lane].remove(worker.identity)
+                del self.workers[worker.identity]
+        for worker in list(self.workers.values()):
+            if worker.lane == SLOW_LANE and worker.idle_since is not None and \
+               now - worker.idle_since > self.idle_timeout and \
+               self.lane_size(SLOW_LANE) > self.min_workers:
+                self._retire(worker)
+        while self.lane_size(FAST_LANE) < self.fast_workers:
+            self._spawn(FAST_LANE)
+        while self.lane_size(SLOW_LANE) < self.min_workers:
+            self._spawn(SLOW_LANE)
+        self.retired = [proc for proc in self.retired if proc.is_alive()]
+
+    def stop(self):
+        """Terminate all workers and close sockets"""
+        for worker in self.workers.values():
+            worker.proc.terminate()
+        for proc in self.retired:
+            proc.terminate()
+        self.frontend.close()
+        self.backend.close()
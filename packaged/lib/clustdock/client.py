@@ -9,10 +9,13 @@
 @namespace clustdock Clustdock Module
 '''
 import logging
+import time
+from collections import deque
 import zmq
 import sys
 import msgpack
 from ClusterShell.NodeSet import NodeSet
+import clustdock.client_protocol as proto
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -25,27 +28,182 @@ STATUS = {
     'crashed': 6,
 }
 STATUS_UNKNOWN = 'unknown'
+# Delay (in seconds) between two polls of a job state
+POLL_DELAY = 1
+# Frame marking progress events sent by the server during a job
+STREAM_EVENT = 'EVENT'
+# Time (in seconds) without progress event before checking the job state
+STREAM_TIMEOUT = 30
+
+
+# Time (in seconds) to wait for a reply before sending the request again,
+# None to wait as long as the server may take (see proto.reply_timeout)
+REQUEST_TIMEOUT = None
+# Number of tries before giving up a request
+REQUEST_RETRIES = 3
+
+
+class ClientTimeout(Exception):
+    '''No reply from the server'''
+    pass
 
 
 class ClustdockClient(object):
-    '''Class representing the client part of the docker/libvirt architecture'''
+    '''Class representing the client part of the docker/libvirt architecture
 
-    def __init__(self, server):
+    Requests are sent on a DEALER socket and matched with their reply by
+    id, so many of them can be in flight at the same time: submit() returns
+    without waiting, poll() reads what the server sent and result() blocks
+    until the reply to a given request is there. call() does all of it.
+
+    A request without reply after timeout seconds is sent again, up to
+    retries times, if all its commands can safely be run twice (see
+    proto.IDEMPOTENT_COMMANDS); other requests fail with ClientTimeout.
+    Without timeout, the client waits as long as the server may take to
+    reply given its host_timeout (see proto.reply_timeout).
+    The socket is recreated before sending again (lazy pirate pattern)
+    unless this would lose the reply to a request that cannot be resent.
+    Instances are not thread safe.
+    '''
+
+    def __init__(self, server, timeout=REQUEST_TIMEOUT, retries=REQUEST_RETRIES,
+                 host_timeout=proto.HOST_TIMEOUT):
         self.ctx = zmq.Context()
-        self.socket = self.ctx.socket(zmq.REQ)
+        self.socket = None
         self.server = server
+        self.timeout = timeout
+        self.retries = retries
+        self.host_timeout = host_timeout
+        self.events = deque()
+        # {request id: {'raw', 'timeout', 'expire', 'tries', 'retry'}}
+        self.pending = {}
+        # {request id: results or ClientTimeout}
+        self.replies = {}
+        self.connect()
+
+    def connect(self):
+        """Connect a new socket to the server, dropping the previous one"""
+        if self.socket is not None:
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.close()
+        self.socket = self.ctx.socket(zmq.DEALER)
         try:
-            self.socket.connect(server)
+            self.socket.connect(self.server)
         except zmq.error.ZMQError:
-            _LOGGER.error("Could not connect to server at %s. Exiting", server)
+            _LOGGER.error("Could not connect to server at %s. Exiting", self.server)
             sys.exit(3)
 
+    def send(self, msg):
+        """Send a request to the server"""
+        self.socket.send_multipart(['', msg])
+
+    def submit(self, ops, timeout=None):
+        """Send operations in one request without waiting, return the request id"""
+        timeout = timeout or self.timeout or proto.reply_timeout(ops, self.host_timeout)
+        retry = all(op['cmd'] in proto.IDEMPOTENT_COMMANDS for op in ops)
+        tries = self.retries if retry else 1
+        # The server does not start operations the client gave up waiting for
+        request = proto.new_request(ops, timeout * tries)
+        raw = proto.pack_request(request)
+        self.pending[request['id']] = {
+            'raw': raw,
+            'timeout': timeout,
+            'expire': time.time() + timeout,
+            'tries': 1,
+            'retry': retry,
+        }
+        self.send(raw)
+        return request['id']
+
+    def poll(self, timeout=0):
+        """Read messages sent by the server, waiting at most timeout seconds
+
+        Return ids of requests completed (or given up) meanwhile.
+        """
+        done = []
+        if self.pending:
+            next_expire = min(req['expire'] for req in self.pending.values())
+            timeout = max(0, min(timeout, next_expire - time.time()))
+        if self.socket.poll(timeout * 1000):
+            while self.socket.poll(0):
+                frames = self.socket.recv_multipart()
+                if len(frames) > 2 and frames[1] == STREAM_EVENT:
+                    self.events.append(msgpack.unpackb(frames[-1]))
+                    continue
+                reply = proto.unpack_reply(frames[-1])
+                if self.pending.pop(reply['id'], None) is None:
+                    _LOGGER.debug("Dropping reply to request %s", reply['id'])
+                    continue
+                self.replies[reply['id']] = reply['results']
+                done.append(reply['id'])
+        done.extend(self._check_expired())
+        return done
+
+    def _check_expired(self):
+        """Send again or give up requests without reply in time"""
+        now = time.time()
+        expired = [req_id for req_id, req in self.pending.iteritems()
+                   if req['expire'] <= now]
+        if not expired:
+            return []
+        given_up = []
+        for req_id in expired:
+            req = self.pending[req_id]
+            if not req['retry'] or req['tries'] >= self.retries:
+                _LOGGER.warning("No reply from %s to request %s", self.server, req_id)
+                del self.pending[req_id]
+                self.replies[req_id] = ClientTimeout("No reply from %s" % self.server)
+                given_up.append(req_id)
+        resend = [req_id for req_id in expired if req_id in self.pending]
+        if resend:
+            if all(req['retry'] for req in self.pending.values()):
+                # Every request in flight is sent again on a fresh connexion
+                self.connect()
+                resend = self.pending.keys()
+            for req_id in resend:
+                req = self.pending[req_id]
+                if req['expire'] <= now:
+                    req['tries'] += 1
+                _LOGGER.debug("Sending request %s again (try %d)", req_id, req['tries'])
+                req['expire'] = now + req['timeout']
+                self.send(req['raw'])
+        return given_up
+
+    def result(self, req_id):
+        """Wait for the reply to a request and return its results
+
+        Raise ClientTimeout if the server did not answer.
+        """
+        while req_id not in self.replies:
+            if req_id not in self.pending:
+                raise KeyError("unknown request '%s'" % req_id)
+            self.poll(self.pending[req_id]['timeout'])
+        results = self.replies.pop(req_id)
+        if isinstance(results, ClientTimeout):
+            raise results
+        return results
+
+    def call(self, ops, timeout=None):
+        """Send operations in one request and return their (result, errors)"""
+        return self.result(self.submit(ops, timeout))
+
+    def next_event(self, timeout):
+        """Return next progress event, None if none came within timeout seconds"""
+        end = time.time() + timeout
+        while not self.events:
+            remaining = end - time.time()
+            if remaining <= 0:
+                return None
+            self.poll(remaining)
+        return self.events.popleft()
+
     def list(self, allnodes, **kwargs):
         """Ask for nodelist on managed hosts"""
         try:
-            self.socket.send("list %s" % allnodes)
-            msg = self.socket.recv()
-            liste = msgpack.unpackb(msg)
+            liste, errors = self.call([proto.operation('list',
+                                                       allnodes=bool(allnodes))])[0]
+            for message in errors:
+                sys.stderr.write("{}\n".format(message.rstrip()))
             print("%-10s %-7s %-40s %-11s" % ("Host", "#Nodes", "Nodeset", "Status"))
             print("-" * 71)
             liste = sort_nodes(liste)
@@ -63,66 +221,182 @@ class ClustdockClient(object):
                             '\033[1;33mcrashed\033[0m')
                 print_nodes(liste[host][STATUS['created']],
                             'unknown')
-        except zmq.error.ZMQError:
+        except (zmq.error.ZMQError, ClientTimeout):
             sys.stderr.write("Error when trying to contact server.\n")
             return 2
 
-    def spawn(self, profil, clustername, nb_nodes, host, **kwargs):
-        """Ask server to spawn a cluster"""
-        rc = 0
+    def spawn(self, profil, clustername, nb_nodes, host, detach=False, placement=None,
+              **kwargs):
+        """Ask server to spawn a cluster
+
+        host is a host or a nodeset of hosts, placement the policy used by
+        the server to place nodes on them.
+        """
         try:
-            self.socket.send("spawn %s %s %s %s" % (profil, clustername, nb_nodes, host))
-            spawn_nodes, errors = msgpack.unpackb(self.socket.recv())
-            if len(errors) != 0:
+            op = proto.operation('spawn',
+                                 profile=profil,
+                                 name=clustername,
+                                 nb_nodes=int(nb_nodes),
+                                 host=None if host in (None, 'None') else host,
+                                 stream=not detach)
+            if placement is not None:
+                op['args']['placement'] = placement
+            return self._follow_jobs(self.call([op]), detach)
+        except (zmq.error.ZMQError, ClientTimeout):
+            sys.stderr.write("Error when trying to contact server.\n")
+            return 2
+
+    def stop(self, nodeset, detach=False, **kwargs):
+        """Ask server to stop nodeset (or list of nodesets)"""
+        if isinstance(nodeset, basestring):
+            nodeset = [nodeset]
+        try:
+            _LOGGER.debug("Trying to delete %s", ", ".join(nodeset))
+            ops = [proto.operation('stop_nodes', nodeset=nodes, stream=not detach)
+                   for nodes in nodeset]
+            return self._follow_jobs(self.call(ops), detach)
+        except (zmq.error.ZMQError, ClientTimeout):
+            sys.stderr.write("Error when trying to contact server.\n")
+            return 2
+
+    def _follow_jobs(self, results, detach):
+        """Read job ids sent back by the server and wait for the jobs if needed"""
+        job_ids = []
+        printed = set()
+        for job_id, errors in results:
+            for message in errors:
+                sys.stderr.write("{}\n".format(message.rstrip()))
+            printed.update(errors)
+            if job_id != "":
+                job_ids.append(job_id)
+        if len(job_ids) == 0:
+            return 1
+        if detach:
+            for job_id in job_ids:
+                print(job_id)
+            return 0
+        return self._stream_jobs(job_ids, printed)
+
+    def _stream_jobs(self, job_ids, printed):
+        """Print progress events of jobs until their end"""
+        running = set(job_ids)
+        jobs = {}
+        while running:
+            event = self.next_event(STREAM_TIMEOUT)
+            if event is None:
+                # No news: make sure the jobs are still running
+                for job_id in list(running):
+                    job = self._get_job(job_id)
+                    if job is None or job['state'] == 'done':
+                        jobs[job_id] = job
+                        running.discard(job_id)
+                continue
+            if event['job'] not in running:
+                continue
+            if event.get('end'):
+                jobs[event['job']] = event
+                running.discard(event['job'])
+                continue
+            line = "{0}\t{1}\t{2:.1f}s".format(event['node'], event['status'],
+                                               event['elapsed'])
+            if event.get('stages'):
+                stages = sorted(event['stages'].items())
+                line += "\t" + ", ".join("%s %.1fs" % stage for stage in stages)
+            sys.stderr.write(line + "\n")
+            if event['error']:
+                sys.stderr.write("{}\n".format(event['error'].rstrip()))
+                printed.add(event['error'])
+        rc = 0
+        for job_id in job_ids:
+            job = jobs[job_id]
+            if job is None:
                 rc = 1
-                for message in errors:
+                continue
+            for message in job['errors']:
+                if message not in printed:
                     sys.stderr.write("{}\n".format(message.rstrip()))
-            if spawn_nodes != "":
-                print(spawn_nodes)
-        except zmq.error.ZMQError:
-            sys.stderr.write("Error when trying to contact server.\n")
-            rc = 2
+            if job.get('hosts'):
+                sys.stderr.write("{}\n".format(job['hosts']))
+            if job['result'] != "":
+                print(job['result'])
+            if len(job['errors']) != 0:
+                rc = 1
         return rc
 
-    def stop(self, nodeset, **kwargs):
-        """Ask server to stop nodeset"""
-        rc = 0
+    def _get_job(self, job_id):
+        """Return job state, None if it is unknown"""
+        job, errors = self.call([proto.operation('status', job=job_id)])[0]
+        for message in errors:
+            sys.stderr.write("{}\n".format(message.rstrip()))
+        if job == "":
+            return None
+        return job
+
+    def status(self, job_id, **kwargs):
+        """Print progress of a job"""
         try:
-            _LOGGER.debug("Trying to delete %s", nodeset)
-            self.socket.send("stop_nodes %s" % nodeset)
-            stopped_nodes, errors = msgpack.unpackb(self.socket.recv())
-            if len(errors) != 0:
+            job = self._get_job(job_id)
+            if job is None:
+                return 1
+            pending, done, failed = job_summary(job)
+            print("Job %s (%s): %s" % (job['id'], job['cmd'], job['state']))
+            print("%d done, %d failed, %d pending" % (done, failed, pending))
+            for message in job['errors']:
+                print(message.rstrip())
+            if job['result'] != "":
+                print(job['result'])
+            return 1 if failed else 0
+        except (zmq.error.ZMQError, ClientTimeout):
+            sys.stderr.write("Error when trying to contact server.\n")
+            return 2
+
+    def wait(self, job_id, **kwargs):
+        """Wait for the end of a job and print processed nodes"""
+        try:
+            job = self._get_job(job_id)
+            while job is not None and job['state'] != 'done':
+                time.sleep(POLL_DELAY)
+                job = self._get_job(job_id)
+            if job is None:
+                return 1
+            rc = 0
+            if len(job['errors']) != 0:
                 rc = 1
-                for message in errors:
+                for message in job['errors']:
                     sys.stderr.write("{}\n".format(message.rstrip()))
-            if stopped_nodes != "":
-                print(stopped_nodes)
-        except zmq.error.ZMQError:
+            if job['result'] != "":
+                print(job['result'])
+            return rc
+        except (zmq.error.ZMQError, ClientTimeout):
             sys.stderr.write("Error when trying to contact server.\n")
-            rc = 2
-        return rc
+            return 2
 
     def getip(self, nodeset, **kwargs):
         """Ask server to give back some ip"""
         rc = 0
         try:
-            self.socket.send("get_ip %s" % nodeset)
-            res, errors = msgpack.unpackb(self.socket.recv())
+            res, errors = self.call([proto.operation('get_ip', nodeset=nodeset)])[0]
             if len(errors) != 0:
                 rc = 1
                 for message in errors:
-                    sys.stderr.write(message)
+                    sys.stderr.write("{}\n".format(message.rstrip()))
             if len(res) == 1:
                 print(res[0][0])
             else:
                 for item in res:
                     print("{0}\t{1}".format(*item))
-        except zmq.error.ZMQError:
+        except (zmq.error.ZMQError, ClientTimeout):
             sys.stderr.write("Error when trying to contact server.\n")
             rc = 2
         return rc
 
 
+def job_summary(job):
+    """Return number of (pending, done, failed) nodes of a job"""
+    statuses = [node['status'] for node in job['nodes'].values()]
+    return statuses.count('pending'), statuses.count('done'), statuses.count('failed')
+
+
 def sort_nodes(nodelist):
     '''Sort nodes for list command'''
     hosts = {}
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/client_protocol.py
+@namespace clustdock.client_protocol Messages exchanged between clients and server
+'''
+import time
+import uuid
+import msgpack
+
+PROTOCOL_VERSION = 1
+REQUIRED = object()
+
+# Arguments of each command: {name: (accepted types, default value)}
+COMMANDS = {
+    'list': {
+        'allnodes': ((bool,), False),
+    },
+    'spawn': {
+        'profile': ((basestring,), REQUIRED),
+        'name': ((basestring,), REQUIRED),
+        'nb_nodes': ((int, long), 1),
+        'host': ((basestring, type(None)), None),
+        'stream': ((bool,), False),
+        'placement': ((basestring, type(None)), None),
+    },
+    'stop_nodes': {
+        'nodeset': ((basestring,), REQUIRED),
+        'stream': ((bool,), False),
+    },
+    'get_ip': {
+        'nodeset': ((basestring,), REQUIRED),
+    },
+    'status': {
+        'job': ((basestring,), REQUIRED),
+    },
+}
+
+# Commands which can be sent again without side effect
+IDEMPOTENT_COMMANDS = frozenset(['list', 'get_ip', 'status'])
+
+# Default time (in seconds) given by the server to each host ('host_timeout'
+# of clustdockd.conf)
+HOST_TIMEOUT = 30
+# Number of successive queries of hosts, each bounded by host_timeout, the
+# server may run before replying to each command
+COMMAND_PHASES = {
+    'list': 1,          # inventory refresh
+    'spawn': 2,         # inventory refresh, placement probes
+    'stop_nodes': 1,    # inventory refresh
+    'get_ip': 2,        # inventory refresh, ip resolution
+    'status': 0,
+}
+# Time (in seconds) added to the bound of the server for everything else
+REPLY_MARGIN = 10
+
+
+class ProtocolError(Exception):
+    '''Malformed request'''
+    pass
+
+
+def operation(cmd, **args):
+    """Return operation running cmd with given arguments"""
+    return {'cmd': cmd, 'args': args}
+
+
+def reply_timeout(ops, host_timeout=HOST_TIMEOUT):
+    """Return time (in seconds) the server may take to reply to ops"""
+    phases = sum(COMMAND_PHASES[op['cmd']] for op in ops)
+    return host_timeout * phases + REPLY_MARGIN
+
+
+def new_request(ops, timeout=None):
+    """Return a request envelope for given operations
+
+    If timeout (in seconds) is given, the server skips operations it could
+    not start within timeout seconds after receiving the request. It is
+    relative so that clocks of clients and server need not agree.
+    """
+    return {
+        'v': PROTOCOL_VERSION,
+        'id': uuid.uuid4().hex,
+        'timeout': timeout,
+        'ops': ops,
+    }
+
+
+def pack_request(request):
+    """Serialize request envelope"""
+    return msgpack.packb(request)
+
+
+def unpack_request(raw, received=None):
+    """Return request envelope from raw message
+
+    The deadline of the request is computed from the time it was received
+    (now if not given). Legacy requests (space-separated strings) are
+    converted to an envelope without id. Raise ProtocolError if the request
+    is not valid.
+    """
+    if raw[:1].isalpha():
+        return parse_legacy(raw)
+    try:
+        request = msgpack.unpackb(raw)
+    except Exception as exc:
+        raise ProtocolError("cannot decode request: %s" % exc)
+    if not isinstance(request, dict) or request.get('v') != PROTOCOL_VERSION:
+        raise ProtocolError("unsupported request version")
+    ops = request.get('ops')
+    if not isinstance(ops, (list, tuple)) or not ops:
+        raise ProtocolError("request without operation")
+    timeout = request.get('timeout')
+    if timeout is not None and not isinstance(timeout, (int, long, float)):
+        raise ProtocolError("invalid timeout '%s'" % timeout)
+    deadline = None
+    if timeout is not None:
+        deadline = (time.time() if received is None else received) + timeout
+    return {
+        'v': PROTOCOL_VERSION,
+        'id': request.get('id'),
+        'deadline': deadline,
+        'ops': [check_operation(op) for op in ops],
+    }
+
+
+def check_operation(op):
+    """Return operation with checked arguments and default values filled"""
+    if not isinstance(op, dict) or op.get('cmd') not in COMMANDS:
+        raise ProtocolError("unknown command in operation '%s'" % (op,))
+    cmd = op['cmd']
+    args = op.get('args') or {}
+    if not isinstance(args, dict):
+        raise ProtocolError("invalid arguments for command '%s'" % cmd)
+    unknown = set(args) - set(COMMANDS[cmd])
+    if unknown:
+        raise ProtocolError("unknown arguments for command '%s': %s" %
+                            (cmd, ", ".join(sorted(unknown))))
+    checked = {}
+    for name, (types, default) in COMMANDS[cmd].iteritems():
+        if name not in args:
+            if default is REQUIRED:
+                raise ProtocolError("missing argument '%s' for command '%s'" % (name,
+                                                                                 cmd))
+            checked[name] = default
+        elif not isinstance(args[name], types):
+            raise ProtocolError("invalid value '%s' for argument '%s' of command '%s'" %
+                                (args[name], name, cmd))
+        elif isinstance(args[name], unicode):
+            checked[name] = args[name].encode('utf-8')
+        else:
+            checked[name] = args[name]
+    return {'cmd': cmd, 'args': checked}
+
+
+def parse_legacy(cmd):
+    """Convert legacy request string into a request envelope"""
+    words = cmd.split()
+    try:
+        if words[0] == 'list':
+            if words[1] not in ('True', 'False'):
+                raise ProtocolError("invalid value '%s' for argument 'allnodes'" %
+                                    words[1])
+            op = operation('list', allnodes=words[1] == 'True')
+        elif words[0] == 'spawn':
+            op = operation('spawn',
+                           profile=words[1],
+                           name=words[2],
+                           nb_nodes=int(words[3]),
+                           host=words[4] if words[4] != 'None' else None,
+                           stream='stream' in words[5:])
+        elif words[0] == 'stop_nodes':
+            op = operation('stop_nodes', nodeset=words[1], stream='stream' in words[2:])
+        elif words[0] == 'get_ip':
+            op = operation('get_ip', nodeset=words[1])
+        elif words[0] == 'status':
+            op = operation('status', job=words[1])
+        else:
+            raise ProtocolError("unknown command '%s'" % words[0])
+    except (IndexError, ValueError):
+        raise ProtocolError("malformed request '%s'" % cmd)
+    return {'v': None, 'id': None, 'deadline': None, 'ops': [check_operation(op)]}
+
+
+def request_commands(raw):
+    """Return commands of a raw request, [] if it cannot be decoded"""
+    try:
+        return [op['cmd'] for op in unpack_request(raw)['ops']]
+    except ProtocolError:
+        return []
+
+
+def expired(request):
+    """Check if the deadline of the request is over"""
+    return request['deadline'] is not None and time.time() > request['deadline']
+
+
+def pack_reply(request, results):
+    """Serialize reply to request, results is [(result, errors), ...]
+
+    Legacy requests get the (result, errors) of their single operation.
+    """
+    if request['id'] is None:
+        return msgpack.packb(results[0])
+    return msgpack.packb({'v': PROTOCOL_VERSION, 'id': request['id'], 'results': results})
+
+
+def pack_error(raw, err):
+    """Serialize error reply to a request which could not be decoded
+
+    The id of the request is sent back when it can be read so that the
+    client still matches the reply with its request.
+    """
+    if raw[:1].isalpha():
+        return msgpack.packb(('', [err]))
+    try:
+        request = msgpack.unpackb(raw)
+        req_id = request.get('id') if isinstance(request, dict) else None
+    except Exception:
+        req_id = None
+    return msgpack.packb({'v': PROTOCOL_VERSION, 'id': req_id, 'results': [('', [err])]})
+
+
+def unpack_reply(raw):
+    """Return reply envelope from raw message"""
+    reply = msgpack.unpackb(raw)
+    if not isinstance(reply, dict) or reply.get('v') != PROTOCOL_VERSION:
+        raise ProtocolError("unsupported reply")
+    return reply
@@ -0,0 +1,407 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/docker_api.py
+@namespace clustdock.docker_api Docker Engine REST API client
+'''
+import logging
+import os
+import json
+import shlex
+import socket
+import struct
+import threading
+import httplib
+import urllib
+
+_LOGGER = logging.getLogger(__name__)
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+API_VERSION = "1.24"
+DEFAULT_TIMEOUT = 60
+POOL_SIZE = 8
+
+STREAM_STDOUT = 1
+STREAM_STDERR = 2
+
+
+class DockerAPIError(Exception):
+
+    def __init__(self, msg, status=None):
+        super(DockerAPIError, self).__init__(msg)
+        self.status = status
+
+
+class DockerOptsError(Exception):
+    """Raised when docker_opts contains options unknown to the API translation"""
+    pass
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connexion over a unix socket"""
+
+    def __init__(self, path, timeout=DEFAULT_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerClient(object):
+    '''Docker Engine API client keeping a pool of persistent HTTP connexions'''
+
+    def __init__(self, base_url=None, pool_size=POOL_SIZE,
+                 timeout=DEFAULT_TIMEOUT, version=API_VERSION):
+        if base_url is None:
+            base_url = "unix://%s" % DOCKER_SOCKET
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.version = version
+        if base_url.startswith('unix://'):
+            self.socket_path = base_url[len('unix://'):]
+            self.address = None
+        elif base_url.startswith('tcp://'):
+            self.socket_path = None
+            host, _, port = base_url[len('tcp://'):].rstrip('/').partition(':')
+            self.address = (host, int(port) if port else 2375)
+        else:
+            raise ValueError("Unsupported docker url '%s'" % base_url)
+        self.stats = {'created': 0, 'reused': 0}
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _new_conn(self):
+        """Open a new HTTP connexion to the engine"""
+        self.stats['created'] += 1
+        if self.socket_path is not None:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        return httplib.HTTPConnection(self.address[0], self.address[1],
+                                      timeout=self.timeout)
+
+    def _get_conn(self):
+        """Take an idle connexion from the pool or open a new one"""
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connexions inherited from the parent process must not be shared
+                _LOGGER.debug("Fork detected, dropping %d inherited connexions",
+                              len(self._idle))
+                for conn in self._idle:
+                    conn.close()
+                self._idle = []
+                self._pid = os.getpid()
+            if self._idle:
+                self.stats['reused'] += 1
+                return self._idle.pop(), True
+        return self._new_conn(), False
+
+    def _put_conn(self, conn):
+        """Give back a connexion to the pool"""
+        with self._lock:
+            if self._pid == os.getpid() and len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Close all idle connexions"""
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+    def _url(self, path, params=None):
+        url = path
+        if self.version:
+            url = "/v%s%s" % (self.version, path)
+        if params:
+            url += '?' + urllib.urlencode(params)
+        return url
+
+    def _send(self, method, url, body=None, headers=None):
+        """Send request, retrying once if a kept-alive connexion was closed"""
+        hdrs = {'Host': 'docker'}
+        if headers:
+            hdrs.update(headers)
+        while True:
+            conn, reused = self._get_conn()
+            try:
+                conn.request(method, url, body, hdrs)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error) as exc:
+                conn.close()
+                if not reused:
+                    raise DockerAPIError("Cannot reach docker engine at %s: %s" % (
+                                         self.base_url, exc))
+                _LOGGER.debug("Stale connexion to %s, retrying", self.base_url)
+
+    def request(self, method, path, params=None, data=None, expect=(200, 201, 204)):
+        """Send a request to the engine and return the decoded answer"""
+        body = None
+        headers = {}
+        if data is not None:
+            body = json.dumps(data)
+            headers['Content-Type'] = 'application/json'
+        conn, resp = self._send(method, self._url(path, params), body, headers)
+        try:
+            content = resp.read()
+        except (httplib.HTTPException, socket.error) as exc:
+            conn.close()
+            raise DockerAPIError("Error when reading answer from %s: %s" % (
+                                 self.base_url, exc))
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(conn)
+        result = content
+        if 'json' in (resp.getheader('Content-Type') or '') and content:
+            try:
+                result = json.loads(content)
+            except ValueError:
+                pass
+        if resp.status not in expect:
+            msg = result.get('message', content) if isinstance(result, dict) else content
+            raise DockerAPIError(str(msg).strip(), resp.status)
+        return result
+
+    def ping(self):
+        """Check that the engine answers"""
+        try:
+            return self.request('GET', '/_ping') == 'OK'
+        except DockerAPIError as exc:
+            _LOGGER.debug(exc)
+            return False
+
+    def info(self):
+        """Return engine system wide information"""
+        return self.request('GET', '/info')
+
+    def containers(self, allnodes=True, filters=None):
+        """List containers"""
+        params = {}
+        if allnodes:
+            params['all'] = 1
+        if filters:
+            params['filters'] = json.dumps(filters)
+        return self.request('GET', '/containers/json', params)
+
+    def inspect(self, name):
+        """Return low-level information on a container"""
+        return self.request('GET', '/containers/%s/json' % name)
+
+    def create(self, name, config):
+        """Create a container, pulling its image if needed"""
+        try:
+            return self.request('POST', '/containers/create', {'name': name}, config)
+        except DockerAPIError as exc:
+            if exc.status != 404:
+                raise
+        self.pull(config['Image'])
+        return self.request('POST', '/containers/create', {'name': name}, config)
+
+    def has_image(self, image):
+        """Check if image is present on the engine"""
+        try:
+            self.request('GET', '/images/%s/json' % image)
+        except DockerAPIError as exc:
+            if exc.status != 404:
+                raise
+            return False
+        return True
+
+    def pull(self, image):
+        """Pull an image"""
+        repo, tag = split_image(image)
+        _LOGGER.debug("Pulling image %s:%s", repo, tag)
+        self.request('POST', '/images/create', {'fromImage': repo, 'tag': tag})
+
+    def start(self, name):
+        """Start a container"""
+        self.request('POST', '/containers/%s/start' % name, expect=(204, 304))
+
+    def remove(self, name, force=True, volumes=True):
+        """Remove a container"""
+        params = {'force': int(force), 'v': int(volumes)}
+        self.request('DELETE', '/containers/%s' % name, params)
+
+    def events(self, filters=None):
+        """Subscribe to engine events. Return an EventStream"""
+        params = {}
+        if filters:
+            params['filters'] = json.dumps(filters)
+        # Dedicated connexion without timeout: events may be rare
+        conn = self._new_conn()
+        conn.timeout = None
+        try:
+            conn.connect()
+            conn.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            conn.request('GET', self._url('/events', params), headers={'Host': 'docker'})
+            resp = conn.getresponse()
+        except (httplib.HTTPException, socket.error) as exc:
+            conn.close()
+            raise DockerAPIError("Cannot reach docker engine at %s: %s" % (
+                                 self.base_url, exc))
+        if resp.status != 200:
+            content = resp.read()
+            conn.close()
+            raise DockerAPIError(content.strip(), resp.status)
+        return EventStream(conn, resp)
+
+    def execute(self, name, cmd):
+        """Run command inside a container and return (rc, stdout, stderr)"""
+        if isinstance(cmd, basestring):
+            cmd = shlex.split(cmd)
+        exe = self.request('POST', '/containers/%s/exec' % name,
+                           data={'AttachStdout': True, 'AttachStderr': True,
+                                 'Cmd': cmd})
+        # The engine hijacks the connexion to send the output stream,
+        # so it is never given back to the pool.
+        conn, resp = self._send('POST', self._url('/exec/%s/start' % exe['Id']),
+                                json.dumps({'Detach': False, 'Tty': False}),
+                                {'Content-Type': 'application/json'})
+        try:
+            raw = resp.read()
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise DockerAPIError(raw.strip(), resp.status)
+        out, err = demux_stream(raw)
+        rc = self.request('GET', '/exec/%s/json' % exe['Id']).get('ExitCode')
+        return (rc, out, err)
+
+
+class EventStream(object):
+    '''Iterate over events sent by the engine until the stream is closed'''
+
+    def __init__(self, conn, resp):
+        self.conn = conn
+        self.resp = resp
+
+    def _chunks(self):
+        fp = self.resp.fp
+        while True:
+            if self.resp.chunked:
+                line = fp.readline()
+                if not line:
+                    return
+                size = int(line.split(';', 1)[0], 16)
+                if size == 0:
+                    return
+                data = fp.read(size)
+                fp.read(2)
+            else:
+                data = fp.readline()
+                if not data:
+                    return
+            yield data
+
+    def __iter__(self):
+        buf = ''
+        try:
+            for data in self._chunks():
+                buf += data
+                while '\n' in buf:
+                    line, buf = buf.split('\n', 1)
+                    if line.strip():
+                        yield json.loads(line)
+        except (httplib.HTTPException, socket.error, ValueError) as exc:
+            raise DockerAPIError("Event stream interrupted: %s" % exc)
+
+    def close(self):
+        """Close the underlying connexion"""
+        self.conn.close()
+
+
+def demux_stream(raw):
+    """Split a multiplexed attach stream into stdout and stderr"""
+    out = []
+    err = []
+    pos = 0
+    while pos + 8 <= len(raw):
+        stream, size = struct.unpack('>BxxxL', raw[pos:pos + 8])
+        chunk = raw[pos + 8:pos + 8 + size]
+        pos += 8 + size
+        if stream == STREAM_STDERR:
+            err.append(chunk)
+        else:
+            out.append(chunk)
+    return (''.join(out), ''.join(err))
+
+
+def split_image(image):
+    """Split image name into repository and tag"""
+    repo, tag = image, 'latest'
+    if ':' in image.rsplit('/', 1)[-1]:
+        repo, tag = image.rsplit(':', 1)
+    return repo, tag
+
+
+def parse_memory(value):
+    """Convert docker memory string (512m, 2g...) into bytes"""
+    units = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def build_config(image, hostname, docker_opts='', cap_add=None, labels=None):
+    """Translate 'docker run' options into a container creation request"""
+    host_config = {'CapAdd': list(cap_add or [])}
+    config = {
+        'Image': image,
+        'Hostname': hostname,
+        'Tty': True,
+        'HostConfig': host_config,
+    }
+    if labels:
+        config['Labels'] = dict(labels)
+    args = shlex.split(docker_opts or '')
+    multi = {
+        '-v': ('Binds', None), '--volume': ('Binds', None),
+        '--cap-add': ('CapAdd', None), '--cap-drop': ('CapDrop', None),
+        '--dns': ('Dns', None), '--add-host': ('ExtraHosts', None),
+        '--security-opt': ('SecurityOpt', None),
+    }
+    while args:
+        arg = args.pop(0)
+        opt, sep, value = arg.partition('=')
+        if opt in ('--privileged', '-t', '--tty', '-d', '--detach'):
+            if opt == '--privileged':
+                host_config['Privileged'] = True
+            continue
+        if not sep:
+            if not args:
+                raise DockerOptsError("Missing value for option '%s'" % opt)
+            value = args.pop(0)
+        if opt in multi:
+            host_config.setdefault(multi[opt][0], []).append(value)
+        elif opt in ('-e', '--env'):
+            config.setdefault('Env', []).append(value)
+        elif opt in ('-l', '--label'):
+            key, _, val = value.partition('=')
+            config.setdefault('Labels', {})[key] = val
+        elif opt in ('--net', '--network'):
+            host_config['NetworkMode'] = value
+        elif opt in ('-m', '--memory'):
+            host_config['Memory'] = parse_memory(value)
+        elif opt == '--cpuset-cpus':
+            host_config['CpusetCpus'] = value
+        elif opt in ('-u', '--user'):
+            config['User'] = value
+        elif opt in ('-w', '--workdir'):
+            config['WorkingDir'] = value
+        elif opt == '--entrypoint':
+            config['Entrypoint'] = [value]
+        else:
+            raise DockerOptsError("Unsupported docker option '%s'" % opt)
+    return config
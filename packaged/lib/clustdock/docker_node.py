@@ -9,12 +9,14 @@
 @namespace clustdock.docker_node DockerNode definition
 '''
 import logging
-import sys
-import re
 import os
 import subprocess as sp
-from ipaddr import IPv4Network
+from collections import namedtuple
 import clustdock
+import clustdock.bridges as bridges
+import clustdock.docker_api as docker_api
+import clustdock.netplumb as netplumb
+import clustdock.sshpool as sshpool
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -30,6 +32,61 @@ STATUS = {
 }
 
 
+# Container states as reported by the engine
+STATES = {
+    'created': STATUS['created'],
+    'running': STATUS['up'],
+    'paused': STATUS['paused'],
+    'restarting': STATUS['restarting'],
+    'removing': STATUS['restarting'],
+    'exited': STATUS['exited'],
+    'dead': STATUS['crashed'],
+}
+
+# Label recording the static IPs of interfaces added to a container, as
+# space separated 'eth=ip[/prefix]' items (the engine does not know them)
+IFACES_LABEL = 'clustdock.ifaces'
+
+
+class ContainerRecord(namedtuple('ContainerRecord',
+                                 ['name', 'img', 'status', 'host', 'ips', 'labels'])):
+    """Compact description of a container, as listed by the engine"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_api(cls, dock, host):
+        """Decode one entry of the engine container list"""
+        name = dock['Names'][0].lstrip('/')
+        if dock.get('State') in STATES:
+            status = STATES[dock['State']]
+        else:
+            status = get_docker_status(dock.get('Status', ''))
+        labels = dock.get('Labels') or {}
+        return cls(name, dock['Image'], status, host,
+                   container_ips(dock.get('NetworkSettings'), labels),
+                   labels)
+
+    @classmethod
+    def from_inspect(cls, info, host):
+        """Decode low-level information of a container"""
+        state = (info.get('State') or {}).get('Status')
+        status = STATES.get(state, STATUS['created'])
+        labels = info['Config'].get('Labels') or {}
+        return cls(info['Name'].lstrip('/'), info['Config']['Image'], status, host,
+                   container_ips(info.get('NetworkSettings'), labels),
+                   labels)
+
+    def to_dict(self):
+        """Prepare record to be send over the network"""
+        return dict(self._asdict())
+
+    def to_node(self):
+        """Build the DockerNode described by this record"""
+        return DockerNode(self.name, self.img, status=self.status,
+                          host=self.host, ip=self.ips[0] if self.ips else None)
+
+
 class AddIfaceException(Exception):
 
     def __init__(self, msg, iface):
@@ -45,57 +102,39 @@ class DockerConnexion(object):
         self.docker_port = docker_port
         self.cnx = None
         docker_env = os.environ.copy()
+        base_url = None
         if self.docker_port is not None:
-            docker_host = "tcp://%s:%d" % (self.host, self.docker_port)
-            _LOGGER.debug("setting DOCKER_HOST environment variable to: %s", docker_host)
-            docker_env["DOCKER_HOST"] = docker_host
+            base_url = "tcp://%s:%d" % (self.host, self.docker_port)
+            _LOGGER.debug("setting DOCKER_HOST environment variable to: %s", base_url)
+            docker_env["DOCKER_HOST"] = base_url
         docker_env["NO_PROXY"] = "%s,%s" % (self.host, docker_env.get("NO_PROXY", ''))
         self.docker_env = docker_env
-        cmd = "docker info"
-        try:
-            p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, env=docker_env, shell=True)
-            (docks, _) = p.communicate()
-            if p.returncode == 0:
-                _LOGGER.info("valid docker connexion on host '%s'", self.host)
-                self.cnx = True
-        except sp.CalledProcessError:
+        self.client = docker_api.DockerClient(base_url)
+        self.check()
+
+    def check(self):
+        """Check that the docker engine answers"""
+        if self.client.ping():
+            _LOGGER.info("valid docker connexion on host '%s'", self.host)
+            self.cnx = True
+        else:
             _LOGGER.error("No docker connexion on host '%s'", self.host)
+            self.cnx = None
+        return self.cnx is not None
 
     def is_ok(self):
         """Check if the connexion is ok"""
-        return self.cnx is not None
+        return self.cnx is not None or self.check()
 
     def list_containers(self, allnodes=True):
-        """List all containers on the host"""
-        containers = []
-        cmd_param = '-f status=running'
-        if allnodes:
-            cmd_param = "--all"
-        out_format = '--format "{{.Image}};{{.Names}};{{.Status}}"'
-        cmd = 'docker ps %s %s' % (cmd_param, out_format)
-        _LOGGER.debug("Launching command: %s", cmd)
+        """List all containers on the host with a single engine request"""
         try:
-            p = sp.Popen(cmd, stdout=sp.PIPE, shell=True, env=self.docker_env)
-            (docks, _) = p.communicate()
-            if p.returncode == 0:
-                docks = docks.strip()
-        except sp.CalledProcessError:
-            _LOGGER.error("Error when retrieving list of docker containers on %s",
-                          self.host)
-            return containers
-
-        docks = docks.split('\n')
-        for dock in docks:
-            try:
-                (cimg, name, status) = dock.split(';')
-            except ValueError:
-                _LOGGER.debug("skipping line: '%s'", dock)
-                continue
-            _LOGGER.debug("container: %s, %s, status: %s", cimg, name, status)
-            status = get_docker_status(status)
-            contner = DockerNode(name, cimg, status=status, host=self.host)
-            containers.append(contner)
-        return containers
+            docks = self.client.containers(allnodes=allnodes)
+        except docker_api.DockerAPIError as exc:
+            _LOGGER.error("Error when retrieving list of docker containers on %s: %s",
+                          self.host, exc)
+            return []
+        return [ContainerRecord.from_api(dock, self.host) for dock in docks]
 
     def launch(self, cmd):
         """Launch given command"""
@@ -112,6 +151,83 @@ class DockerConnexion(object):
             _LOGGER.error(spexcep)
         return (rc, out, err)
 
+    def run(self, name, img, docker_opts='', labels=None):
+        """Create and start a container. Return (rc, out, err)"""
+        try:
+            config = docker_api.build_config(img, name, docker_opts,
+                                             cap_add=['net_raw', 'net_admin'],
+                                             labels=labels)
+        except docker_api.DockerOptsError as exc:
+            _LOGGER.debug("%s, falling back to docker cli", exc)
+            label_opts = " ".join("--label '%s=%s'" % item
+                                  for item in (labels or {}).items())
+            spawn_cmd = "docker run -d -t --name %s -h %s \
+                --cap-add net_raw --cap-add net_admin \
+                %s %s %s" % (name, name, label_opts, docker_opts, img)
+            return self.launch(spawn_cmd)
+        try:
+            self.client.create(name, config)
+            self.client.start(name)
+        except docker_api.DockerAPIError as exc:
+            return (1, '', str(exc))
+        return (0, name, '')
+
+    def remove(self, name):
+        """Remove a container and its volumes. Return (rc, out, err)"""
+        try:
+            self.client.remove(name)
+        except docker_api.DockerAPIError as exc:
+            return (1, '', str(exc))
+        return (0, name, '')
+
+    def execute(self, name, cmd):
+        """Execute command inside container. Return (rc, out, err)"""
+        try:
+            return self.client.execute(name, cmd)
+        except docker_api.DockerAPIError as exc:
+            return (1, '', str(exc))
+
+    def get_ips(self, names):
+        """Return {name: [ip, ...]} of running containers among names
+
+        All containers are read with a single engine request. IPs of
+        interfaces added with a static address are read from their label,
+        only containers without any known IP are asked from inside.
+        """
+        wanted = set(names)
+        try:
+            docks = self.client.containers(allnodes=False,
+                                           filters={'name': sorted(wanted)})
+        except docker_api.DockerAPIError as exc:
+            _LOGGER.error("Error when retrieving docker containers on %s: %s",
+                          self.host, exc)
+            return {}
+        ips = {}
+        for dock in docks:
+            record = ContainerRecord.from_api(dock, self.host)
+            # The engine filter matches substrings of names
+            if record.name not in wanted:
+                continue
+            ips[record.name] = record.ips or self.exec_ips(record.name)
+        return ips
+
+    def exec_ips(self, name):
+        """Return global IPs seen from inside the container"""
+        cmd = ['sh', '-c', "ip a show scope global | grep 'inet '"]
+        (rc, out, err) = self.execute(name, cmd)
+        if rc != 0:
+            _LOGGER.error("Something went wrong when getting ip of %s: %s", name, err)
+            return []
+        return [line.split()[1].split('/')[0] for line in out.splitlines()
+                if line.strip()]
+
+    def get_pid(self, name):
+        """Return pid of the container main process. Return (rc, out, err)"""
+        try:
+            return (0, str(self.client.inspect(name)['State']['Pid']), '')
+        except docker_api.DockerAPIError as exc:
+            return (1, '', str(exc))
+
 
 class DockerNode(clustdock.VirtualNode):
 
@@ -124,17 +240,11 @@ class DockerNode(clustdock.VirtualNode):
             self.add_iface = [self.add_iface]
         self.status = kwargs.get('status', STATUS['created'])
 
-    def start(self, pipe):
+    def start(self, pipe=None, fork=True, cnx=None):
         '''Start a docker container'''
-        # --cpuset-cpus {cpu_bind} \
-        cnx = DockerConnexion(self.host)
+        if cnx is None:
+            cnx = DockerConnexion(self.host)
         msg = 'OK'
-        spawn_cmd = "docker run -d -t --name %s -h %s \
-                --cap-add net_raw --cap-add net_admin \
-                %s %s" % (self.name,
-                          self.name,
-                          self.docker_opts,
-                          self.img)
         spawned = 1
         if self.before_start:
             _LOGGER.debug("Trying to launch before start hook: %s", self.before_start)
@@ -143,28 +253,41 @@ class DockerNode(clustdock.VirtualNode):
                 msg = "Error when spawning '{}'\n".format(self.name)
                 msg += stderr
                 _LOGGER.error(msg)
-                pipe.send(msg)
-                sys.exit(spawned)
+                return self.end_operation(spawned, msg, pipe, fork)
 
-        (rc, out, err) = cnx.launch(spawn_cmd)
+        ovs_bridges = set(br for br, _, _ in self.add_iface or []
+                          if self._is_ovs_bridge(br))
+        # Let the containers plumbed with this one wait for its interfaces
+        ticket = None
+        if any(br not in ovs_bridges for br, _, _ in self.add_iface or []):
+            ticket = netplumb.BATCHER.announce(self.host)
+        (rc, out, err) = cnx.run(self.name, self.img, self.docker_opts,
+                                 labels=self.iface_labels(ovs_bridges))
         if rc != 0:
             msg = "Error when spawning '{}'\n".format(self.name)
             msg += err
             _LOGGER.error(msg)
-            self.stop(cnx, fork=False)
+            netplumb.BATCHER.withdraw(ticket)
+            self.stop(fork=False, cnx=cnx)
         else:
             try:
-                if self.add_iface:
-                    for iface in self.add_iface:
-                        self._add_iface(iface)
+                system_ifaces = []
+                for iface in self.add_iface or []:
+                    if iface[0] in ovs_bridges:
+                        self._add_iface(iface, cnx, ovs=True)
+                    else:
+                        system_ifaces.append(iface)
+                if system_ifaces:
+                    self._plumb_ifaces(system_ifaces, cnx, ticket)
                 spawned = 0
             except AddIfaceException as exc:
+                netplumb.BATCHER.withdraw(ticket)
                 msg = "Error when spawning '{}'. Cannot add interface '{}'\n".format(
                       self.name,
                       exc.iface)
                 msg += str(exc)
                 _LOGGER.error(msg)
-                self.stop(cnx, fork=False)
+                self.stop(fork=False, cnx=cnx)
             else:
                 if self.after_start:
                     _LOGGER.debug("Trying to launch after start hook: %s",
@@ -176,16 +299,15 @@ class DockerNode(clustdock.VirtualNode):
                         msg += stderr
                         _LOGGER.error(msg)
                         spawned = 1
-        pipe.send(msg)
-        sys.exit(spawned)
+        return self.end_operation(spawned, msg, pipe, fork)
 
-    def stop(self, pipe=None, fork=True):
+    def stop(self, pipe=None, fork=True, cnx=None):
         """Stop docker container"""
-        cnx = DockerConnexion(self.host)
+        if cnx is None:
+            cnx = DockerConnexion(self.host)
         rc = 0
         msg = 'OK'
-        rmcmd = "docker rm -f -v %s" % self.name
-        (rc, out, err) = cnx.launch(rmcmd)
+        (rc, out, err) = cnx.remove(self.name)
         if rc != 0:
             msg = "Error when stopping '{}'\n".format(self.name)
             msg += err
@@ -198,95 +320,108 @@ class DockerNode(clustdock.VirtualNode):
                     msg = "Error when stopping '{}'\n".format(self.name)
                     msg += stderr
                     _LOGGER.error(msg)
-        if fork:
-            if pipe:
-                pipe.send(msg)
-            sys.exit(rc)
-        else:
-            return rc
+        return self.end_operation(rc, msg, pipe, fork)
 
-    def get_ip(self):
+    def get_ip(self, cnx=None):
         '''Get container ip from name'''
-        cnx = DockerConnexion(self.host)
-        ip = ''
-        cmd = "docker exec %s ip a show scope global | grep 'inet '" % self.name
-        (rc, out, err) = cnx.launch(cmd)
-        if rc != 0:
+        if cnx is None:
+            cnx = DockerConnexion(self.host)
+        ips = cnx.get_ips([self.name]).get(self.name, [])
+        ip = ips[0] if ips else ''
+        if ip == '':
             _LOGGER.error("Something went wrong when getting ip of %s", self.name)
-        else:
-            node_info = out.strip()
-            if node_info != '':
-                ip = node_info.split()[1].split('/')[0]
-            self.ip = ip
+        self.ip = ip
         return ip
 
-    def _add_iface(self, iface):
-        cnx = DockerConnexion(self.host)
+    def iface_labels(self, ovs_bridges):
+        '''Return labels recording static IPs of the interfaces to add'''
+        static = ["%s=%s" % (eth, ip) for br, eth, ip in self.add_iface or []
+                  if ip != 'dhcp' and br in ovs_bridges]
+        if not static:
+            return {}
+        return {IFACES_LABEL: " ".join(static)}
+
+    def _bridge(self, br):
+        """Return Bridge br of the host. Raise AddIfaceException if not usable"""
+        try:
+            bridge = bridges.lookup(self.host, br)
+        except RuntimeError as exc:
+            raise AddIfaceException(str(exc), br)
+        if bridge is None:
+            raise AddIfaceException("Bridge %s does not exist on host %s" %
+                                    (br, self.host), br)
+        if bridge.ip is None:
+            raise AddIfaceException("Cannot find ip for bridge %s" % br, br)
+        return bridge
+
+    def _is_ovs_bridge(self, br):
+        """Check if br is an openvswitch bridge of the host"""
+        try:
+            bridge = bridges.lookup(self.host, br)
+        except RuntimeError as exc:
+            _LOGGER.error(exc)
+            return False
+        return bridge is not None and bridge.kind == bridges.BRIDGE_OVS
+
+    def _add_iface(self, iface, cnx=None, ovs=None):
         """Add another interface to the docker container"""
-        prefix = "ssh %s" % self.host if self.host != 'localhost' else ''
+        if cnx is None:
+            cnx = DockerConnexion(self.host)
         br, eth, ip = iface
-        # ip addr show docker0 -> check the bridge presence
-        cmd = "%s ip addr show %s" % (prefix, br)
-        _LOGGER.debug("Trying to execute: %s", cmd)
-        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-        (ip_info, stderr) = p.communicate()
-        if p.returncode != 0:
-            _LOGGER.error(stderr)
-            raise AddIfaceException(stderr, br)
-        match = re.search("inet\s+([^\s]+)\s", ip_info)
-        if match:
-            br_ip = match.groups()[0]
-            IPv4Network(br_ip)
-        else:
-            raise AddIfaceException("Cannot find ip for bridge %s" % br, br)
-        # test if it's an ovs bridge
-        rc = sp.call("%s ovs-vsctl br-exists %s &> /dev/null" % (
-            prefix, br), shell=True)
-        if rc == 0:
+        bridge = self._bridge(br)
+        if ovs is None:
+            ovs = bridge.kind == bridges.BRIDGE_OVS
+        if ovs:
             # It's an ovs bridge
-            cmd = "%s ovs-docker add-port %s %s %s" % (
-                  prefix, br, eth, self.name
+            cmd = "ovs-docker add-port %s %s %s" % (
+                  br, eth, self.name
             )
             cmd += " --ipaddress=%s" % ip if ip != "dhcp" else ""
 
             _LOGGER.debug("Trying to execute: %s", cmd)
-            p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-            (_, stderr) = p.communicate()
-            if p.returncode != 0:
+            (rc, _, stderr) = sshpool.run(self.host, cmd)
+            if rc != 0:
                 _LOGGER.error(stderr)
                 raise AddIfaceException(stderr, br)
         else:
             # it's a system bridge
+            self._plumb_ifaces([iface], cnx)
 
-            # Get the pid of the container
-            cmd = "docker inspect -f '{{.State.Pid}}' %s" % self.name
-            (rc, out, err) = cnx.launch(cmd)
-            if rc != 0:
-                _LOGGER.error(err)
-                raise AddIfaceException(err, br)
-            pid = out.strip()
-            if_a_name = "v%spl%s" % (eth, pid)
-            if_b_name = "v%spg%s" % (eth, pid)
-            cmd = 'mkdir -p /var/run/netns \n ' + \
-                  'ln -s /proc/{pid}/ns/net /var/run/netns/{pid} \n ' + \
-                  'ip link add {a_if} type veth peer name {b_if} \n' + \
-                  'brctl addif %s {a_if} \n' % br + \
-                  'ip link set {a_if} up \n' + \
-                  'ip link set {b_if} netns {pid} \n' + \
-                  'ip netns exec {pid} ip link set dev {b_if} name %s \n' % eth + \
-                  'ip netns exec {pid} ip link set %s up\n' % eth + \
-                  'rm -f /var/run/netns/{pid}'
-            if self.host != 'localhost':
-                cmd = 'ssh -T %s <<ENDSSH \n ' % self.host + \
-                      '%s \n' % cmd + \
-                      'ENDSSH'
-            cmd = cmd.format(pid=pid, a_if=if_a_name, b_if=if_b_name)
-            _LOGGER.debug("Trying to execute: %s", cmd)
-            p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-            (_, stderr) = p.communicate()
-            if p.returncode != 0:
-                _LOGGER.error(stderr)
-                raise AddIfaceException(stderr, br)
+    def _plumb_ifaces(self, ifaces, cnx, ticket=None):
+        """Add interfaces on system bridges to the docker container
+
+        They are plumbed in one batch with the interfaces of the other
+        containers started at the same time on the host. ticket is the one
+        returned by netplumb.BATCHER.announce() for this start, if any.
+        """
+        for br, _, _ in ifaces:
+            self._bridge(br)
+        (rc, out, err) = cnx.get_pid(self.name)
+        if rc != 0:
+            _LOGGER.error(err)
+            raise AddIfaceException(err, ifaces[0][0])
+        links = [netplumb.new_link(out.strip(), br, eth) for br, eth, _ in ifaces]
+        (rc, stderr) = netplumb.BATCHER.submit(self.host, links, ticket)
+        if rc != 0:
+            _LOGGER.error(stderr)
+            raise AddIfaceException(stderr, ", ".join(br for br, _, _ in ifaces))
+
+
+def network_ips(settings):
+    """Return IPs given by the engine in container network settings"""
+    networks = (settings or {}).get('Networks') or {}
+    return [net['IPAddress'] for net in networks.values() if net.get('IPAddress')]
+
+
+def label_ips(labels):
+    """Return static IPs of added interfaces recorded in container labels"""
+    items = (labels or {}).get(IFACES_LABEL, '').split()
+    return [item.partition('=')[2].split('/')[0] for item in items]
+
+
+def container_ips(settings, labels):
+    """Return all known IPs of a container, engine networks first"""
+    return network_ips(settings) + label_ips(labels)
 
 
 def get_docker_status(status_str):
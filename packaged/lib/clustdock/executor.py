@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/executor.py
+@namespace clustdock.executor Bounded execution of node operations
+'''
+import errno
+import logging
+import os
+import threading
+from collections import deque
+import clustdock.inventory as inv
+
+_LOGGER = logging.getLogger(__name__)
+
+MAX_PARALLEL = 16
+MAX_PARALLEL_PER_HOST = 4
+# Time (in seconds) between two tries to take a slot held by other workers
+SLOT_RETRY = 0.1
+
+
+class HostSlots(object):
+    '''Operation slots shared by the executors of all worker processes
+
+    At most max_parallel operations hold a slot at the same time, and at
+    most max_per_host on the same host. Slots are recorded with the pid of
+    the process holding them: when no slot is free, those of processes
+    which died (or were killed) without releasing them are taken back.
+    '''
+
+    def __init__(self, max_parallel=MAX_PARALLEL, max_per_host=MAX_PARALLEL_PER_HOST):
+        self.max_parallel = max_parallel
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._running = 0
+        self._by_host = {}
+        # {pid: {host: number of slots}}
+        self._holders = {}
+
+    def _full(self, host):
+        return self._running >= self.max_parallel or \
+            self._by_host.get(host, 0) >= self.max_per_host
+
+    def acquire(self, host, pid):
+        """Take a slot on host for process pid. Return False if none is free"""
+        with self._lock:
+            if self._full(host):
+                self._reclaim()
+                if self._full(host):
+                    return False
+            self._count(pid, host, 1)
+            return True
+
+    def release(self, host, pid):
+        """Give back a slot taken on host by process pid"""
+        with self._lock:
+            if self._holders.get(pid, {}).get(host):
+                self._count(pid, host, -1)
+
+    def _count(self, pid, host, incr):
+        self._running += incr
+        self._by_host[host] = self._by_host.get(host, 0) + incr
+        if not self._by_host[host]:
+            del self._by_host[host]
+        held = self._holders.setdefault(pid, {})
+        held[host] = held.get(host, 0) + incr
+        if not held[host]:
+            del held[host]
+        if not held:
+            del self._holders[pid]
+
+    def _reclaim(self):
+        """Take back slots of dead processes"""
+        for pid in list(self._holders):
+            try:
+                os.kill(pid, 0)
+                continue
+            except OSError as exc:
+                if exc.errno != errno.ESRCH:
+                    continue
+            _LOGGER.warning("Taking back slots of dead process %d: %s", pid,
+                            self._holders[pid])
+            for host, count in self._holders[pid].items():
+                self._count(pid, host, -count)
+
+
+class _Task(object):
+    '''Operation queued in the executor'''
+
+    def __init__(self, group, host, func, args):
+        self.group = group
+        self.host = host
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+
+
+class _Group(object):
+    '''Tasks submitted by one call to Executor.run'''
+
+    def __init__(self, max_parallel, max_per_host, pending):
+        self.max_parallel = max_parallel
+        self.max_per_host = max_per_host
+        self.pending = pending
+        self.running = 0
+        self.by_host = {}
+
+
+class Executor(object):
+    '''Run node operations on a fixed set of threads
+
+    At most max_parallel operations run at the same time, and at most
+    max_per_host on the same host. With slots (a HostSlots shared through
+    the InventoryManager), these limits hold for all the worker processes
+    together. Each call to run() can lower these limits for its own tasks
+    (see the profile keys max_parallel and max_parallel_per_host). Threads
+    are started on first use and reused.
+    '''
+
+    def __init__(self, max_parallel=MAX_PARALLEL, max_per_host=MAX_PARALLEL_PER_HOST,
+                 slots=None):
+        self.max_parallel = max_parallel
+        self.max_per_host = max_per_host
+        self.slots = slots
+        # Whether a task allowed to run waits for a slot held by other workers
+        self._throttled = False
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._by_host = {}
+        self._threads = []
+
+    def run(self, tasks, max_parallel=None, max_per_host=None):
+        """Run tasks [(host, func, args), ...] and wait for all of them
+
+        Return [(result, exception), ...] in the order of tasks.
+        """
+        group = _Group(max_parallel or self.max_parallel,
+                       max_per_host or self.max_per_host,
+                       len(tasks))
+        queued = [_Task(group, host, func, args) for host, func, args in tasks]
+        with self._cond:
+            self._start_threads()
+            self._queue.extend(queued)
+            self._cond.notify_all()
+            while group.pending:
+                self._cond.wait()
+        return [(task.result, task.error) for task in queued]
+
+    def _start_threads(self):
+        while len(self._threads) < self.max_parallel:
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _can_run(self, task):
+        group = task.group
+        return self._by_host.get(task.host, 0) < self.max_per_host and \
+            group.running < group.max_parallel and \
+            group.by_host.get(task.host, 0) < group.max_per_host
+
+    def _next_task(self):
+        """Pop the first queued task allowed to run and holding a slot"""
+        self._throttled = False
+        for task in self._queue:
+            if self._can_run(task):
+                if self.slots is not None and \
+                        not self.slots.acquire(task.host, os.getpid()):
+                    self._throttled = True
+                    continue
+                self._queue.remove(task)
+                return task
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next_task()
+                while task is None:
+                    # Slots released by other workers are not notified
+                    self._cond.wait(SLOT_RETRY if self._throttled else None)
+                    task = self._next_task()
+                self._count(task, 1)
+            try:
+                task.result = task.func(*task.args)
+            except Exception as exc:
+                _LOGGER.exception("Operation on host '%s' failed", task.host)
+                task.error = exc
+            if self.slots is not None:
+                self.slots.release(task.host, os.getpid())
+            with self._cond:
+                self._count(task, -1)
+                task.group.pending -= 1
+                self._cond.notify_all()
+
+    def _count(self, task, incr):
+        group = task.group
+        group.running += incr
+        group.by_host[task.host] = group.by_host.get(task.host, 0) + incr
+        self._by_host[task.host] = self._by_host.get(task.host, 0) + incr
+
+
+inv.InventoryManager.register('HostSlots', HostSlots)
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/fanout.py
+@namespace clustdock.fanout Parallel execution of per-host operations
+'''
+import logging
+import threading
+import time
+import Queue
+
+_LOGGER = logging.getLogger(__name__)
+
+MAX_THREADS = 32
+
+
+class _Task(object):
+    '''One call of the fanned out function'''
+
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.started = None
+        self.done = threading.Event()
+
+
+def fan_out(func, items, timeout=None, max_threads=MAX_THREADS):
+    """Call func(item) for each item in parallel threads
+
+    Each call is given at most timeout seconds once started.
+    Return (results, errors): results maps items to the value returned by
+    func, errors maps items to an error message for failed or timed out calls.
+    """
+    tasks = [_Task(item) for item in items]
+    pending = Queue.Queue()
+    for task in tasks:
+        pending.put(task)
+
+    def work():
+        while True:
+            try:
+                task = pending.get_nowait()
+            except Queue.Empty:
+                return
+            task.started = time.time()
+            try:
+                task.result = func(task.item)
+            except Exception as exc:
+                _LOGGER.exception("Error when processing '%s'", task.item)
+                task.error = str(exc) or exc.__class__.__name__
+            task.done.set()
+
+    def spawn_thread():
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    for _ in xrange(min(max_threads, len(tasks))):
+        spawn_thread()
+
+    results = {}
+    errors = {}
+    for task in tasks:
+        while not task.done.is_set():
+            if task.started is None or timeout is None:
+                task.done.wait(0.1 if timeout is not None else None)
+                continue
+            remaining = task.started + timeout - time.time()
+            if remaining <= 0 or not task.done.wait(remaining):
+                break
+        if not task.done.is_set():
+            _LOGGER.warning("No answer for '%s' after %ss", task.item, timeout)
+            errors[task.item] = "timeout after %ss" % timeout
+            # the stuck thread is abandoned, keep the pool size
+            spawn_thread()
+        elif task.error is not None:
+            errors[task.item] = task.error
+        else:
+            results[task.item] = task.result
+    return results, errors
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/hooks.py
+@namespace clustdock.hooks Hooks of the nodes of a spawn run together
+'''
+import logging
+import pipes
+import time
+from ClusterShell.NodeSet import NodeSet
+import clustdock
+import clustdock.fanout as fanout
+import clustdock.virtual_cluster as vc
+
+_LOGGER = logging.getLogger(__name__)
+
+# Ways to run before_start/after_start hooks (profile key 'hook_mode'):
+# - node: by the start operation of each node
+# - parallel: once per node, at most 'hook_max_parallel' at the same time
+# - batch: once for all the nodes sharing the same hook
+HOOK_MODE_NODE = 'node'
+HOOK_MODE_PARALLEL = 'parallel'
+HOOK_MODE_BATCH = 'batch'
+HOOK_MODES = (HOOK_MODE_NODE, HOOK_MODE_PARALLEL, HOOK_MODE_BATCH)
+
+# Number of hooks run at the same time in parallel mode
+HOOK_PARALLEL = 8
+
+
+class HookEngine(object):
+    '''Run the hook of several nodes out of their start operation
+
+    In parallel mode, a hook gets the usual arguments: the node name, the
+    node type and the host. In batch mode, it gets the nodeset, the node
+    type and the hosts of the nodes ('host1:nodeset1 - host2:nodeset2'),
+    and one 'name type host' line per node on its standard input.
+    '''
+
+    def __init__(self, mode, timeout=None, max_parallel=HOOK_PARALLEL):
+        self.mode = mode
+        self.timeout = timeout
+        self.max_parallel = max_parallel
+
+    @classmethod
+    def from_profile(cls, profile):
+        """Return the engine of the profile, None if hooks are run by each node"""
+        mode = profile.get('hook_mode', HOOK_MODE_NODE)
+        if mode not in HOOK_MODES:
+            _LOGGER.error("Unknown hook_mode '%s', hooks are run by each node", mode)
+            return None
+        if mode == HOOK_MODE_NODE:
+            return None
+        return cls(mode, profile.get('hook_timeout'),
+                   int(profile.get('hook_max_parallel', HOOK_PARALLEL)))
+
+    def command(self, hook_file, vtype, nodes):
+        """Return (shell command, stdin) running hook_file for nodes"""
+        if self.mode == HOOK_MODE_BATCH:
+            nodeset = NodeSet.fromlist(node.name for node in nodes)
+            cmd = "%s %s %s %s" % (hook_file,
+                                   pipes.quote(str(nodeset)),
+                                   vtype,
+                                   pipes.quote(vc.byhosts(nodes)))
+            return (cmd, "".join("%s %s %s\n" % (node.name, vtype, node.host)
+                                 for node in nodes))
+        (node,) = nodes
+        return ("%s %s %s %s" % (hook_file, node.name, vtype, node.host), None)
+
+    def run(self, calls):
+        """Run hooks [(hook_file, vtype, node), ...]
+
+        Return {node name: (rc, stderr, elapsed)}. In batch mode, all nodes
+        of a call get its result.
+        """
+        groups = {}
+        for hook_file, vtype, node in calls:
+            key = (hook_file, vtype)
+            if self.mode != HOOK_MODE_BATCH:
+                key += (node.name,)
+            groups.setdefault(key, []).append(node)
+
+        def call(key):
+            cmd, stdin = self.command(key[0], key[1], groups[key])
+            start = time.time()
+            rc, _, stderr = clustdock.run_command(cmd, self.timeout, stdin)
+            return (rc, stderr, time.time() - start)
+
+        results, errors = fanout.fan_out(call, list(groups),
+                                         max_threads=self.max_parallel)
+        res = {}
+        for key, nodes in groups.iteritems():
+            result = results.get(key) or (1, errors.get(key, ''), 0)
+            _LOGGER.debug("Hook %s of %d nodes: rc %d in %.1fs", key[0], len(nodes),
+                          result[0], result[2])
+            for node in nodes:
+                res[node.name] = result
+        return res
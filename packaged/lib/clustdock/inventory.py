@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/inventory.py
+@namespace clustdock.inventory Cache of the nodes known on managed hosts
+'''
+import bisect
+import logging
+import threading
+import time
+from multiprocessing.managers import BaseManager
+import clustdock
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_TTL = 10
+# Same value for libvirt (VIR_DOMAIN_RUNNING) and docker ('up') nodes
+STATUS_RUNNING = 1
+VTYPES = set([clustdock.DOCKER_NODE, clustdock.LIBVIRT_NODE])
+# Time (in seconds) after which indexes reserved by a worker which did not
+# release them are available again
+RESERVATION_TTL = 3600
+# Time (in seconds) during which a host stays watched without being renewed
+# by the state watcher
+WATCH_LEASE = 90
+
+
+class IndexSet(object):
+    '''Set of node indexes stored as sorted disjoint intervals
+
+    Clusters made of consecutive indexes take a single interval, whatever
+    their size.
+    '''
+
+    def __init__(self, indexes=()):
+        self._starts = []
+        self._ends = []
+        for idx in indexes:
+            self.add(idx)
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+    def __iter__(self):
+        for start, end in zip(self._starts, self._ends):
+            for idx in xrange(start, end + 1):
+                yield idx
+
+    def _interval(self, idx):
+        """Return position of the interval which may contain idx, -1 if none"""
+        return bisect.bisect_right(self._starts, idx) - 1
+
+    def __contains__(self, idx):
+        pos = self._interval(idx)
+        return pos >= 0 and self._ends[pos] >= idx
+
+    def add(self, idx):
+        """Add an index, merging adjacent intervals"""
+        pos = self._interval(idx)
+        if pos >= 0 and self._ends[pos] >= idx:
+            return
+        after_left = pos >= 0 and self._ends[pos] == idx - 1
+        before_right = pos + 1 < len(self._starts) and self._starts[pos + 1] == idx + 1
+        if after_left and before_right:
+            self._ends[pos] = self._ends[pos + 1]
+            del self._starts[pos + 1]
+            del self._ends[pos + 1]
+        elif after_left:
+            self._ends[pos] = idx
+        elif before_right:
+            self._starts[pos + 1] = idx
+        else:
+            self._starts.insert(pos + 1, idx)
+            self._ends.insert(pos + 1, idx)
+
+    def discard(self, idx):
+        """Remove an index if present, splitting its interval"""
+        pos = self._interval(idx)
+        if pos < 0 or self._ends[pos] < idx:
+            return
+        start, end = self._starts[pos], self._ends[pos]
+        if start == end:
+            del self._starts[pos]
+            del self._ends[pos]
+        elif idx == start:
+            self._starts[pos] = idx + 1
+        elif idx == end:
+            self._ends[pos] = idx - 1
+        else:
+            self._ends[pos] = idx - 1
+            self._starts.insert(pos + 1, idx + 1)
+            self._ends.insert(pos + 1, end)
+
+    def lowest_free(self, count):
+        """Return the count lowest indexes missing from the set"""
+        free = []
+        candidate = 0
+        for start, end in zip(self._starts, self._ends):
+            if len(free) == count:
+                break
+            free.extend(xrange(candidate, min(start, candidate + count - len(free))))
+            candidate = end + 1
+        free.extend(xrange(candidate, candidate + count - len(free)))
+        return free
+
+
+class Inventory(object):
+    '''Nodes known on managed hosts, indexed by host and by node name
+
+    Nodes are stored as dicts (see clustdock.server.encode_node).
+    The content of a host expires ttl seconds after it was last listed,
+    or as soon as the host is invalidated, unless all its backends are
+    watched: their changes are then pushed by the state watcher and the
+    content does not expire while the watcher renews its lease. Each change
+    increments the generation number.
+    '''
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._hosts = {}
+        self._updated = {}
+        self._byname = {}
+        # Watched backends of each host: {host: {vtype: lease expiry date}}
+        self._watched = {}
+        self._generation = 0
+        # Indexes taken by known or reserved nodes: {clustername: IndexSet}
+        self._taken = {}
+        # Known nodes holding each index, whatever the format of their name:
+        # {clustername: {idx: set of names}}
+        self._holders = {}
+        # Reserved indexes: {clustername: {idx: expiry date}}
+        self._reserved = {}
+
+    def generation(self):
+        """Return the current generation number"""
+        return self._generation
+
+    def is_fresh(self, host):
+        """Check if the host content can be used without listing it again"""
+        with self._lock:
+            now = time.time()
+            leases = self._watched.get(host, {})
+            if all(leases.get(vtype, 0) > now for vtype in VTYPES):
+                return True
+            updated = self._updated.get(host)
+            return updated is not None and time.time() - updated < self.ttl
+
+    def stale_hosts(self, hosts):
+        """Return hosts among given ones that need to be listed again"""
+        return [host for host in hosts if not self.is_fresh(host)]
+
+    def set_host(self, host, nodes, vtype=None):
+        """Replace the content of a host with freshly listed nodes
+
+        If vtype is given, only nodes of this type are replaced.
+        """
+        with self._lock:
+            content = self._hosts.setdefault(host, {})
+            for name, node in content.items():
+                if vtype is None or node_vtype(node) == vtype:
+                    del content[name]
+                    if self._byname.get(name) == host:
+                        del self._byname[name]
+                        self._untake(name)
+            for node in nodes:
+                content[node['name']] = node
+                self._byname[node['name']] = host
+                self._take(node['name'])
+            if vtype is None:
+                self._updated[host] = time.time()
+            self._generation += 1
+
+    def watch(self, host, vtype, enabled=True, lease=WATCH_LEASE):
+        """Mark nodes of given type on host as kept up to date by events
+
+        The mark is dropped lease seconds later unless it is renewed by
+        calling watch again.
+        """
+        with self._lock:
+            leases = self._watched.setdefault(host, {})
+            was_watched = leases.get(vtype, 0) > time.time()
+            if enabled:
+                leases[vtype] = time.time() + lease
+            else:
+                leases.pop(vtype, None)
+            if was_watched != enabled:
+                self._generation += 1
+
+    def set_status(self, host, name, status):
+        """Update status of a known node. Return False if node is unknown"""
+        with self._lock:
+            node = self._hosts.get(host, {}).get(name)
+            if node is None:
+                return False
+            node['status'] = status
+            self._generation += 1
+            return True
+
+    def invalidate(self, host=None):
+        """Force next access to list the host (or all hosts) again"""
+        with self._lock:
+            if host is None:
+                self._updated.clear()
+            else:
+                self._updated.pop(host, None)
+            self._generation += 1
+
+    def add_nodes(self, nodes):
+        """Register new or updated nodes"""
+        with self._lock:
+            for node in nodes:
+                old_host = self._byname.get(node['name'])
+                if old_host is not None and old_host != node['host']:
+                    self._hosts[old_host].pop(node['name'], None)
+                self._hosts.setdefault(node['host'], {})[node['name']] = node
+                self._byname[node['name']] = node['host']
+                self._take(node['name'])
+            self._generation += 1
+
+    def remove_nodes(self, names):
+        """Forget stopped nodes"""
+        with self._lock:
+            for name in names:
+                host = self._byname.pop(name, None)
+                if host is not None:
+                    self._hosts[host].pop(name, None)
+                    self._untake(name)
+            self._generation += 1
+
+    def nodes(self, hosts, running=False):
+        """Return {host: [node, ...]} for given hosts"""
+        with self._lock:
+            res = {}
+            for host in hosts:
+                res[host] = [node for node in self._hosts.get(host, {}).itervalues()
+                             if not running or node['status'] == STATUS_RUNNING]
+            return res
+
+    def names(self, hosts=None):
+        """Return names of nodes known on given hosts (default: all hosts)"""
+        with self._lock:
+            if hosts is None:
+                return self._byname.keys()
+            return [name for host in hosts for name in self._hosts.get(host, {})]
+
+    def lookup(self, names, running=False):
+        """Return {name: node} for known nodes among given names"""
+        with self._lock:
+            res = {}
+            for name in names:
+                host = self._byname.get(name)
+                if host is None:
+                    continue
+                node = self._hosts[host][name]
+                if not running or node['status'] == STATUS_RUNNING:
+                    res[name] = node
+            return res
+
+    def _take(self, name):
+        clustername, idx = clustdock.VirtualNode.split_name(name)
+        if idx is not None:
+            self._taken.setdefault(clustername, IndexSet()).add(idx)
+            self._holders.setdefault(clustername, {}).setdefault(idx, set()).add(name)
+
+    def _untake(self, name):
+        clustername, idx = clustdock.VirtualNode.split_name(name)
+        if idx is None:
+            return
+        holders = self._holders.get(clustername, {})
+        names = holders.get(idx, set())
+        names.discard(name)
+        if names:
+            # Another node has the same index (e.g. 'cn1' and 'cn01')
+            return
+        holders.pop(idx, None)
+        if idx not in self._reserved.get(clustername, {}):
+            self._taken.get(clustername, IndexSet()).discard(idx)
+
+    def reserve(self, clustername, count, ttl=RESERVATION_TTL):
+        """Reserve and return the count lowest indexes free in a cluster
+
+        Reserved indexes are not given to other spawns until they are
+        released, or ttl seconds later.
+        """
+        with self._lock:
+            taken = self._taken.setdefault(clustername, IndexSet())
+            reserved = self._reserved.setdefault(clustername, {})
+            now = time.time()
+            expired = [idx for idx, expiry in reserved.iteritems() if expiry < now]
+            if expired:
+                _LOGGER.warning("Reservation of indexes %s of cluster '%s' expired",
+                                expired, clustername)
+                self.release(clustername, expired)
+            indexes = taken.lowest_free(count)
+            for idx in indexes:
+                taken.add(idx)
+                reserved[idx] = now + ttl
+            return indexes
+
+    def release(self, clustername, indexes):
+        """End reservation of indexes, those held by no known node become free"""
+        with self._lock:
+            reserved = self._reserved.get(clustername, {})
+            taken = self._taken.get(clustername, IndexSet())
+            holders = self._holders.get(clustername, {})
+            for idx in indexes:
+                reserved.pop(idx, None)
+                if idx not in holders:
+                    taken.discard(idx)
+
+
+def node_vtype(node):
+    """Return type of virtual node described by the given dict"""
+    if 'base_domain' in node:
+        return clustdock.LIBVIRT_NODE
+    return clustdock.DOCKER_NODE
+
+
+class InventoryManager(BaseManager):
+    '''Serve one Inventory to all worker processes'''
+    pass
+
+
+InventoryManager.register('Inventory', Inventory)
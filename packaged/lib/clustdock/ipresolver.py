@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/ipresolver.py
+@namespace clustdock.ipresolver Bulk IP resolution of libvirt domains
+'''
+import logging
+from lxml import etree
+import libvirt
+import clustdock.sshpool as sshpool
+
+_LOGGER = logging.getLogger(__name__)
+
+# libvirt sources of domain addresses, tried in this order for the macs
+# missing from the neighbour table (the agent may be slow or absent)
+ADDRESS_SOURCES = (
+    ('lease', 'VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE'),
+    ('agent', 'VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT'),
+)
+MAC_XPATH = etree.XPath("/domain/devices/interface/mac/@address")
+
+
+def parse_neighbours(output):
+    """Return {mac: [ip, ...]} from the output of 'ip neigh show'
+
+    Entries without link layer address (FAILED, INCOMPLETE) are skipped.
+    """
+    table = {}
+    for line in output.splitlines():
+        words = line.split()
+        if 'lladdr' not in words[:-1]:
+            continue
+        mac = words[words.index('lladdr') + 1].lower()
+        table.setdefault(mac, []).append(words[0])
+    return table
+
+
+def read_neighbours(host):
+    """Return the neighbour table of host, {} if it cannot be read"""
+    try:
+        (rc, out, err) = sshpool.run(host, 'ip neigh show')
+    except OSError as exc:
+        _LOGGER.error("Cannot read neighbour table of host '%s': %s", host, exc)
+        return {}
+    if rc != 0:
+        _LOGGER.error("Cannot read neighbour table of host '%s': %s", host, err.strip())
+        return {}
+    return parse_neighbours(out)
+
+
+def domain_macs(domain):
+    """Return mac addresses of the interfaces of a domain"""
+    return [mac.lower() for mac in MAC_XPATH(etree.fromstring(domain.XMLDesc()))]
+
+
+def domain_addresses(domain, source):
+    """Return {mac: [ip, ...]} known by libvirt from source ('lease' or 'agent')"""
+    flag = getattr(libvirt, dict(ADDRESS_SOURCES)[source], None)
+    if flag is None or not hasattr(domain, 'interfaceAddresses'):
+        return {}
+    try:
+        ifaces = domain.interfaceAddresses(flag)
+    except libvirt.libvirtError as exc:
+        _LOGGER.debug("No %s address for domain '%s': %s", source, domain.name(), exc)
+        return {}
+    table = {}
+    for iface in ifaces.itervalues():
+        if not iface.get('hwaddr'):
+            continue
+        addrs = [addr['addr'] for addr in iface.get('addrs') or []]
+        table.setdefault(iface['hwaddr'].lower(), []).extend(addrs)
+    return table
+
+
+def choose_ip(ips):
+    """Return the address to report among ips, IPv4 first"""
+    for ip in ips:
+        if ':' not in ip:
+            return ip
+    return ips[0] if ips else ''
+
+
+def resolve(cnx, host, names, read=None):
+    """Return {name: ip} for the domains of host, '' for unresolved ones
+
+    Domains are listed once and the neighbour table of the host is read
+    once, whatever the number of names, with read(host) if given. libvirt
+    address sources are only asked for domains whose macs are not in that
+    table.
+    """
+    ips = dict((name, '') for name in names)
+    try:
+        domains = dict((domain.name(), domain)
+                       for domain in cnx.instance.listAllDomains()
+                       if domain.name() in ips)
+    except libvirt.libvirtError as exc:
+        _LOGGER.error("Cannot list domains on host '%s': %s", host, exc)
+        return ips
+    macs = {}
+    for name, domain in domains.iteritems():
+        try:
+            macs[name] = domain_macs(domain)
+        except (libvirt.libvirtError, etree.XMLSyntaxError) as exc:
+            _LOGGER.error("Cannot read description of domain '%s': %s", name, exc)
+    missing = sorted(name for name in ips if name not in domains)
+    if missing:
+        _LOGGER.error("Couldn't find domains %s on host '%s'", ", ".join(missing), host)
+    neighbours = (read or read_neighbours)(host) if macs else {}
+    unresolved = set()
+    for name, addresses in macs.iteritems():
+        found = [ip for mac in addresses for ip in neighbours.get(mac, [])]
+        if found:
+            ips[name] = choose_ip(found)
+        else:
+            unresolved.add(name)
+    for source, _ in ADDRESS_SOURCES:
+        for name in sorted(unresolved):
+            table = domain_addresses(domains[name], source)
+            found = [ip for mac in macs[name] for ip in table.get(mac, [])]
+            if found:
+                ips[name] = choose_ip(found)
+                unresolved.discard(name)
+    for name, ip in sorted(ips.iteritems()):
+        _LOGGER.debug("ip of %s is '%s'", name, ip)
+    return ips
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/jobs.py
+@namespace clustdock.jobs Progress of asynchronous spawn/stop operations
+'''
+import copy
+import logging
+import threading
+import time
+import clustdock.inventory as inv
+
+_LOGGER = logging.getLogger(__name__)
+
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+NODE_PENDING = 'pending'
+NODE_DONE = 'done'
+NODE_FAILED = 'failed'
+# Time (in seconds) during which finished jobs are kept
+JOB_TTL = 3600
+
+
+class JobStore(object):
+    '''Jobs created by workers for spawn/stop commands
+
+    A job is a dict with following keys:
+        id, cmd, state, created, finished, errors, result and nodes, which
+        maps each node name to {'status', 'error', 'elapsed'}.
+    Finished jobs are forgotten ttl seconds after their end.
+    '''
+
+    def __init__(self, ttl=JOB_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._counter = 0
+
+    def create(self, cmd, names, errors=None):
+        """Register a new job on given nodes and return its id"""
+        with self._lock:
+            self._purge()
+            self._counter += 1
+            job_id = str(self._counter)
+            self._jobs[job_id] = {
+                'id': job_id,
+                'cmd': cmd,
+                'state': JOB_RUNNING,
+                'created': time.time(),
+                'finished': None,
+                'errors': list(errors or []),
+                'result': '',
+                'hosts': '',
+                'nodes': dict((name, {'status': NODE_PENDING,
+                                      'error': None,
+                                      'elapsed': None,
+                                      'stages': {}}) for name in names),
+            }
+            return job_id
+
+    def node_done(self, job_id, name, success, error=None, elapsed=None, stages=None):
+        """Record result of the operation on one node
+
+        stages gives the duration of each stage of the operation.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job['nodes'][name] = {'status': NODE_DONE if success else NODE_FAILED,
+                                  'error': error,
+                                  'elapsed': elapsed,
+                                  'stages': stages or {}}
+            if error:
+                job['errors'].append(error)
+
+    def add_error(self, job_id, msg):
+        """Record an error not related to a single node"""
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id]['errors'].append(msg)
+
+    def finish(self, job_id, result, hosts=''):
+        """Mark job as done, result is the nodeset of processed nodes
+
+        hosts describes on which hosts are the processed nodes.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job['state'] = JOB_DONE
+            job['finished'] = time.time()
+            job['result'] = result
+            job['hosts'] = hosts
+
+    def get(self, job_id):
+        """Return a copy of the job, None if unknown"""
+        with self._lock:
+            return copy.deepcopy(self._jobs.get(job_id))
+
+    def _purge(self):
+        limit = time.time() - self.ttl
+        for job_id, job in self._jobs.items():
+            if job['finished'] is not None and job['finished'] < limit:
+                del self._jobs[job_id]
+
+
+inv.InventoryManager.register('JobStore', JobStore)
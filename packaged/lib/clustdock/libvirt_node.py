@@ -8,26 +8,62 @@
 @file clustdock/libvirt_node.py
 @namespace clustdock.libvirt_node LibvirtNode definition
 '''
+import copy
+import hashlib
 import logging
-import sys
 import os
 import subprocess as sp
+import threading
 from lxml import etree
 import libvirt
 import clustdock
+import clustdock.ipresolver as ipresolver
+import clustdock.provision as provision
 
 _LOGGER = logging.getLogger(__name__)
 
 CLUSTDOCK_METADATA = "clustdock"
 AFTER_END_METADATA = "clustdock.after_end"
+# Keepalive of libvirt connexions: seconds between two messages and number
+# of messages without answer before the connexion is considered dead
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# XPath expressions used to build node descriptions, compiled once. They cannot
+# be evaluated by several threads at once: hold XPATH_LOCK when using them.
+XPATH_LOCK = threading.Lock()
+XPATH = dict((key, etree.XPath(path)) for key, path in (
+    ('domain', "/domain"),
+    ('name', "/domain/name"),
+    ('uuid', "/domain/uuid"),
+    ('memory', "/domain/memory"),
+    ('current_memory', "/domain/currentMemory"),
+    ('vcpu', "/domain/vcpu"),
+    ('devices', "//devices"),
+    ('disk_source', "//devices/disk/source"),
+    ('macs', "/domain/devices/interface/mac"),
+))
+IFACE_ELEMENT = etree.fromstring("<interface type='bridge'>\n"
+                                 "  <source bridge=''/>\n"
+                                 "  <model type='virtio'/>\n"
+                                 "</interface>\n")
+# Parsed base domains: {base domain: (sha1 of its description, DomainTemplate)}
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
 
 
 class LibvirtConnexion(object):
 
-    def __init__(self, host):
-        """Create new libvirt connexion on the specified node"""
+    def __init__(self, host, keepalive=False):
+        """Create new libvirt connexion on the specified node
+
+        With keepalive, the connexion detects a dead peer by itself. This
+        needs a libvirt event loop running in the process (see ConnexionPool).
+        """
         self.host = host
         self.uri = None
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
         if self.host != 'localhost':
             self.uri = "qemu+ssh://%s/system" % self.host
         self.connect()
@@ -42,12 +78,18 @@ class LibvirtConnexion(object):
             msg += str(exc)
             _LOGGER.error(msg)
             self.cnx = None
+            return
+        if self.keepalive:
+            try:
+                self.cnx.setKeepAlive(KEEPALIVE_INTERVAL, KEEPALIVE_COUNT)
+            except libvirt.libvirtError as exc:
+                _LOGGER.warning("No keepalive on connexion to host '%s': %s",
+                                self.host, exc)
 
     def is_ok(self):
-        """Check if the connexion is ok"""
-        if self.cnx is None:
-            return False
-        return self.cnx.isAlive()
+        """Check if the connexion is ok, opening it again if needed"""
+        cnx = self.instance
+        return cnx is not None and cnx.isAlive()
 
     def listvms(self, allnodes=True):
         """List all vms on the host"""
@@ -66,12 +108,87 @@ class LibvirtConnexion(object):
 
     @property
     def instance(self):
-        if self.cnx is None:
-            self.connect()
-        if not self.cnx.isAlive():
-            self.cnx.close()
-            self.connect()
-        return self.cnx
+        # Shared by threads: only one of them reconnects
+        with self.lock:
+            if self.cnx is None:
+                self.connect()
+            elif not self.cnx.isAlive():
+                _LOGGER.warning("Libvirt connexion to host '%s' lost, reconnecting",
+                                self.host)
+                try:
+                    self.cnx.close()
+                except libvirt.libvirtError:
+                    pass
+                self.connect()
+            return self.cnx
+
+    def close(self):
+        """Close the connexion"""
+        with self.lock:
+            if self.cnx is not None:
+                try:
+                    self.cnx.close()
+                except libvirt.libvirtError:
+                    pass
+                self.cnx = None
+
+
+class ConnexionPool(object):
+    '''Long-lived libvirt connexions of the process, one per host
+
+    Connexions are shared by all threads and kept alive: node operations
+    take them from here instead of opening a new (ssh) connexion each time.
+    Dead connexions are opened again on next use.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cnx = {}
+        self._event_loop = None
+
+    def _start_event_loop(self):
+        """Run the libvirt event loop needed by keepalive, once per process"""
+        if self._event_loop is not None:
+            return
+        libvirt.virEventRegisterDefaultImpl()
+
+        def run():
+            while True:
+                libvirt.virEventRunDefaultImpl()
+        self._event_loop = threading.Thread(target=run)
+        self._event_loop.daemon = True
+        self._event_loop.start()
+
+    def get(self, host):
+        """Return the connexion to host"""
+        with self._lock:
+            cnx = self._cnx.get(host)
+            if cnx is not None:
+                return cnx
+            self._start_event_loop()
+        # Connexions to several hosts are opened in parallel
+        cnx = LibvirtConnexion(host, keepalive=True)
+        with self._lock:
+            if host in self._cnx:
+                cnx.close()
+                return self._cnx[host]
+            self._cnx[host] = cnx
+            return cnx
+
+    def close(self):
+        """Close all connexions"""
+        with self._lock:
+            for cnx in self._cnx.values():
+                cnx.close()
+            self._cnx.clear()
+
+
+POOL = ConnexionPool()
+
+
+def get_connexion(host):
+    """Return the shared libvirt connexion to host"""
+    return POOL.get(host)
 
 
 class LibvirtNode(clustdock.VirtualNode):
@@ -103,6 +220,11 @@ class LibvirtNode(clustdock.VirtualNode):
         self.img_path = kwargs.get('img_path', None)
         if self.img_path is None:
             self.new_img_path()
+        self.hostname = kwargs.get('hostname', provision.HOSTNAME_DEFAULT)
+        # Set when the disk was created beforehand with the disks of other nodes
+        self.disk_ready = kwargs.get('disk_ready', False)
+        # Duration (in seconds) of each stage of the last start
+        self.timings = {}
 
     def new_img_path(self):
         """Return path of the node image"""
@@ -132,35 +254,40 @@ class LibvirtNode(clustdock.VirtualNode):
         except libvirt.libvirtError:
             _LOGGER.debug("no after_end hook set for domain '%s'", self.name)
 
-    def start(self, pipe):
+    def start(self, pipe=None, fork=True, cnx=None):
         """Start libvirt virtual machine"""
         spawned = 0
         msg = 'OK'
+        self.timings = {}
         _LOGGER.debug("Trying to spawn %s on host %s", self.name, self.host)
-        mngtvirt = libvirt.open()
-        cnx = LibvirtConnexion(self.host)
+        if cnx is None:
+            cnx = get_connexion(self.host)
+        if self.hostname not in provision.HOSTNAME_METHODS:
+            msg = "Error when spawning '{}'. Unknown hostname method '{}'\n".format(
+                  self.name, self.hostname)
+            _LOGGER.error(msg)
+            return self.end_operation(1, msg, pipe, fork)
         # Check if base domain exists, otherwise exit
-        base_dom = None
         try:
-            base_dom = mngtvirt.lookupByName(self.base_domain)
+            bxml_desc = self.base_description()
         except libvirt.libvirtError as exc:
             msg = "Base image '{}' doesn't exist\n".format(self.base_domain)
             msg += str(exc)
             _LOGGER.error(msg)
-            pipe.send(msg)
-            sys.exit(1)
+            return self.end_operation(1, msg, pipe, fork)
         # check if domain already exists
         if self.name in cnx.instance.listDefinedDomains():
             msg = "Image '{}' already exists. Skipping\n".format(self.name)
             # if force, delete and create
             _LOGGER.error(msg)
-            pipe.send(msg)
-            sys.exit(1)
+            if self.disk_ready:
+                # Domain defined since the disks of the spawn were provisioned
+                self.remove_disk()
+            return self.end_operation(1, msg, pipe, fork)
 
-        # Get xml description of the base image
-        bxml_desc = base_dom.XMLDesc()
         # Change xml content
-        new_xml = self.build_xml(bxml_desc)
+        new_xml = self.build_xml(bxml_desc,
+                                 smbios=self.hostname == provision.HOSTNAME_SMBIOS)
 
         if self.before_start:
             _LOGGER.debug("Trying to launch before start hook: %s", self.before_start)
@@ -169,76 +296,74 @@ class LibvirtNode(clustdock.VirtualNode):
                 msg = "Error when spawning '{}'\n".format(self.name)
                 msg += stderr
                 _LOGGER.error(msg)
-                pipe.send(msg)
-                sys.exit(1)
+                return self.end_operation(1, msg, pipe, fork)
 
         # Create new disk file for the node
         # Just save diffs from based image
-        cmd = "qemu-img create -f qcow2 -b %s %s && chmod a+w %s" % (self.baseimg_path,
-                                                                     self.img_path,
-                                                                     self.img_path)
-        _LOGGER.debug("Launching %s", cmd)
-        p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-        (_, stderr) = p.communicate()
-        if p.returncode != 0:
-            msg = "Error when spawning '{}'\n".format(self.name)
-            msg += stderr
-            _LOGGER.error(msg)
-            spawned = 1
-            self.stop(cnx, fork=False)
-        else:
-            cmd = "virt-customize --hostname %s -a %s" % (self.name, self.img_path)
-            # cmd = "guestfish -i -a %s write /etc/hostname '%s'" % (
-            #      self.img_path,
-            #      self.name)
-            _LOGGER.debug("Launching %s", cmd)
-            p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
-            (_, stderr) = p.communicate()
-            if p.returncode != 0:
+        if not self.disk_ready:
+            with provision.timed(self.timings, 'disk'):
+                err = provision.create_overlays([(self.baseimg_path, self.img_path)])
+            if err[self.img_path] is not None:
+                msg = "Error when spawning '{}'\n".format(self.name)
+                msg += err[self.img_path]
+                _LOGGER.error(msg)
+                self.stop(fork=False, cnx=cnx)
+                return self.end_operation(1, msg, pipe, fork)
+        if self.hostname == provision.HOSTNAME_VIRT_CUSTOMIZE:
+            with provision.timed(self.timings, 'hostname'):
+                rc, stderr = provision.customize_hostname(self.name, self.img_path)
+            if rc != 0:
                 msg = "Setting hostname for node '{}' failed\n".format(self.name)
                 msg += stderr
                 _LOGGER.error(msg)
-                spawned = 1
-                self.stop(cnx, fork=False)
-            else:
-                try:
-                    cnx.instance.defineXML(new_xml)
-                    dom = cnx.instance.lookupByName(self.name)
+                self.stop(fork=False, cnx=cnx)
+                return self.end_operation(1, msg, pipe, fork)
+        try:
+            with provision.timed(self.timings, 'define'):
+                cnx.instance.defineXML(new_xml)
+                dom = cnx.instance.lookupByName(self.name)
 
+                dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                                "<clustdock/>", "clustdock", CLUSTDOCK_METADATA)
+                if self.after_end:
                     dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
-                                    "<clustdock/>", "clustdock", CLUSTDOCK_METADATA)
-                    if self.after_end:
-                        dom.setMetadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
-                                        "<after_end path='%s'/>" % self.after_end,
-                                        "clustdock",
-                                        AFTER_END_METADATA)
-
-                    dom.create()
-                    if self.after_start:
-                        _LOGGER.debug("Trying to launch after start hook: %s",
-                                      self.after_start)
-                        rc, _, stderr = self.run_hook(self.after_start,
-                                                      clustdock.LIBVIRT_NODE)
-                        if rc != 0:
-                            msg = "Error when spawning '{}'\n".format(self.name)
-                            msg += stderr
-                            _LOGGER.error(msg)
-                            spawned = 1
-                except libvirt.libvirtError as exc:
-                    msg = "Domain '{}' alreay exists\n".format(self.name)
-                    msg += str(exc)
-                    _LOGGER.error(exc)
+                                    "<after_end path='%s'/>" % self.after_end,
+                                    "clustdock",
+                                    AFTER_END_METADATA)
+
+            with provision.timed(self.timings, 'boot'):
+                dom.create()
+            if self.after_start:
+                _LOGGER.debug("Trying to launch after start hook: %s",
+                              self.after_start)
+                with provision.timed(self.timings, 'hooks'):
+                    rc, _, stderr = self.run_hook(self.after_start,
+                                                  clustdock.LIBVIRT_NODE)
+                if rc != 0:
+                    msg = "Error when spawning '{}'\n".format(self.name)
+                    msg += stderr
+                    _LOGGER.error(msg)
                     spawned = 1
+        except libvirt.libvirtError as exc:
+            msg = "Domain '{}' alreay exists\n".format(self.name)
+            msg += str(exc)
+            _LOGGER.error(exc)
+            spawned = 1
+        _LOGGER.debug("Stages of %s: %s", self.name,
+                      provision.format_timings(self.timings))
+        return self.end_operation(spawned, msg, pipe, fork)
 
-        pipe.send(msg)
-        cnx.instance.close()
-        sys.exit(spawned)
+    def base_description(self):
+        """Return XML description of the base domain, defined on the server host"""
+        cnx = get_connexion('localhost')
+        return cnx.instance.lookupByName(self.base_domain).XMLDesc()
 
-    def stop(self, pipe=None, fork=True):
+    def stop(self, pipe=None, fork=True, cnx=None):
         """Stop libvirt node"""
         msg = 'OK'
         rc = 0
-        cnx = LibvirtConnexion(self.host)
+        if cnx is None:
+            cnx = get_connexion(self.host)
         try:
             dom = cnx.instance.lookupByName(self.name)
         except libvirt.libvirtError as exc:
@@ -268,6 +393,14 @@ class LibvirtNode(clustdock.VirtualNode):
                         msg += stderr
                         _LOGGER.error(msg)
                         rc = 1
+        err = self.remove_disk()
+        if err is not None:
+            msg = err
+            rc = 1
+        return self.end_operation(rc, msg, pipe, fork)
+
+    def remove_disk(self):
+        '''Remove disk of the node. Return error message or None'''
         cmd = "rm -f %s" % self.img_path
         _LOGGER.debug("Launching %s", cmd)
         p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
@@ -276,65 +409,25 @@ class LibvirtNode(clustdock.VirtualNode):
             msg = "Error when removing disk for node '{}'\n".format(self.name)
             msg += stderr
             _LOGGER.error(msg)
-            rc = 1
-        cnx.instance.close()
-        if fork:
-            if pipe:
-                pipe.send(msg)
-            sys.exit(rc)
-        else:
-            return rc
+            return msg
+        return None
 
-    def get_ip(self):
+    def get_ip(self, cnx=None):
         '''Get vm ip from domain name'''
-        ip = ''
-        cnx = LibvirtConnexion(self.host)
-        try:
-            domain = cnx.instance.lookupByName(self.name)
-        except libvirt.libvirtError:
-            _LOGGER.error("Couldn't find domain '{}'\n".format(self.name))
-            cnx.instance.close()
-            return ip
-        xml_desc = domain.XMLDesc()
-        tree = etree.fromstring(xml_desc)
-        mac = tree.xpath("//mac/@address")[0]
-        _LOGGER.debug('mac of domain %s is %s', self.name, mac)
-        try:
-            cmd = "ip neigh | grep '%s' | awk '{print $1}'" % mac
-            p = sp.Popen(cmd, stdout=sp.PIPE, shell=True)
-            (node_info, _) = p.communicate()
-            ip = node_info.strip()
-            _LOGGER.debug("ip of %s is '%s'", self.name, ip)
-
-        except sp.CalledProcessError:
-            _LOGGER.error("Something went wrong when getting ip of %s", self.name)
+        if cnx is None:
+            cnx = get_connexion(self.host)
+        ip = ipresolver.resolve(cnx, self.host, [self.name])[self.name]
         self.ip = ip
-        cnx.instance.close()
         return ip
 
-    def build_xml(self, xml_info):
-        '''Generate new XML description for the node from the base description'''
-        tree = etree.fromstring(xml_info)
-        dom = tree.xpath("/domain")[0]
-        path = tree.xpath("//devices/disk/source")[0]
-        self.baseimg_path = path.get('file')
-        path.set('file', self.img_path)
-        dom_name = tree.xpath("/domain/name")
-        dom_name[0].text = self.name
-        uuid = tree.xpath("/domain/uuid")[0]
-        if etree.iselement(uuid):
-            dom.remove(uuid)
-        macs = tree.xpath("/domain/devices/interface/mac")
-        for mac in macs:
-            mac.getparent().remove(mac)
-        if self.add_iface:
-            for iface in self.add_iface:
-                tree = self._add_iface(tree, iface)
-        if self.mem:
-            self._set_memory(tree)
-        if self.cpu:
-            self._set_cpu(tree)
-        return etree.tostring(tree)
+    def build_xml(self, xml_info, smbios=False):
+        '''Generate new XML description for the node from the base description
+
+        With smbios, the hostname is given in the SMBIOS data of the domain.
+        '''
+        template = get_template(self.base_domain, xml_info)
+        self.baseimg_path = template.baseimg_path
+        return template.render(self, smbios)
 
     def __str__(self):
         return self.name
@@ -348,34 +441,80 @@ class LibvirtNode(clustdock.VirtualNode):
     @staticmethod
     def _add_iface(tree, iface):
         """Add network interface to the VM"""
-        desc = "<interface type='bridge'>\n" + \
-               "  <source bridge='%s'/>\n" % iface + \
-               "  <model type='virtio'/>\n" + \
-               "</interface>\n"
-        new_iface = etree.fromstring(desc)
-        devices = tree.xpath("//devices")[0]
-        devices.append(new_iface)
+        new_iface = copy.deepcopy(IFACE_ELEMENT)
+        new_iface[0].set('bridge', iface)
+        XPATH['devices'](tree)[0].append(new_iface)
         return tree
 
     def _set_memory(self, tree):
         """Set memory limit for the node"""
-        desc = "<memory unit='MB'>%s</memory>" % self.mem
-        new_mem = etree.fromstring(desc)
-        dom = tree.xpath("/domain")[0]
-        cur_mem = tree.xpath("/domain/currentMemory")
+        new_mem = etree.Element('memory', unit='MB')
+        new_mem.text = str(self.mem)
+        dom = XPATH['domain'](tree)[0]
+        cur_mem = XPATH['current_memory'](tree)
         if cur_mem and etree.iselement(cur_mem[0]):
             dom.remove(cur_mem[0])
-        memory = tree.xpath("/domain/memory")[0]
+        memory = XPATH['memory'](tree)[0]
         dom.replace(memory, new_mem)
         return tree
 
     def _set_cpu(self, tree):
         """Set number of cpus for the node"""
-        cpu = tree.xpath("/domain/vcpu")[0]
+        cpu = XPATH['vcpu'](tree)[0]
         cpu.text = str(self.cpu)
         return tree
 
 
+class DomainTemplate(object):
+    '''Parsed description of a base domain, shared by the nodes cloned from it
+
+    The base description is parsed once. Each node gets a copy of the tree
+    with its own name, disk, memory, cpus and interfaces.
+    '''
+
+    def __init__(self, xml_info):
+        tree = etree.fromstring(xml_info)
+        with XPATH_LOCK:
+            self.baseimg_path = XPATH['disk_source'](tree)[0].get('file')
+            # Never kept by clones: libvirt gives them new ones
+            dom = XPATH['domain'](tree)[0]
+            for uuid in XPATH['uuid'](tree):
+                dom.remove(uuid)
+            for mac in XPATH['macs'](tree):
+                mac.getparent().remove(mac)
+        self.tree = tree
+
+    def render(self, node, smbios=False):
+        """Return the XML description of node"""
+        tree = copy.deepcopy(self.tree)
+        with XPATH_LOCK:
+            XPATH['disk_source'](tree)[0].set('file', node.img_path)
+            XPATH['name'](tree)[0].text = node.name
+            if node.add_iface:
+                for iface in node.add_iface:
+                    node._add_iface(tree, iface)
+            if node.mem:
+                node._set_memory(tree)
+            if node.cpu:
+                node._set_cpu(tree)
+        if smbios:
+            provision.set_hostname(tree, node.name)
+        return etree.tostring(tree)
+
+
+def get_template(base_domain, xml_info):
+    """Return template of base_domain, parsing xml_info only if it changed"""
+    digest = hashlib.sha1(xml_info).hexdigest()
+    with _TEMPLATES_LOCK:
+        cached = _TEMPLATES.get(base_domain)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+    template = DomainTemplate(xml_info)
+    with _TEMPLATES_LOCK:
+        _TEMPLATES[base_domain] = (digest, template)
+    return template
+
+
 def get_source_path(xmltree):
     """Get source image path from xml description"""
     path = xmltree.xpath("//devices/disk/source/@file")[0]
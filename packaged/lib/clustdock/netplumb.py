@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/netplumb.py
+@namespace clustdock.netplumb Batched plumbing of container interfaces on system bridges
+'''
+import logging
+import threading
+import time
+from collections import namedtuple
+import clustdock.sshpool as sshpool
+
+_LOGGER = logging.getLogger(__name__)
+
+# Time (in seconds) a batch waits at most for the links of announced
+# containers still being created
+BATCH_MAX_WAIT = 2
+
+# veth pair linking the network namespace of process pid to a bridge:
+# host_if is enslaved to bridge, its peer is named eth in the namespace
+Link = namedtuple('Link', ['pid', 'bridge', 'eth', 'host_if'])
+
+
+def new_link(pid, bridge, eth):
+    """Return the Link of interface eth of the container of process pid"""
+    return Link(str(pid), bridge, eth, "v%spl%s" % (eth, pid))
+
+
+def plumb_script(links):
+    """Return shell script plumbing all links at once
+
+    Host side interfaces are created, enslaved and set up in a single
+    'ip -batch' transaction, each peer being created directly in its
+    namespace under its final name. Interfaces of each namespace are then
+    set up with one 'ip -batch' in the namespace. On any failure, host
+    side interfaces are deleted (with their peers) and the script fails.
+    """
+    lines = ["rollback() {",
+             "    for dev in %s; do ip link del $dev 2>/dev/null; done" % " ".join(
+                 link.host_if for link in links),
+             "    exit 1",
+             "}",
+             "ip -batch - <<'CLUSTDOCK_EOF' || rollback"]
+    for link in links:
+        lines.append("link add %s type veth peer name %s netns %s" % (
+            link.host_if, link.eth, link.pid))
+        lines.append("link set %s master %s up" % (link.host_if, link.bridge))
+    lines.append("CLUSTDOCK_EOF")
+    pids = []
+    for link in links:
+        if link.pid not in pids:
+            pids.append(link.pid)
+    for pid in pids:
+        lines.append("nsenter -t %s -n ip -batch - <<'CLUSTDOCK_EOF' || rollback" % pid)
+        lines.extend("link set %s up" % link.eth for link in links if link.pid == pid)
+        lines.append("CLUSTDOCK_EOF")
+    return "\n".join(lines) + "\n"
+
+
+def plumb(host, links):
+    """Plumb links on host in one command. Return (rc, stderr)"""
+    _LOGGER.debug("Plumbing %d interfaces on host '%s'", len(links), host)
+    rc, _, stderr = sshpool.run(host, plumb_script(links))
+    return (rc, stderr)
+
+
+class Batcher(object):
+    '''Gather links of the containers started at the same time on a host
+
+    Container starts needing plumbing announce themselves before creating
+    their container. The first start submitting links for a host waits
+    until every announced start of the host has submitted its links or
+    withdrawn (or max_wait seconds), then plumbs them all in one batch.
+    If the batch fails, it is rolled back and the links of each container
+    are plumbed alone, so that only the containers in error fail.
+
+    A batch holds the containers started concurrently on the host, which
+    the executor bounds with max_parallel_per_host: each start waits for
+    its own plumbing, so waiting for all the containers of a spawn would
+    block the executor slots needed to start them.
+    '''
+
+    def __init__(self, max_wait=BATCH_MAX_WAIT, run=plumb):
+        self.max_wait = max_wait
+        self.run = run
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._announced = {}
+
+    def announce(self, host):
+        """Register a start which will submit links for host. Return its ticket"""
+        ticket = {'host': host, 'open': True}
+        with self._cond:
+            self._announced[host] = self._announced.get(host, 0) + 1
+        return ticket
+
+    def withdraw(self, ticket):
+        """Unregister an announced start which did not submit its links"""
+        if ticket is None:
+            return
+        with self._cond:
+            self._close(ticket)
+
+    def _close(self, ticket):
+        if ticket is not None and ticket['open']:
+            ticket['open'] = False
+            self._announced[ticket['host']] -= 1
+            self._cond.notify_all()
+
+    def submit(self, host, links, ticket=None):
+        """Plumb links on host with those of other starts. Return (rc, stderr)"""
+        entry = {'links': links, 'done': threading.Event(), 'result': None}
+        with self._cond:
+            self._close(ticket)
+            leader = host not in self._pending
+            self._pending.setdefault(host, []).append(entry)
+            if leader:
+                deadline = time.time() + self.max_wait
+                while self._announced.get(host, 0) > 0 and time.time() < deadline:
+                    self._cond.wait(deadline - time.time())
+                entries = self._pending.pop(host)
+        if leader:
+            self._flush(host, entries)
+        entry['done'].wait()
+        return entry['result']
+
+    def _flush(self, host, entries):
+        try:
+            result = self.run(host, [link for entry in entries
+                                     for link in entry['links']])
+            if result[0] != 0 and len(entries) > 1:
+                _LOGGER.warning("Plumbing of %d containers failed on host '%s', "
+                                "retrying them one by one", len(entries), host)
+                for entry in entries:
+                    entry['result'] = self.run(host, entry['links'])
+            else:
+                for entry in entries:
+                    entry['result'] = result
+        except Exception as exc:
+            _LOGGER.exception("Plumbing failed on host '%s'", host)
+            for entry in entries:
+                if entry['result'] is None:
+                    entry['result'] = (1, str(exc))
+        finally:
+            for entry in entries:
+                entry['done'].set()
+
+
+BATCHER = Batcher()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/provision.py
+@namespace clustdock.provision Disk and hostname provisioning of libvirt nodes
+'''
+import logging
+import os
+import subprocess as sp
+import time
+from contextlib import contextmanager
+from lxml import etree
+
+_LOGGER = logging.getLogger(__name__)
+
+# Ways to give its hostname to a libvirt node (profile key 'hostname'):
+# - virt-customize (default): written in the disk image (boots a libguestfs
+#   appliance), works with any image
+# - smbios: in the SMBIOS serial of the domain, read by cloud-init (NoCloud),
+#   much faster but the image must run cloud-init
+# - none: left to the image
+HOSTNAME_SMBIOS = 'smbios'
+HOSTNAME_VIRT_CUSTOMIZE = 'virt-customize'
+HOSTNAME_NONE = 'none'
+HOSTNAME_METHODS = (HOSTNAME_SMBIOS, HOSTNAME_VIRT_CUSTOMIZE, HOSTNAME_NONE)
+# virt-customize stays the default: whether an image runs cloud-init cannot
+# be known without inspecting it (which is what virt-customize costs), and
+# an image without it ignores the SMBIOS serial and keeps the hostname of
+# its base domain. Profiles with cloud-init images set hostname = "smbios".
+HOSTNAME_DEFAULT = HOSTNAME_VIRT_CUSTOMIZE
+
+# Number of disk overlays created at the same time
+OVERLAY_PARALLEL = 32
+
+
+@contextmanager
+def timed(timings, stage):
+    """Record in timings the duration (in seconds) of the enclosed stage"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0) + time.time() - start
+
+
+def format_timings(timings):
+    """Return printable durations of stages"""
+    return ", ".join("%s %.1fs" % item for item in sorted(timings.items()))
+
+
+def create_overlays(disks, max_parallel=OVERLAY_PARALLEL):
+    """Create qcow2 overlays [(base image, overlay path), ...] in parallel
+
+    Return {overlay path: error message or None}.
+    """
+    results = {}
+    pending = list(disks)
+    running = []
+    while pending or running:
+        while pending and len(running) < max_parallel:
+            base, path = pending.pop(0)
+            cmd = ['qemu-img', 'create', '-q', '-f', 'qcow2', '-b', base, path]
+            _LOGGER.debug("Launching %s", " ".join(cmd))
+            try:
+                proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+            except OSError as exc:
+                results[path] = str(exc)
+                continue
+            running.append((path, proc))
+        if not running:
+            continue
+        path, proc = running.pop(0)
+        (_, stderr) = proc.communicate()
+        if proc.returncode != 0:
+            results[path] = stderr
+            continue
+        try:
+            os.chmod(path, 0o666)
+        except OSError as exc:
+            results[path] = str(exc)
+            continue
+        results[path] = None
+    return results
+
+
+def set_hostname(tree, hostname):
+    """Give hostname to the domain through its SMBIOS serial (NoCloud seed)"""
+    dom = tree.xpath("/domain")[0]
+    for sysinfo in dom.findall("sysinfo"):
+        dom.remove(sysinfo)
+    sysinfo = etree.SubElement(dom, "sysinfo", type="smbios")
+    system = etree.SubElement(sysinfo, "system")
+    serial = etree.SubElement(system, "entry", name="serial")
+    serial.text = "ds=nocloud;h=%s;i=%s" % (hostname, hostname)
+    os_elt = dom.find("os")
+    if os_elt is None:
+        os_elt = etree.SubElement(dom, "os")
+    smbios = os_elt.find("smbios")
+    if smbios is None:
+        smbios = etree.SubElement(os_elt, "smbios")
+    smbios.set("mode", "sysinfo")
+    return tree
+
+
+def customize_hostname(hostname, img_path):
+    """Write hostname in the disk image. Return (rc, stderr)"""
+    cmd = "virt-customize --hostname %s -a %s" % (hostname, img_path)
+    _LOGGER.debug("Launching %s", cmd)
+    p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE, shell=True)
+    (_, stderr) = p.communicate()
+    return (p.returncode, stderr)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/scheduler.py
+@namespace clustdock.scheduler Placement of new nodes on managed hosts
+'''
+import logging
+import clustdock.docker_api as docker_api
+import clustdock.libvirt_node as lnode
+
+_LOGGER = logging.getLogger(__name__)
+
+# Placement policies (profile key 'placement'):
+# - spread: each node goes to the host with the fewest nodes, then the most
+#   free memory
+# - pack: each node goes to the fitting host with the least free memory
+#   left, so that other hosts stay free for large nodes
+POLICY_SPREAD = 'spread'
+POLICY_PACK = 'pack'
+POLICIES = (POLICY_SPREAD, POLICY_PACK)
+DEFAULT_POLICY = POLICY_SPREAD
+
+# Number of vcpus of libvirt domains per physical cpu of a host (profile
+# key 'cpu_overcommit')
+CPU_OVERCOMMIT = 4.0
+
+MIB = 1024 * 1024
+# libvirt memory units, in KiB
+MEMORY_UNITS = {
+    'b': 1.0 / 1024, 'bytes': 1.0 / 1024,
+    'kb': 1000.0 / 1024, 'k': 1, 'kib': 1,
+    'mb': 1000.0 ** 2 / 1024, 'm': 1024, 'mib': 1024,
+    'gb': 1000.0 ** 3 / 1024, 'g': 1024 ** 2, 'gib': 1024 ** 2,
+}
+
+
+class NoCapacity(Exception):
+    '''No host has enough free resources for a node'''
+    pass
+
+
+class HostResources(object):
+    '''Free cpus and memory (MiB) of a host, and number of nodes on it'''
+
+    def __init__(self, host, cpus, mem, nodes=0):
+        self.host = host
+        self.cpus = cpus
+        self.mem = mem
+        self.nodes = nodes
+
+    def __repr__(self):
+        return "<HostResources %s: %d cpus, %d MiB, %d nodes>" % (self.host, self.cpus,
+                                                                   self.mem, self.nodes)
+
+    def fits(self, cpus, mem):
+        """Check if a node needing cpus and mem (MiB) fits on the host"""
+        return cpus <= self.cpus and mem <= self.mem
+
+    def reserve(self, cpus, mem):
+        """Account for a node placed on the host"""
+        self.cpus -= cpus
+        self.mem -= mem
+        self.nodes += 1
+
+
+def probe_libvirt(cnx, host, cpu_overcommit=CPU_OVERCOMMIT):
+    """Return free resources of a libvirt host
+
+    Free cpus are the cpus of the host times cpu_overcommit, minus the
+    vcpus of running domains. Memory is the lowest of the memory free on
+    the host and of the memory not allocated to running domains, which may
+    not use it all yet.
+    """
+    info = cnx.instance.getInfo()
+    domains = [dom.info() for dom in cnx.instance.listAllDomains() if dom.isActive()]
+    used_cpus = sum(dom[3] for dom in domains)
+    allocated = sum(dom[1] for dom in domains) / 1024
+    free_mem = min(cnx.instance.getFreeMemory() / MIB, info[1] - allocated)
+    return HostResources(host, int(info[2] * float(cpu_overcommit)) - used_cpus, free_mem,
+                         len(domains))
+
+
+def probe_docker(cnx, host):
+    """Return resources of a docker host
+
+    Containers do not reserve resources, so all cpus and memory of the host
+    are available and only the number of running containers changes.
+    """
+    info = cnx.client.info()
+    return HostResources(host, info.get('NCPU', 0), info.get('MemTotal', 0) / MIB,
+                         info.get('ContainersRunning', 0))
+
+
+def domain_resources(tree):
+    """Return (cpus, memory in MiB) of a parsed domain description"""
+    with lnode.XPATH_LOCK:
+        cpus = lnode.XPATH['vcpu'](tree)
+        memory = lnode.XPATH['memory'](tree)
+    mem = 0
+    if memory:
+        unit = MEMORY_UNITS.get(memory[0].get('unit', 'KiB').lower(), 1)
+        mem = int(int(memory[0].text) * unit / 1024)
+    return (int(cpus[0].text) if cpus else 1, mem)
+
+
+def node_request(node, base_tree=None):
+    """Return (cpus, memory in MiB) needed by a node
+
+    Libvirt nodes without 'cpu' or 'mem' get the values of their base domain
+    when its description is given. Docker nodes need the memory limit set in
+    their options and a cpu per pinned cpu.
+    """
+    if isinstance(node, lnode.LibvirtNode):
+        cpus, mem = domain_resources(base_tree) if base_tree is not None else (1, 0)
+        return (int(node.cpu or cpus), int(node.mem or mem))
+    try:
+        config = docker_api.build_config('', '', getattr(node, 'docker_opts', ''))
+    except docker_api.DockerOptsError:
+        return (0, 0)
+    host_config = config['HostConfig']
+    cpus = 0
+    for part in host_config.get('CpusetCpus', '').split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus += int(last) - int(first) + 1
+        elif part:
+            cpus += 1
+    return (cpus, host_config.get('Memory', 0) / MIB)
+
+
+def _spread_key(resources, cpus, mem):
+    return (resources.nodes, -resources.mem, -resources.cpus, resources.host)
+
+
+def _pack_key(resources, cpus, mem):
+    return (resources.mem - mem, resources.cpus - cpus, -resources.nodes, resources.host)
+
+
+def place(requests, resources, policy=DEFAULT_POLICY):
+    """Choose a host for each (cpus, mem) request
+
+    Largest requests are placed first. resources are updated with the
+    placed nodes. Return hosts in the order of requests, raise NoCapacity
+    if a node does not fit on any host.
+    """
+    key = {POLICY_SPREAD: _spread_key, POLICY_PACK: _pack_key}[policy]
+    hosts = [None] * len(requests)
+    order = sorted(range(len(requests)), key=lambda idx: (-requests[idx][1],
+                                                          -requests[idx][0], idx))
+    for idx in order:
+        cpus, mem = requests[idx]
+        candidates = [res for res in resources if res.fits(cpus, mem)]
+        if not candidates:
+            raise NoCapacity("no host with %d free cpus and %d MiB of free memory" %
+                             (cpus, mem))
+        chosen = min(candidates, key=lambda res: key(res, cpus, mem))
+        chosen.reserve(cpus, mem)
+        hosts[idx] = chosen.host
+    _LOGGER.debug("Placement (%s): %s", policy, resources)
+    return hosts
@@ -14,15 +14,29 @@ import msgpack
 import signalfd
 import signal
 import os
-import random
-import multiprocessing as mp
+import threading
+import time
+from lxml import etree
 from ClusterShell.NodeSet import NodeSet
-from ClusterShell.NodeSet import NodeSetBase
-from ClusterShell.RangeSet import RangeSet
 from ClusterShell.NodeSet import NodeSetParseError
 import clustdock.virtual_cluster as vc
 import clustdock.docker_node as dnode
 import clustdock.libvirt_node as lnode
+import clustdock.fanout as fanout
+import clustdock.hooks as hooks
+import clustdock.agent as agent
+import clustdock.bridges as bridges
+import clustdock.ipresolver as ipresolver
+import clustdock.provision as provision
+import clustdock.scheduler as scheduler
+import clustdock.sshpool as sshpool
+import clustdock.warmpool as warmpool
+import clustdock.inventory as inv
+import clustdock.broker as broker
+import clustdock.executor as executor
+import clustdock.jobs as jobs
+import clustdock.client as clt
+import clustdock.client_protocol as proto
 import clustdock
 
 _LOGGER = logging.getLogger(__name__)
@@ -30,25 +44,79 @@ _LOGGER = logging.getLogger(__name__)
 
 class ClustdockWorker(object):
 
-    def __init__(self, url_server, worker_id, profiles, hostlist, docker_port):
+    def __init__(self, url_server, worker_id, profiles, hostlist, docker_port,
+                 host_timeout=None, inventory=None, lane=broker.SLOW_LANE, jobstore=None,
+                 max_parallel=executor.MAX_PARALLEL,
+                 max_parallel_per_host=executor.MAX_PARALLEL_PER_HOST, agent_port=None,
+                 agent_curve_dir=None, host_slots=None):
         self.worker_id = worker_id
+        self.lane = lane
+        self.client = None
         self.url_server = url_server
         self.profiles = profiles
         self.hostlist = hostlist
-        self.libvirt_cnx = {}
         self.docker_cnx = {}
         self.docker_port = docker_port
+        self.host_timeout = host_timeout
+        # Port of the agents of managed hosts, None if they have no agent
+        self.agent_port = agent_port
+        # Directory of the CURVE certificates of the agents, None if not used
+        self.agent_curve_dir = agent_curve_dir
+        if inventory is None:
+            inventory = inv.Inventory()
+        self.inventory = inventory
+        if jobstore is None:
+            jobstore = jobs.JobStore()
+        self.jobs = jobstore
+        # host_slots shares the executor limits with the other workers
+        self.executor = executor.Executor(max_parallel, max_parallel_per_host, host_slots)
+        self.job_threads = []
+        self.streams = {}
+        self.events_lock = threading.Lock()
 
     def init_sockets(self):
         """Initialize zmq sockets"""
         _LOGGER.debug("Initializing sockets for worker %d", self.worker_id)
         self.ctx = zmq.Context()
-        self.rep_sock = self.ctx.socket(zmq.REP)
-        self.rep_sock.connect(self.url_server)
-        _LOGGER.debug("worker %d connected to ThreadDevice at %s",
+        self.sock = self.ctx.socket(zmq.DEALER)
+        self.sock.setsockopt(zmq.IDENTITY, broker.worker_identity(self.worker_id))
+        self.sock.setsockopt(zmq.LINGER, 1000)
+        self.sock.connect(self.url_server)
+        self.sock.send_multipart(['', broker.WORKER_READY])
+        # Progress events of jobs, sent by job and executor threads
+        self.events = self.ctx.socket(zmq.PULL)
+        self.events.bind("inproc://events")
+        self.events_push = self.ctx.socket(zmq.PUSH)
+        self.events_push.connect("inproc://events")
+        _LOGGER.debug("worker %d connected to broker at %s",
                       self.worker_id,
                       self.url_server)
 
+    def reply(self, msg):
+        """Send reply to the client of the request being processed"""
+        self.sock.send_multipart(['', self.client, '', msg])
+
+    def notify(self, job_id, event):
+        """Send progress event of a job to the client following it"""
+        client = self.streams.get(job_id)
+        if client is None:
+            return
+        event['job'] = job_id
+        # Socket shared by threads, the lock serializes its use
+        with self.events_lock:
+            self.events_push.send_multipart([client, msgpack.packb(event)])
+
+    def _forward_events(self):
+        """Forward pending progress events to clients"""
+        while self.events.poll(0):
+            client, event = self.events.recv_multipart()
+            self.sock.send_multipart(['', client, '', clt.STREAM_EVENT, event])
+
+    def running_jobs(self):
+        """Return number of jobs running in this worker"""
+        self.job_threads = [thread for thread in self.job_threads if thread.is_alive()]
+        return len(self.job_threads)
+
     def start(self, loglevel, logfile):
         """Start to work !"""
         logging.basicConfig(level=loglevel,
@@ -57,21 +125,36 @@ class ClustdockWorker(object):
         global _LOGGER
         _LOGGER = logging.getLogger(__name__)
         self.init_sockets()
-        _LOGGER.info("Worker %d started", self.worker_id)
+        _LOGGER.info("Worker %d started (%s lane)", self.worker_id, self.lane)
         fd = signalfd.signalfd(-1, [signal.SIGTERM], signalfd.SFD_CLOEXEC)
         signalfd.sigprocmask(signalfd.SIG_BLOCK, [signal.SIGTERM])
         with os.fdopen(fd) as fo:
             poller = zmq.Poller()
-            poller.register(self.rep_sock, zmq.POLLIN)
+            poller.register(self.sock, zmq.POLLIN)
+            poller.register(self.events, zmq.POLLIN)
             poller.register(fo, zmq.POLLIN)
+            retired = False
             while True:
                 try:
                     items = dict(poller.poll(1000))
-                    if self.rep_sock in items:
-                        cmd = self.rep_sock.recv()
-                        _LOGGER.debug("cmd received from client: '%s'", cmd)
-                        self.process_cmd(cmd)
-                        _LOGGER.debug("cmd '%s' processed", cmd)
+                    if self.events in items:
+                        self._forward_events()
+                    if self.sock in items:
+                        frames = self.sock.recv_multipart()
+                        if frames[-1] == broker.WORKER_STOP:
+                            _LOGGER.debug("Worker %d retired by broker", self.worker_id)
+                            retired = True
+                        else:
+                            self.client, request = frames[1], frames[-1]
+                            received = float(frames[-2]) if len(frames) > 4 else None
+                            _LOGGER.debug("request received from client: %r", request)
+                            self.process_request(request, received)
+                            _LOGGER.debug("request %r processed", request)
+                            self.sock.send_multipart(['', broker.WORKER_READY])
+                    if retired and self.running_jobs() == 0:
+                        # Jobs are over, their last events can be sent
+                        self._forward_events()
+                        break
                     if fo.fileno() in items:
                         _LOGGER.debug("Signal received on worker %d", self.worker_id)
                         break
@@ -79,35 +162,81 @@ class ClustdockWorker(object):
                     _LOGGER.debug("Keyboard interrrupt received on worker %d", self.worker_id)
                     break
         _LOGGER.debug("Stopping worker %d", self.worker_id)
-        self.rep_sock.close()
-
-    def process_cmd(self, cmd):
-        '''Process recieved cmd'''
-        if cmd.startswith('list'):
-            (_, allnodes) = cmd.split()
-            hosts = self.list_nodes(allnodes=eval(allnodes), keep_obj=False)
-            self.rep_sock.send(msgpack.packb(hosts))
-        elif cmd.startswith('spawn'):
-            (_, profil, name, nb_nodes, host) = cmd.split()
-            if host == 'None':
-                host = _choose_host(self.hostlist)
-            if host not in self.hostlist:
-                err = "Error: host '%s' is not managed" % host
+        self.sock.close()
+        self.events_push.close()
+        self.events.close()
+        self.ctx.term()
+        lnode.POOL.close()
+        if sshpool.POOL.stats:
+            _LOGGER.info("ssh commands of worker %d: %s", self.worker_id,
+                         sshpool.POOL.report())
+
+    def process_request(self, raw, received=None):
+        '''Process received request and send back the result of its operations
+
+        received is the time the broker received the request.
+        '''
+        try:
+            request = proto.unpack_request(raw, received)
+        except proto.ProtocolError as exc:
+            err = "Error: %s" % exc
+            _LOGGER.error(err)
+            self.reply(proto.pack_error(raw, err))
+            return
+        results = []
+        for op in request['ops']:
+            if proto.expired(request):
+                err = "Error: deadline exceeded, '%s' not run" % op['cmd']
+                _LOGGER.warning(err)
+                results.append(('', [err]))
+                continue
+            results.append(getattr(self, 'cmd_' + op['cmd'])(**op['args']))
+        self.reply(proto.pack_reply(request, results))
+
+    def cmd_list(self, allnodes):
+        """List nodes of managed hosts"""
+        errors = []
+        hosts = self.list_nodes(allnodes=allnodes, keep_obj=False, errors=errors)
+        return (hosts, errors)
+
+    def cmd_spawn(self, profile, name, nb_nodes, host, stream, placement=None):
+        """Start a job spawning nb_nodes nodes of the profile
+
+        host is a host or a nodeset of hosts among which nodes are placed.
+        """
+        hosts = None
+        if host is not None:
+            try:
+                hosts = NodeSet(host)
+            except NodeSetParseError:
+                err = "Error: '%s' is not a valid nodeset of hosts" % host
                 _LOGGER.error(err)
-                self.rep_sock.send(msgpack.packb(("", [err])))
-            else:
-                nodes = self.select_nodes(profil, name, int(nb_nodes), host)
-                if len(nodes) != 0:
-                    self.spawn_nodes(nodes)
-        elif cmd.startswith('stop_nodes'):
-            nodelist = cmd.split()[1]
-            self.stop_nodes(nodelist)
-        elif cmd.startswith('get_ip'):
-            nodelist = cmd.split()[1]
-            self.get_ip(nodelist)
-        else:
-            _LOGGER.debug("Ignoring cmd %s", cmd)
-            self.rep_sock.send(msgpack.packb('FAIL'))
+                return ("", [err])
+            unmanaged = hosts.difference(NodeSet.fromlist(self.hostlist))
+            if len(hosts) == 0 or len(unmanaged) != 0:
+                err = "Error: host '%s' is not managed" % (unmanaged or host)
+                _LOGGER.error(err)
+                return ("", [err])
+        errors = []
+        nodes = self.select_nodes(profile, name, nb_nodes, hosts, errors, placement)
+        if len(nodes) == 0:
+            return ("", errors)
+        job_id = self.jobs.create('spawn', [node.name for node in nodes])
+        self.start_job(self.spawn_nodes, job_id, nodes,
+                       (self.profiles[profile],), stream)
+        return (job_id, errors)
+
+    def cmd_stop_nodes(self, nodeset, stream):
+        """Start a job stopping nodes of the nodeset"""
+        return self.stop_nodes(nodeset, stream)
+
+    def cmd_get_ip(self, nodeset):
+        """Return ip of nodes of the nodeset"""
+        return self.get_ip(nodeset)
+
+    def cmd_status(self, job):
+        """Return the state of a job"""
+        return self.job_status(job)
 
     def _get_cnx(self, node):
         """return libvirt/docker connexion for given node"""
@@ -116,16 +245,14 @@ class ClustdockWorker(object):
         elif isinstance(node, lnode.LibvirtNode):
             return self._get_libvirt_cnx(node.host)
 
+    def _node_kwargs(self, node, **kwargs):
+        """Return keyword arguments for node operations"""
+        kwargs['cnx'] = self._get_cnx(node)
+        return kwargs
+
     def _get_libvirt_cnx(self, host):
         """return libvirt connexion object"""
-        cnx = self.libvirt_cnx.get(host, None)
-        retry = 0
-        while cnx is None and retry < 5:
-            _LOGGER.debug("New libvirt connexion to host '%s'", host)
-            cnx = lnode.LibvirtConnexion(host)
-            self.libvirt_cnx[host] = cnx
-            retry += 1
-        return cnx
+        return lnode.get_connexion(host)
 
     def _get_docker_cnx(self, host):
         """return docker connexion object"""
@@ -136,31 +263,25 @@ class ClustdockWorker(object):
             self.docker_cnx[host] = cnx
         return cnx
 
-    def list_nodes(self, allnodes=True, hostlist=None, byhost=True, keep_obj=True):
-        '''List all nodes on managed hosts or specified hostlist'''
-        hosts = {}
+    def list_nodes(self, allnodes=True, hostlist=None, byhost=True, keep_obj=True,
+                   errors=None):
+        '''List all nodes on managed hosts or specified hostlist
+
+        Nodes are read from the inventory, hosts whose content expired are
+        listed again in parallel. Hosts which fail or do not answer in time
+        are reported in errors (if given) and listed without nodes.
+        '''
         if hostlist is None:
             hostlist = self.hostlist
-        for host in hostlist:
+        hostlist = list(hostlist)
+        failed = self.refresh_inventory(hostlist, errors=errors)
+        hosts = self.inventory.nodes([host for host in hostlist if host not in failed],
+                                     running=not allnodes)
+        for host in failed:
             hosts[host] = []
-            libvirt_cnx = self._get_libvirt_cnx(host)
-            if not libvirt_cnx.is_ok():
-                _LOGGER.warning("No libvirt connexion to host %s. Skipping", host)
-            else:
-                vms = libvirt_cnx.listvms(allnodes=allnodes)
-                if not keep_obj:
-                    hosts[host].extend([vm.__dict__ for vm in vms])
-                else:
-                    hosts[host].extend(vms)
-            docker_cnx = self._get_docker_cnx(host)
-            if not docker_cnx.is_ok():
-                _LOGGER.warning("No docker connexion to host %s. Skipping", host)
-                continue
-            containers = docker_cnx.list_containers(allnodes=allnodes)
-            if not keep_obj:
-                hosts[host].extend([dock.__dict__ for dock in containers])
-            else:
-                hosts[host].extend(containers)
+        if keep_obj:
+            for host in hosts:
+                hosts[host] = [decode_node(node) for node in hosts[host]]
         if not byhost:
             nodes = []
             for hostnodes in hosts.itervalues():
@@ -168,6 +289,49 @@ class ClustdockWorker(object):
             return nodes
         return hosts
 
+    def refresh_inventory(self, hostlist, errors=None, force=False):
+        '''List again the hosts whose inventory expired
+
+        Return the set of hosts that could not be listed.
+        '''
+        stale = hostlist if force else self.inventory.stale_hosts(hostlist)
+        if not stale:
+            return set()
+        results, host_errors = fanout.fan_out(self._list_host_nodes,
+                                              stale,
+                                              timeout=self.host_timeout)
+        for host, nodes in results.iteritems():
+            self.inventory.set_host(host, nodes)
+        for host, err in sorted(host_errors.items()):
+            msg = "Error: cannot list nodes on host '%s': %s" % (host, err)
+            _LOGGER.error(msg)
+            if errors is not None:
+                errors.append(msg)
+        return set(host_errors)
+
+    def _list_host_nodes(self, host):
+        '''List all nodes on the given host'''
+        nodes = []
+        libvirt_cnx = self._get_libvirt_cnx(host)
+        if not libvirt_cnx.is_ok():
+            _LOGGER.warning("No libvirt connexion to host %s. Skipping", host)
+        else:
+            vms = libvirt_cnx.listvms()
+            nodes.extend([encode_node(vm) for vm in vms])
+        docker_cnx = self._get_docker_cnx(host)
+        if not docker_cnx.is_ok():
+            _LOGGER.warning("No docker connexion to host %s. Skipping", host)
+            return nodes
+        containers = docker_cnx.list_containers()
+        nodes.extend([dock.to_dict() for dock in containers])
+        return nodes
+
+    def _resolve_nodes(self, nodeset, running=False, errors=None):
+        '''Return {name: node} for existing nodes of the nodeset'''
+        self.refresh_inventory(list(self.hostlist), errors=errors)
+        found = self.inventory.lookup(list(nodeset), running=running)
+        return dict((name, decode_node(node)) for name, node in found.iteritems())
+
     def get_ip(self, nodes):
         '''Get the ip of nodes if possible'''
         res = []
@@ -180,11 +344,9 @@ class ClustdockWorker(object):
             errors.append(msg)
         else:
             nodes_to_ping = []
-            nodelist = self.list_nodes(allnodes=False, byhost=False)
-            node_dict = {node.name: node for node in nodelist}
-            availnodes = NodeSet.fromlist(node_dict.keys())
+            node_dict = self._resolve_nodes(nodeset, running=True, errors=errors)
             for node in nodeset:
-                if node in availnodes:
+                if node in node_dict:
                     nodes_to_ping.append(node_dict[node])
                 else:
                     msg = "Error: node '%s' does not exist or is "\
@@ -192,102 +354,455 @@ class ClustdockWorker(object):
                     _LOGGER.warning(msg)
                     errors.append(msg)
 
+            libvirt_names = {}
+            docker_names = {}
             for node in nodes_to_ping:
-                tmp = node.get_ip()
-                if tmp != '':
-                    res.append((tmp, node.name))
+                if isinstance(node, dnode.ContainerRecord) and node.ips:
+                    res.append((node.ips[0], node.name))
+                elif isinstance(node, lnode.LibvirtNode):
+                    libvirt_names.setdefault(node.host, []).append(node.name)
+                else:
+                    docker_names.setdefault(node.host, []).append(node.name)
+            res.extend(self._resolve_ips(libvirt_names, docker_names, errors))
+        return (res, errors)
+
+    def _resolve_ips(self, libvirt_names, docker_names, errors):
+        '''Return [(ip, name), ...] of nodes, resolved host by host in parallel
+
+        Each host answers for all its nodes at once: libvirt nodes through
+        its neighbour table, containers through one engine request.
+        '''
+        def resolve(host):
+            ips = {}
+            if host in libvirt_names:
+                ips.update(ipresolver.resolve(self._get_libvirt_cnx(host), host,
+                                              libvirt_names[host], self._read_neighbours))
+            if host in docker_names:
+                found = self._get_docker_cnx(host).get_ips(docker_names[host])
+                ips.update((name, addrs[0] if addrs else '')
+                           for name, addrs in found.items())
+            return ips
+
+        res = []
+        hosts = sorted(set(libvirt_names) | set(docker_names))
+        results, host_errors = fanout.fan_out(resolve, hosts, timeout=self.host_timeout)
+        for host, err in sorted(host_errors.items()):
+            msg = "Error: cannot get ip of nodes on host '%s': %s\n" % (host, err)
+            _LOGGER.error(msg)
+            errors.append(msg)
+        for host in hosts:
+            if host not in results:
+                continue
+            for name in libvirt_names.get(host, []) + docker_names.get(host, []):
+                if results[host].get(name, '') != '':
+                    res.append((results[host][name], name))
                 else:
-                    errors.append("Error: Unable to find IP for node %s\n" % node.name)
-        self.rep_sock.send(msgpack.packb((res, errors)))
+                    errors.append("Error: Unable to find IP for node %s\n" % name)
+        return res
 
-    def select_nodes(self, profil, name, nb_nodes, host):
-        '''Select nodes to spawn'''
+    def select_nodes(self, profil, name, nb_nodes, host, errors=None, placement=None):
+        '''Select nodes to spawn
+
+        host is a host or a nodeset of hosts. Nodes are placed among managed
+        hosts if it is None, among the hosts of the nodeset if it has several
+        hosts or if a placement policy is given.
+        '''
         # 1: recover available nodelist
         # 2: select nb_nodes among availables nodes
         # 3: return the list of nodes
         err = ""
         nodes = []
-        if host is None:
+        if errors is None:
+            errors = []
+        if host is None and len(self.hostlist) == 0:
             err = "Error: No host available\n"
             _LOGGER.error(err)
-            self.rep_sock.send(msgpack.packb(('', [err])))
+            errors.append(err)
             return nodes
         if not vc.VirtualCluster.valid_clustername(name):
             err = "Error: clustername '{}' is not a valid name\n".format(name)
             _LOGGER.error(err)
-            self.rep_sock.send(msgpack.packb(('', [err])))
+            errors.append(err)
             return nodes
         if profil not in self.profiles:
             err = "Error: Profil '{}' not found in configuration file\n".format(profil)
             _LOGGER.error(err)
-            self.rep_sock.send(msgpack.packb(('', [err])))
+            errors.append(err)
             return nodes
 
-        nodelist = self.list_nodes(byhost=False)
-        nodeset = NodeSet.fromlist([node.name for node in nodelist])
-        idx_min = 0
-        idx_max = nb_nodes - 1
-        base_range = RangeSet("%d-%d" % (idx_min, idx_max))
-        base_nodeset = NodeSetBase(name + '%s', base_range)
-        ndset_inter = nodeset.intersection(base_nodeset)
-        while len(ndset_inter) != 0:
-            indexes = [clustdock.VirtualNode.split_name(node)[1] for node in ndset_inter]
-            for idx in indexes:
-                _LOGGER.debug("Removing %d from rangeset %s", idx, base_range)
-                base_range.remove(idx)
-            base_nodeset.difference_update(ndset_inter)
-            _LOGGER.debug("Nodeset becomes '%s' after removing", base_nodeset)
-            idx_min = max(indexes + list(base_range)) + 1
-            idx_max = idx_min + max([len(indexes), nb_nodes - len(base_range)])
-            base_range.add_range(idx_min, idx_max)
-            _LOGGER.debug("New rangeset: %s", base_range)
-            base_nodeset.update(NodeSetBase(name + '%s',
-                                            RangeSet.fromlist([range(idx_min, idx_max)])))
-            _LOGGER.debug("New nodeset: %s", base_nodeset)
-            ndset_inter = nodeset.intersection(base_nodeset)
-
-        final_range = base_range
-        _LOGGER.debug("final rangeset/nodeset: %s / %s", base_range, base_nodeset)
+        # Free indexes are reserved in the inventory shared by all workers,
+        # so that concurrent spawns of a cluster get different names
+        self.refresh_inventory(list(self.hostlist))
+        indexes = self.inventory.reserve(name, nb_nodes)
+        _LOGGER.debug("Indexes reserved for cluster '%s': %s", name, indexes)
 
+        hosts = NodeSet(host) if host is not None else None
         cluster = vc.VirtualCluster(name, profil, self.profiles[profil])
         nodes = []
-        for idx in final_range:
-            node = cluster.add_node(idx, host)
+        for idx in indexes:
+            node = cluster.add_node(idx, str(hosts)
+                                    if hosts is not None and len(hosts) == 1 else None)
             nodes.append(node)
+        if hosts is None or len(hosts) > 1 or placement is not None:
+            if not self.place_nodes(profil, nodes, errors, hosts, placement):
+                self.inventory.release(name, indexes)
+                return []
         return nodes
 
-    def spawn_nodes(self, nodes):
+    def _probe_host(self, vtype, host, cpu_overcommit=scheduler.CPU_OVERCOMMIT):
+        """Return free resources of host for nodes of type vtype"""
+        if vtype == clustdock.LIBVIRT_NODE:
+            return scheduler.probe_libvirt(self._get_libvirt_cnx(host), host,
+                                           cpu_overcommit)
+        return scheduler.probe_docker(self._get_docker_cnx(host), host)
+
+    def place_nodes(self, profil, nodes, errors, hosts=None, policy=None):
+        """Choose the host of each node from free resources of hosts
+
+        Nodes are placed among managed hosts if hosts is None. The placement
+        policy defaults to the 'placement' key of the profile.
+        Return False if nodes cannot be placed.
+        """
+        if hosts is None:
+            hosts = self.hostlist
+        if policy is None:
+            policy = self.profiles[profil].get('placement', scheduler.DEFAULT_POLICY)
+        if policy not in scheduler.POLICIES:
+            err = "Error: unknown placement policy '%s' in profil '%s'\n" % (policy,
+                                                                              profil)
+            _LOGGER.error(err)
+            errors.append(err)
+            return False
+        vtype = self.profiles[profil].get('vtype')
+        overcommit = self.profiles[profil].get('cpu_overcommit', scheduler.CPU_OVERCOMMIT)
+        resources, host_errors = fanout.fan_out(lambda host: self._probe_host(vtype, host,
+                                                                              overcommit),
+                                                list(hosts),
+                                                timeout=self.host_timeout)
+        for host, err in sorted(host_errors.iteritems()):
+            _LOGGER.warning("Host '%s' not used for placement: %s", host, err)
+        base_trees = {}
+        requests = []
+        for node in nodes:
+            base_tree = None
+            if isinstance(node, lnode.LibvirtNode) and \
+                    (node.cpu is None or node.mem is None):
+                if node.base_domain not in base_trees:
+                    try:
+                        base_trees[node.base_domain] = etree.fromstring(
+                            node.base_description())
+                    except Exception as exc:
+                        _LOGGER.warning("Cannot read base domain '%s': %s",
+                                        node.base_domain, exc)
+                        base_trees[node.base_domain] = None
+                base_tree = base_trees[node.base_domain]
+            requests.append(scheduler.node_request(node, base_tree))
+        try:
+            hosts = scheduler.place(requests, resources.values(), policy)
+        except scheduler.NoCapacity as exc:
+            err = "Error: cannot place %d nodes: %s\n" % (len(nodes), exc)
+            _LOGGER.error(err)
+            errors.append(err)
+            return False
+        for node, host in zip(nodes, hosts):
+            node.host = host
+        _LOGGER.info("Nodes placed (%s): %s", policy, vc.byhosts(nodes))
+        return True
+
+    def _update_inventory(self, nodes, spawned=(), stopped=()):
+        """Record result of spawn/stop operations in the inventory"""
+        spawned = set(spawned)
+        stopped = set(stopped)
+        new_nodes = []
+        failed_hosts = set()
+        for node in nodes:
+            if node.name in spawned:
+                new_nodes.append(dict(encode_node(node), status=inv.STATUS_RUNNING))
+            elif node.name not in stopped:
+                failed_hosts.add(node.host)
+        # State of hosts where an operation failed is unknown
+        for host in failed_hosts:
+            self.inventory.invalidate(host)
+        if new_nodes:
+            self.inventory.add_nodes(new_nodes)
+        if stopped:
+            self.inventory.remove_nodes(list(stopped))
+
+    def job_status(self, job_id):
+        """Return (job, errors) for the given job id"""
+        job = self.jobs.get(job_id)
+        if job is None:
+            err = "Error: job '%s' not found" % job_id
+            _LOGGER.error(err)
+            return ('', [err])
+        return (job, [])
+
+    def start_job(self, func, job_id, nodes, args=(), stream=False):
+        """Run func(job_id, nodes, *args) in background
+
+        If stream is True, progress events are sent to the current client.
+        """
+        if stream:
+            self.streams[job_id] = self.client
+        thread = threading.Thread(target=self._run_job, args=(func, job_id, nodes) + args)
+        thread.start()
+        self.job_threads.append(thread)
+        return thread
+
+    def _run_job(self, func, job_id, nodes, *args):
+        try:
+            func(job_id, nodes, *args)
+        except Exception as exc:
+            err = "Error: job %s failed: %s" % (job_id, exc)
+            _LOGGER.exception(err)
+            self.jobs.add_error(job_id, err)
+            self.jobs.finish(job_id, '')
+        job = self.jobs.get(job_id)
+        self.notify(job_id, {'end': True,
+                             'result': job['result'],
+                             'hosts': job['hosts'],
+                             'errors': job['errors']})
+        self.streams.pop(job_id, None)
+
+    def _node_operation(self, job_id, node, operation, outcomes=None):
+        """Run start/stop operation on a node and record its result
+
+        If outcomes is given, (rc, msg, elapsed) is stored in it by node
+        name instead, for the caller to record it.
+        """
+        start = time.time()
+        try:
+            rc, msg = getattr(node, operation)(**self._node_kwargs(node, fork=False))
+        except Exception as exc:
+            rc, msg = 1, "Error when running %s on '%s': %s" % (operation, node.name, exc)
+            _LOGGER.exception(msg)
+        if outcomes is not None:
+            outcomes[node.name] = (rc, msg, time.time() - start)
+        else:
+            self._node_result(job_id, node, rc, msg, time.time() - start)
+        return rc
+
+    def _node_result(self, job_id, node, rc, msg, elapsed):
+        """Record result of the operation on a node and notify the client"""
+        error = msg if rc != 0 else None
+        timings = getattr(node, 'timings', None) or {}
+        self.jobs.node_done(job_id, node.name, rc == 0, error, elapsed, timings)
+        self.notify(job_id, {'node': node.name,
+                             'status': jobs.NODE_DONE if rc == 0 else jobs.NODE_FAILED,
+                             'elapsed': elapsed,
+                             'error': error,
+                             'stages': timings})
+
+    def _run_operation(self, job_id, nodes, operation, profile=None, outcomes=None):
+        """Run operation on nodes through the executor
+
+        Return names of nodes on which the operation succeeded.
+        """
+        if profile is None:
+            profile = {}
+        tasks = [(node.host, self._node_operation, (job_id, node, operation, outcomes))
+                 for node in nodes]
+        results = self.executor.run(tasks,
+                                    profile.get('max_parallel'),
+                                    profile.get('max_parallel_per_host'))
+        return [node.name for node, (rc, _) in zip(nodes, results) if rc == 0]
+
+    def _provision_disks(self, job_id, nodes):
+        '''Create disks of all libvirt nodes at once before starting them
+
+        Return nodes which can be started.
+        '''
+        vms = [node for node in nodes if isinstance(node, lnode.LibvirtNode)]
+        if not vms:
+            return nodes
+        start = time.time()
+        failed = {}
+        descs = {}
+        # Disks are only provisioned for domains which do not exist yet, running or
+        # not. A disk left by an earlier spawn which failed is overwritten.
+        defined = {}
+        for host in set(node.host for node in vms):
+            try:
+                cnx = lnode.get_connexion(host)
+                defined[host] = set(dom.name() for dom in cnx.instance.listAllDomains())
+            except Exception as exc:
+                # start() reports the unreachable host
+                defined[host] = set()
+                _LOGGER.error("Cannot list domains of host '%s': %s", host, exc)
+        for node in vms:
+            if node.name in defined[node.host]:
+                failed[node.name] = "Image '%s' already exists. Skipping\n" % node.name
+                continue
+            if node.base_domain not in descs:
+                try:
+                    descs[node.base_domain] = node.base_description()
+                except Exception as exc:
+                    descs[node.base_domain] = None
+                    _LOGGER.error("Base image '%s' doesn't exist: %s",
+                                  node.base_domain, exc)
+            if descs[node.base_domain] is None:
+                # start() reports the missing base domain
+                continue
+            node.baseimg_path = lnode.get_template(node.base_domain,
+                                                   descs[node.base_domain]).baseimg_path
+        wanted = {}
+        for node in vms:
+            if descs[node.base_domain] is not None and node.name not in failed:
+                key = (node.baseimg_path, os.path.dirname(node.img_path))
+                wanted.setdefault(key, []).append(node.img_path)
+        # Overlays of the warm pool first, then the missing ones
+        results = {}
+        for (baseimg_path, storage_dir), paths in wanted.iteritems():
+            for path in warmpool.claim(baseimg_path, storage_dir, paths):
+                results[path] = None
+        disks = [(baseimg_path, path) for (baseimg_path, _), paths in wanted.iteritems()
+                 for path in paths if path not in results]
+        results.update(self._create_overlays(disks, dict((node.img_path, node.host)
+                                                         for node in vms)))
+        elapsed = time.time() - start
+        _LOGGER.info("%d disks created, %d taken from warm pool in %.1fs", len(disks),
+                     len(results) - len(disks), elapsed)
+        for node in vms:
+            if node.img_path not in results or node.name in failed:
+                continue
+            node.timings = {'disk': elapsed}
+            if results[node.img_path] is None:
+                node.disk_ready = True
+            else:
+                failed[node.name] = "Error when spawning '%s'\n%s" % (
+                    node.name, results[node.img_path])
+        for node in vms:
+            if node.name in failed:
+                _LOGGER.error(failed[node.name])
+                self._node_result(job_id, node, 1, failed[node.name], elapsed)
+        return [node for node in nodes if node.name not in failed]
+
+    def _create_overlays(self, disks, hosts):
+        '''Create overlays [(base image, path), ...] of nodes
+
+        hosts gives the host of the node of each path. With agents, each
+        host creates its overlays in one batch, otherwise they are created
+        here. Return {path: error message or None}.
+        '''
+        if self.agent_port is None:
+            return provision.create_overlays(disks)
+        byhost = {}
+        for base, path in disks:
+            byhost.setdefault(hosts[path], []).append((base, path))
+
+        def create(host):
+            client = agent.AgentClient(host, self.agent_port,
+                                       curve_dir=self.agent_curve_dir)
+            try:
+                answers = client.batch([agent.operation('overlay', base=base, path=path)
+                                        for base, path in byhost[host]])
+            finally:
+                client.close()
+            return dict((path, err) for (_, path), (_, err) in zip(byhost[host], answers))
+
+        results, host_errors = fanout.fan_out(create, list(byhost))
+        created = {}
+        for host, host_disks in byhost.iteritems():
+            if host in results:
+                created.update(results[host])
+            else:
+                err = "agent of host '%s': %s" % (host, host_errors[host])
+                created.update((path, err) for _, path in host_disks)
+        return created
+
+    def _read_neighbours(self, host):
+        '''Return neighbour table of host, read by its agent if any'''
+        if self.agent_port is not None:
+            client = agent.AgentClient(host, self.agent_port,
+                                       self.host_timeout or agent.AGENT_TIMEOUT,
+                                       curve_dir=self.agent_curve_dir)
+            try:
+                ((table, err),) = client.batch([agent.operation('neighbours')])
+                if err is None:
+                    return table
+                _LOGGER.warning("Agent of host '%s' cannot read neighbours: %s",
+                                host, err)
+            except agent.AgentError as exc:
+                _LOGGER.warning("%s, reading neighbours through ssh", exc)
+            finally:
+                client.close()
+        return ipresolver.read_neighbours(host)
+
+    def spawn_nodes(self, job_id, nodes, profile=None):
         '''Spawn some nodes'''
-        errors = []
-        processes = []
+        # Bridges of the hosts are probed once for the whole spawn
+        for host in set(node.host for node in nodes
+                        if isinstance(node, dnode.DockerNode) and node.add_iface):
+            bridges.TOPOLOGY.invalidate(host)
+        engine = hooks.HookEngine.from_profile(profile or {})
+        try:
+            ready = self._provision_disks(job_id, nodes)
+            if engine is None:
+                spawned_nodes = self._run_operation(job_id, ready, 'start', profile)
+            else:
+                spawned_nodes = self._start_with_hooks(job_id, ready, engine, profile)
+            _LOGGER.debug(spawned_nodes)
+            self._update_inventory(nodes, spawned=spawned_nodes)
+        finally:
+            # Indexes of spawned nodes stay taken by the nodes themselves
+            self.inventory.release(nodes[0].clustername, [node.idx for node in nodes])
+        self.jobs.finish(job_id, str(NodeSet.fromlist(spawned_nodes)),
+                         vc.byhosts([node for node in nodes
+                                     if node.name in spawned_nodes]))
+
+    def _start_with_hooks(self, job_id, nodes, engine, profile):
+        """Start nodes, their before_start and after_start hooks run by engine
+
+        Results are recorded once the after_start hooks are done, with the
+        time spent in hooks as 'hooks' stage. Return names of nodes started
+        with their hooks.
+        """
+        vtypes = dict((node.name, clustdock.DOCKER_NODE
+                       if isinstance(node, dnode.DockerNode) else clustdock.LIBVIRT_NODE)
+                      for node in nodes)
+        after_start = dict((node.name, node.after_start) for node in nodes
+                           if node.after_start)
+        before = engine.run([(node.before_start, vtypes[node.name], node)
+                             for node in nodes if node.before_start])
+        for node in nodes:
+            node.before_start = node.after_start = None
+        ready = []
         for node in nodes:
-            to_child, to_self = mp.Pipe()
-            p = mp.Process(target=node.__class__.start,
-                           args=(node,),
-                           kwargs={'pipe': to_self})
-            p.start()
-            processes.append((node, p, (to_child, to_self)))
-        spawned_nodes = []
-        nodes_to_del = []
-        for node, p, pipes in processes:
-            p.join()
-            if p.exitcode == 0:
-                spawned_nodes.append(node.name)
+            rc, stderr, elapsed = before.get(node.name, (0, '', 0))
+            if rc != 0:
+                msg = "Error when spawning '%s'\n%s" % (node.name, stderr)
+                _LOGGER.error(msg)
+                node.timings = {'hooks': elapsed}
+                self._node_result(job_id, node, 1, msg, elapsed)
             else:
-                nodes_to_del.append(node.name)
-                err = pipes[0].recv()
-                errors.append(err)
-            pipes[0].close()
-            pipes[1].close()
-
-        _LOGGER.debug(spawned_nodes)
-        nodelist = str(NodeSet.fromlist(spawned_nodes))
-        self.rep_sock.send(msgpack.packb((nodelist, errors)))
-
-    def stop_nodes(self, nodes):
+                ready.append(node)
+        outcomes = {}
+        started = set(self._run_operation(job_id, ready, 'start', profile, outcomes))
+        after = engine.run([(after_start[node.name], vtypes[node.name], node)
+                            for node in ready
+                            if node.name in started and node.name in after_start])
+        spawned = []
+        for node in ready:
+            rc, msg, elapsed = outcomes[node.name]
+            hooks_elapsed = before.get(node.name, (0, '', 0))[2]
+            if node.name in after:
+                hook_rc, stderr, hook_elapsed = after[node.name]
+                hooks_elapsed += hook_elapsed
+                if hook_rc != 0:
+                    rc, msg = 1, "Error when spawning '%s'\n%s" % (node.name, stderr)
+                    _LOGGER.error(msg)
+            node.timings = dict(getattr(node, 'timings', None) or {})
+            if hooks_elapsed:
+                node.timings['hooks'] = node.timings.get('hooks', 0) + hooks_elapsed
+            self._node_result(job_id, node, rc, msg, elapsed + hooks_elapsed)
+            if rc == 0:
+                spawned.append(node.name)
+        return spawned
+
+    def stop_nodes(self, nodes, stream=False):
         '''Stopping nodes'''
         errors = []
-        stopped_nodes = []
+        nodes_to_stop = []
 
         try:
             nodeset = NodeSet(nodes)
@@ -296,38 +811,26 @@ class ClustdockWorker(object):
             _LOGGER.error(msg)
             errors.append(msg)
         else:
-            nodes_to_stop = []
-            nodelist = self.list_nodes(byhost=False)
-            node_dict = {node.name: node for node in nodelist}
-            availnodes = NodeSet.fromlist(node_dict.keys())
+            node_dict = self._resolve_nodes(nodeset, errors=errors)
             for node in nodeset:
-                if node in availnodes:
-                    nodes_to_stop.append(node_dict[node])
+                if node in node_dict:
+                    nodes_to_stop.append(_as_node(node_dict[node]))
                 else:
                     msg = "Error: node '%s' does not exist. Skipping" % node
                     _LOGGER.warning(msg)
                     errors.append(msg)
 
-            processes = []
-            for node in nodes_to_stop:
-                to_child, to_self = mp.Pipe()
-                p = mp.Process(target=node.__class__.stop,
-                               args=(node,),
-                               kwargs={'pipe': to_self})
-                p.start()
-                processes.append((node, p, (to_child, to_self)))
-
-            for node, p, pipes in processes:
-                p.join()
-                if p.exitcode == 0:
-                    stopped_nodes.append(node.name)
-                else:
-                    errors.append(pipes[0].recv())
-                pipes[0].close()
-                pipes[1].close()
+        if not nodes_to_stop:
+            return ('', errors)
+        job_id = self.jobs.create('stop', [node.name for node in nodes_to_stop], errors)
+        self.start_job(self._stop_nodes, job_id, nodes_to_stop, stream=stream)
+        return (job_id, errors)
 
-        nodelist = str(NodeSet.fromlist(stopped_nodes))
-        self.rep_sock.send(msgpack.packb((nodelist, errors)))
+    def _stop_nodes(self, job_id, nodes):
+        """Stop resolved nodes"""
+        stopped_nodes = self._run_operation(job_id, nodes, 'stop')
+        self._update_inventory(nodes, stopped=stopped_nodes)
+        self.jobs.finish(job_id, str(NodeSet.fromlist(stopped_nodes)))
 
 
 def extract_hosts(hosts):
@@ -340,14 +843,11 @@ def extract_hosts(hosts):
     return nodeset
 
 
-def _choose_host(hosts):
-    """Choose random host in hostlist"""
-    host = None
-    try:
-        host = random.choice(hosts)
-    except (TypeError, IndexError):
-        _LOGGER.error("Empty hostlist given: %s", hosts)
-    return host
+def _as_node(node):
+    """Return the VirtualNode corresponding to a listed node"""
+    if isinstance(node, dnode.ContainerRecord):
+        return node.to_node()
+    return node
 
 
 def encode_node(obj):
@@ -364,5 +864,7 @@ def decode_node(dico):
         return clustdock.docker_node.DockerNode(**dico)
     elif 'base_domain' in dico:
         return clustdock.libvirt_node.LibvirtNode(**dico)
+    elif 'labels' in dico:
+        return clustdock.docker_node.ContainerRecord(**dico)
     else:
         return dico
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/sshpool.py
+@namespace clustdock.sshpool Persistent ssh sessions to managed hosts
+'''
+import logging
+import os
+import subprocess as sp
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Directory of the control sockets of the master sessions, shared by all
+# processes of the daemon
+CONTROL_DIR = "/var/run/clustdock-ssh"
+# Time (in seconds) during which an unused master session is kept open
+CONTROL_PERSIST = 600
+# Environment variable giving hooks the ssh command reusing the sessions
+HOOK_ENV = 'CLUSTDOCK_SSH'
+
+
+class SSHPool(object):
+    '''Multiplexed ssh sessions, one master session per host
+
+    Commands are run through OpenSSH connection sharing: the first command
+    run on a host opens a master session which stays open CONTROL_PERSIST
+    seconds after its last use. Next commands, from any process of the
+    daemon, open a channel in this session without new TCP connexion nor
+    key exchange.
+    '''
+
+    def __init__(self, control_dir=CONTROL_DIR, persist=CONTROL_PERSIST):
+        self.control_dir = control_dir
+        self.persist = persist
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def control_path(self, host):
+        """Return path of the control socket of the master session of host"""
+        return os.path.join(self.control_dir, "%s.sock" % host)
+
+    def options(self):
+        """Return ssh options sharing the master sessions"""
+        return ['-o', 'ControlMaster=auto',
+                '-o', 'ControlPath=%s' % os.path.join(self.control_dir, '%h.sock'),
+                '-o', 'ControlPersist=%d' % self.persist]
+
+    def command(self, host, cmd):
+        """Return ssh command running shell command cmd on host"""
+        return ['ssh'] + self.options() + ['-T', host, cmd]
+
+    def run(self, host, cmd, stdin=None):
+        """Run shell command cmd on host. Return (rc, stdout, stderr)
+
+        Commands for 'localhost' are run without ssh.
+        """
+        if host == 'localhost':
+            args = {'shell': True}
+        else:
+            if not os.path.isdir(self.control_dir):
+                try:
+                    os.makedirs(self.control_dir, 0o700)
+                except OSError:
+                    pass
+            reused = os.path.exists(self.control_path(host))
+            cmd = self.command(host, cmd)
+            args = {}
+        _LOGGER.debug("Launching %s", cmd)
+        start = time.time()
+        p = sp.Popen(cmd, stdin=sp.PIPE if stdin is not None else None,
+                     stdout=sp.PIPE, stderr=sp.PIPE, **args)
+        (stdout, stderr) = p.communicate(stdin)
+        if host != 'localhost':
+            self._record(host, reused, time.time() - start)
+        return (p.returncode, stdout, stderr)
+
+    def _record(self, host, reused, elapsed):
+        with self._lock:
+            stats = self.stats.setdefault(host, {'commands': 0, 'reused': 0, 'time': 0.0,
+                                                 'max_time': 0.0})
+            stats['commands'] += 1
+            stats['reused'] += 1 if reused else 0
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+
+    def report(self):
+        """Return printable statistics of the commands run on each host"""
+        with self._lock:
+            return ", ".join(
+                "%s: %d commands, %d reused sessions, %.3fs avg, %.3fs max" % (
+                    host, stats['commands'], stats['reused'],
+                    stats['time'] / stats['commands'], stats['max_time'])
+                for host, stats in sorted(self.stats.iteritems()))
+
+    def close(self):
+        """Close the master sessions of all hosts"""
+        if not os.path.isdir(self.control_dir):
+            return
+        for sock in os.listdir(self.control_dir):
+            if not sock.endswith('.sock'):
+                continue
+            host = sock[:-len('.sock')]
+            cmd = ['ssh'] + self.options() + ['-O', 'exit', host]
+            _LOGGER.debug("Closing ssh session to host '%s'", host)
+            p = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+            p.communicate()
+
+
+POOL = SSHPool()
+
+
+def configure(control_dir=CONTROL_DIR, persist=CONTROL_PERSIST):
+    """Set up the pool used by this process and the processes it starts
+
+    Hooks get the ssh command reusing the sessions in HOOK_ENV.
+    """
+    global POOL
+    POOL = SSHPool(control_dir, persist)
+    os.environ[HOOK_ENV] = " ".join(['ssh'] + POOL.options())
+    return POOL
+
+
+def run(host, cmd, stdin=None):
+    """Run shell command cmd on host through the pool"""
+    return POOL.run(host, cmd, stdin)
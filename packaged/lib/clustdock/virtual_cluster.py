@@ -77,9 +77,9 @@ class VirtualCluster(object):
 
     def add_node(self, idx, host):
         """Create new node on host and add it to the cluster"""
-        self.cfg['default']['host'] = host
         conf = self.cfg['default'].copy()
         conf.update(self.cfg.get(idx, {}))
+        conf['host'] = host
         _LOGGER.debug(conf)
         if conf['vtype'] == clustdock.DOCKER_NODE:
             node = dock.DockerNode("%s%d" % (self.name, idx), **conf)
@@ -90,10 +90,15 @@ class VirtualCluster(object):
 
     def byhosts(self):
         """Return string describing on which hosts are virtual nodes"""
-        byhost = {}
-        for node in self.nodes.values():
-            if node.host not in byhost:
-                byhost[node.host] = NodeSet(node.name)
-            else:
-                byhost[node.host].add(node.name)
-        return " - ".join([k + ':' + str(byhost[k]) for k in byhost])
+        return byhosts(self.nodes.values())
+
+
+def byhosts(nodes):
+    """Return string describing on which hosts are the given nodes"""
+    byhost = {}
+    for node in nodes:
+        if node.host not in byhost:
+            byhost[node.host] = NodeSet(node.name)
+        else:
+            byhost[node.host].add(node.name)
+    return " - ".join([k + ':' + str(byhost[k]) for k in byhost])
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/warmpool.py
+@namespace clustdock.warmpool Disks and images prepared before spawn requests
+'''
+import glob
+import hashlib
+import logging
+import os
+import select
+import signal
+import uuid
+import signalfd
+import clustdock.docker_api as docker_api
+import clustdock.docker_node as dnode
+import clustdock.libvirt_node as lnode
+import clustdock.provision as provision
+
+_LOGGER = logging.getLogger(__name__)
+
+# Warm overlays are stored next to node disks, named
+# <WARM_PREFIX><key of the base image>-<uuid>.qcow2
+WARM_PREFIX = '.clustdock-warm-'
+TMP_PREFIX = '.clustdock-tmp-'
+# Delay (in seconds) between two refills of the pools
+REFILL_INTERVAL = 10
+
+
+def pool_key(baseimg_path):
+    """Return key of the overlays of baseimg_path, None if it does not exist
+
+    The key changes when the base image is replaced or modified, so that
+    overlays of an older base image are never used.
+    """
+    try:
+        st = os.stat(baseimg_path)
+    except OSError:
+        return None
+    ident = "%s:%d:%d" % (baseimg_path, st.st_ino, int(st.st_mtime))
+    return hashlib.sha1(ident).hexdigest()[:12]
+
+
+def warm_files(storage_dir, key=None):
+    """Return warm overlays of storage_dir, only those of key if given"""
+    pattern = "%s%s-*.qcow2" % (WARM_PREFIX, key or '*')
+    return sorted(glob.glob(os.path.join(storage_dir, pattern)))
+
+
+def claim(baseimg_path, storage_dir, img_paths):
+    """Move warm overlays of baseimg_path to the given disk paths
+
+    Return the set of paths which got an overlay. Renaming is atomic: an
+    overlay goes to one node only, even if several workers claim at once.
+    """
+    claimed = set()
+    key = pool_key(baseimg_path)
+    if key is None:
+        return claimed
+    available = warm_files(storage_dir, key)
+    for img_path in img_paths:
+        while available:
+            try:
+                os.rename(available.pop(), img_path)
+            except OSError:
+                # Claimed by another worker (or another filesystem)
+                continue
+            claimed.add(img_path)
+            break
+    return claimed
+
+
+class WarmPool(object):
+    '''Keep resources ready for the profiles with a 'warm_pool' size
+
+    For libvirt profiles, 'warm_pool' qcow2 overlays of the base image are
+    kept in the storage directory, and spawns take them instead of creating
+    disks. For docker profiles, the image is kept present on managed hosts.
+    '''
+
+    def __init__(self, profiles, hostlist, docker_port=None, interval=REFILL_INTERVAL):
+        self.profiles = profiles
+        self.hostlist = list(hostlist)
+        self.docker_port = docker_port
+        self.interval = interval
+
+    @staticmethod
+    def enabled(profiles):
+        """Check if a profile needs a warm pool"""
+        return any(int(profile.get('warm_pool', 0)) > 0 for profile in profiles.values())
+
+    def start(self, loglevel, logfile):
+        """Refill the pools until SIGTERM is received"""
+        logging.basicConfig(level=loglevel,
+                            stream=logfile,
+                            format="%(levelname)s|%(asctime)s|%(process)d|%(filename)s|"
+                                   "%(funcName)s|%(lineno)d| %(message)s")
+        global _LOGGER
+        _LOGGER = logging.getLogger(__name__)
+        _LOGGER.info("Warm pool started")
+        fd = signalfd.signalfd(-1, [signal.SIGTERM], signalfd.SFD_CLOEXEC)
+        signalfd.sigprocmask(signalfd.SIG_BLOCK, [signal.SIGTERM])
+        with os.fdopen(fd) as fo:
+            while True:
+                try:
+                    self.refill()
+                    ready, _, _ = select.select([fo], [], [], self.interval)
+                    if ready:
+                        _LOGGER.debug("Signal received on warm pool")
+                        break
+                except KeyboardInterrupt:
+                    break
+        lnode.POOL.close()
+        _LOGGER.debug("Stopping warm pool")
+
+    def refill(self):
+        """Bring every pool back to its size"""
+        live_keys = self.live_keys()
+        for name, profile in sorted(self.profiles.items()):
+            size = int(profile.get('warm_pool', 0))
+            if size <= 0:
+                continue
+            try:
+                if profile.get('vtype') == 'libvirt':
+                    self.refill_libvirt(name, profile['base_domain'],
+                                        profile['storage_dir'], size, live_keys)
+                elif profile.get('vtype') == 'docker':
+                    self.refill_docker(name, profile['img'])
+            except Exception:
+                _LOGGER.exception("Cannot refill warm pool of profile '%s'", name)
+
+    @staticmethod
+    def base_image(base_domain):
+        """Return path of the disk of base_domain"""
+        cnx = lnode.get_connexion('localhost')
+        desc = cnx.instance.lookupByName(base_domain).XMLDesc()
+        return lnode.get_template(base_domain, desc).baseimg_path
+
+    def live_keys(self):
+        """Return keys of the base images of all libvirt warm pools
+
+        Return None if one of them cannot be read: overlays of other base
+        images may then still be in use and are kept.
+        """
+        keys = set()
+        for name, profile in self.profiles.items():
+            if profile.get('vtype') != 'libvirt' or int(profile.get('warm_pool', 0)) <= 0:
+                continue
+            try:
+                keys.add(pool_key(self.base_image(profile['base_domain'])))
+            except Exception as exc:
+                _LOGGER.error("Cannot read base image of profile '%s': %s", name, exc)
+                return None
+        return keys
+
+    def refill_libvirt(self, name, base_domain, storage_dir, size, live_keys=None):
+        """Create missing overlays of a libvirt profile, return their number
+
+        Warm overlays of storage_dir whose key is not in live_keys belong to
+        base images which no profile uses anymore and are removed. Profiles
+        sharing storage_dir keep their pools.
+        """
+        if '{' in storage_dir:
+            _LOGGER.warning("Storage directory of profile '%s' depends on the cluster, "
+                            "no warm pool", name)
+            return 0
+        baseimg_path = self.base_image(base_domain)
+        key = pool_key(baseimg_path)
+        if key is None:
+            _LOGGER.error("Base image '%s' of profile '%s' not found", baseimg_path, name)
+            return 0
+        # Leftovers of an interrupted refill, and overlays of older base images
+        stale = glob.glob(os.path.join(storage_dir, TMP_PREFIX + '*'))
+        if live_keys is not None:
+            live = set(live_keys) | set([key])
+            stale.extend(path for path in warm_files(storage_dir)
+                         if os.path.basename(path)[len(WARM_PREFIX):].split('-')[0]
+                         not in live)
+        for path in stale:
+            _LOGGER.debug("Removing stale overlay %s", path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        missing = size - len(warm_files(storage_dir, key))
+        if missing <= 0:
+            return 0
+        # Overlays get their final name once complete
+        names = [uuid.uuid4().hex for _ in range(missing)]
+        disks = [(baseimg_path,
+                  os.path.join(storage_dir, "%s%s.qcow2" % (TMP_PREFIX, ident)))
+                 for ident in names]
+        results = provision.create_overlays(disks)
+        created = 0
+        for ident, (_, tmp_path) in zip(names, disks):
+            if results[tmp_path] is not None:
+                _LOGGER.error("Cannot create warm overlay for profile '%s': %s",
+                              name, results[tmp_path])
+                continue
+            os.rename(tmp_path, os.path.join(storage_dir, "%s%s-%s.qcow2" % (WARM_PREFIX,
+                                                                            key, ident)))
+            created += 1
+        _LOGGER.info("%d overlays added to warm pool of profile '%s'", created, name)
+        return created
+
+    def refill_docker(self, name, image):
+        """Pull the image of a docker profile on hosts where it is missing"""
+        for host in self.hostlist:
+            cnx = dnode.DockerConnexion(host, self.docker_port)
+            try:
+                if not cnx.client.has_image(image):
+                    _LOGGER.info("Pulling image '%s' of profile '%s' on host '%s'",
+                                 image, name, host)
+                    cnx.client.pull(image)
+            except docker_api.DockerAPIError as exc:
+                _LOGGER.error("Cannot pull image '%s' on host '%s': %s", image, host, exc)
+            finally:
+                cnx.client.close()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+'''
+@author Antoine Sax <<antoine.sax@atos.net>>
+@copyright 2018 Bull S.A.S.  -  All rights reserved.\n
+           This is not Free or Open Source software.\n
+           Please contact Bull SAS for details about its license.\n
+           Bull - Rue Jean Jaures - B.P. 68 - 78340 Les Clayes-sous-Bois
+@file clustdock/watcher.py
+@namespace clustdock.watcher Event driven tracking of nodes state
+'''
+import logging
+import os
+import select
+import signal
+import threading
+import signalfd
+import libvirt
+import clustdock
+import clustdock.docker_api as docker_api
+import clustdock.docker_node as dnode
+import clustdock.inventory as inv
+import clustdock.libvirt_node as lnode
+
+_LOGGER = logging.getLogger(__name__)
+
+RETRY_DELAY = 30
+# Docker actions changing the state of a container
+DOCKER_ACTIONS = set(['create', 'start', 'restart', 'die', 'kill', 'stop',
+                      'pause', 'unpause', 'oom', 'rename'])
+
+
+class StateWatcher(object):
+    '''Keep the inventory up to date from libvirt and docker events
+
+    For each managed host, the watcher lists the nodes once, then applies
+    libvirt domain lifecycle events and docker container events to the
+    inventory. While both streams of a host are up, the host is marked as
+    watched and workers read its nodes without querying the host. The mark
+    is renewed every lease / 3 seconds, so that it expires if the watcher
+    dies. Hosts whose backend cannot be reached are left to the listing of
+    the workers.
+    '''
+
+    def __init__(self, hostlist, inventory, docker_port=None, retry_delay=RETRY_DELAY,
+                 lease=inv.WATCH_LEASE):
+        self.hostlist = list(hostlist)
+        self.inventory = inventory
+        self.docker_port = docker_port
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.libvirt_cnx = {}
+        self._docker_watched = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def start(self, loglevel, logfile):
+        """Watch managed hosts until SIGTERM is received"""
+        logging.basicConfig(level=loglevel,
+                            stream=logfile,
+                            format="%(levelname)s|%(asctime)s|%(process)d|%(filename)s|"
+                                   "%(funcName)s|%(lineno)d| %(message)s")
+        global _LOGGER
+        _LOGGER = logging.getLogger(__name__)
+        _LOGGER.info("State watcher started on %s", ",".join(self.hostlist))
+        fd = signalfd.signalfd(-1, [signal.SIGTERM], signalfd.SFD_CLOEXEC)
+        signalfd.sigprocmask(signalfd.SIG_BLOCK, [signal.SIGTERM])
+        libvirt.virEventRegisterDefaultImpl()
+        self._start_thread(self._run_libvirt_loop)
+        for host in self.hostlist:
+            self._start_thread(self._watch_docker, host)
+        with os.fdopen(fd) as fo:
+            while True:
+                try:
+                    self.check_libvirt()
+                    self.renew_leases()
+                    ready, _, _ = select.select([fo], [], [],
+                                                min(self.retry_delay, self.lease / 3.0))
+                    if ready:
+                        _LOGGER.debug("Signal received on state watcher")
+                        break
+                except KeyboardInterrupt:
+                    break
+        self._stop.set()
+        for host in self.libvirt_cnx.keys():
+            self._close_libvirt(host)
+        _LOGGER.debug("Stopping state watcher")
+
+    @staticmethod
+    def _start_thread(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run_libvirt_loop(self):
+        """Dispatch libvirt events"""
+        while not self._stop.is_set():
+            libvirt.virEventRunDefaultImpl()
+
+    def renew_leases(self):
+        """Renew the watch marks of the streams which are up"""
+        with self._lock:
+            for host in self.libvirt_cnx.keys():
+                self.inventory.watch(host, clustdock.LIBVIRT_NODE, lease=self.lease)
+            for host in self._docker_watched:
+                self.inventory.watch(host, clustdock.DOCKER_NODE, lease=self.lease)
+
+    def check_libvirt(self):
+        """Subscribe to domain events of hosts not watched yet"""
+        for host in self.hostlist:
+            if host in self.libvirt_cnx:
+                continue
+            cnx = lnode.LibvirtConnexion(host)
+            if cnx.cnx is None:
+                # Listed by the workers until libvirt can be reached
+                continue
+            try:
+                cnx.cnx.setKeepAlive(lnode.KEEPALIVE_INTERVAL, lnode.KEEPALIVE_COUNT)
+                cnx.cnx.registerCloseCallback(self._on_libvirt_close, host)
+                cnx.cnx.domainEventRegisterAny(None,
+                                               libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                               self._on_domain_event,
+                                               host)
+                vms = cnx.listvms()
+            except libvirt.libvirtError as exc:
+                _LOGGER.error("Cannot watch libvirt events on host '%s': %s", host, exc)
+                cnx.cnx.close()
+                continue
+            self.inventory.set_host(host, [vm.__dict__ for vm in vms],
+                                    vtype=clustdock.LIBVIRT_NODE)
+            with self._lock:
+                self.libvirt_cnx[host] = cnx
+                self.inventory.watch(host, clustdock.LIBVIRT_NODE, lease=self.lease)
+            _LOGGER.info("Watching libvirt events on host '%s'", host)
+
+    def _close_libvirt(self, host):
+        with self._lock:
+            cnx = self.libvirt_cnx.pop(host, None)
+            self.inventory.watch(host, clustdock.LIBVIRT_NODE, False)
+        if cnx is not None:
+            try:
+                cnx.cnx.close()
+            except libvirt.libvirtError:
+                pass
+
+    def _on_libvirt_close(self, conn, reason, host):
+        """Called when the libvirt connexion to a host is lost"""
+        _LOGGER.warning("Lost libvirt connexion to host '%s' (reason %s)", host, reason)
+        with self._lock:
+            self.libvirt_cnx.pop(host, None)
+            self.inventory.watch(host, clustdock.LIBVIRT_NODE, False)
+
+    def _on_domain_event(self, conn, domain, event, detail, host):
+        """Apply a domain lifecycle event to the inventory"""
+        name = domain.name()
+        _LOGGER.debug("libvirt event %d on domain '%s' (host %s)", event, name, host)
+        if event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            self.inventory.remove_nodes([name])
+            return
+        try:
+            status = domain.state()[0]
+            if not self.inventory.set_status(host, name, status):
+                node = lnode.LibvirtNode.from_domain(domain, host)
+                self.inventory.add_nodes([node.__dict__])
+        except libvirt.libvirtError as exc:
+            _LOGGER.debug("Domain '%s' vanished: %s", name, exc)
+            self.inventory.remove_nodes([name])
+
+    def _watch_docker(self, host):
+        """Follow container events of a host, reconnecting when needed"""
+        cnx = dnode.DockerConnexion(host, self.docker_port)
+        while not self._stop.is_set():
+            try:
+                stream = cnx.client.events(filters={'type': ['container']})
+            except docker_api.DockerAPIError as exc:
+                # Listed by the workers until the engine can be reached
+                _LOGGER.debug("No docker events on host '%s': %s", host, exc)
+                self._stop.wait(self.retry_delay)
+                continue
+            try:
+                containers = cnx.client.containers()
+                records = [dnode.ContainerRecord.from_api(dock, host).to_dict()
+                           for dock in containers]
+                self.inventory.set_host(host, records, vtype=clustdock.DOCKER_NODE)
+                with self._lock:
+                    self._docker_watched.add(host)
+                    self.inventory.watch(host, clustdock.DOCKER_NODE, lease=self.lease)
+                _LOGGER.info("Watching docker events on host '%s'", host)
+                for event in stream:
+                    self.on_docker_event(cnx, host, event)
+            except docker_api.DockerAPIError as exc:
+                _LOGGER.warning("Docker events of host '%s' interrupted: %s", host, exc)
+            finally:
+                stream.close()
+                with self._lock:
+                    self._docker_watched.discard(host)
+                    self.inventory.watch(host, clustdock.DOCKER_NODE, False)
+            self._stop.wait(1)
+
+    def on_docker_event(self, cnx, host, event):
+        """Apply a container event to the inventory"""
+        action = event.get('Action', event.get('status', ''))
+        attrs = event.get('Actor', {}).get('Attributes', {})
+        name = attrs.get('name')
+        _LOGGER.debug("docker event '%s' on container '%s' (host %s)", action, name, host)
+        if action == 'destroy':
+            if name is not None:
+                self.inventory.remove_nodes([name])
+            return
+        if action not in DOCKER_ACTIONS:
+            return
+        if action == 'rename' and 'oldName' in attrs:
+            self.inventory.remove_nodes([attrs['oldName'].lstrip('/')])
+        try:
+            info = cnx.client.inspect(event.get('id', name))
+        except docker_api.DockerAPIError as exc:
+            _LOGGER.debug("Container '%s' vanished: %s", name, exc)
+            if name is not None:
+                self.inventory.remove_nodes([name])
+            return
+        record = dnode.ContainerRecord.from_inspect(info, host)
+        self.inventory.add_nodes([record.to_dict()])
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Minimal in-process Docker Engine API used by the testsuite'''
+
+import os
+import re
+import json
+import time
+import struct
+import threading
+import Queue
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+
+class FakeDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer the subset of the Engine API used by clustdock"""
+
+    protocol_version = "HTTP/1.1"
+
+    routes = [
+        ('GET', r'^/_ping$', 'ping'),
+        ('GET', r'^/info$', 'info'),
+        ('GET', r'^/containers/json$', 'list'),
+        ('POST', r'^/containers/create$', 'create'),
+        ('POST', r'^/containers/([^/]+)/start$', 'start'),
+        ('GET', r'^/containers/([^/]+)/json$', 'inspect'),
+        ('DELETE', r'^/containers/([^/]+)$', 'remove'),
+        ('POST', r'^/containers/([^/]+)/exec$', 'exec_create'),
+        ('POST', r'^/exec/([^/]+)/start$', 'exec_start'),
+        ('GET', r'^/exec/([^/]+)/json$', 'exec_inspect'),
+        ('POST', r'^/images/create$', 'pull'),
+        ('GET', r'^/images/(.+)/json$', 'image_inspect'),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        engine = self.server.engine
+        url = urlparse.urlparse(self.path)
+        path = re.sub(r'^/v[0-9.]+', '', url.path)
+        self.query = dict(urlparse.parse_qsl(url.query))
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self.data = json.loads(self.rfile.read(length)) if length else None
+        if path == '/events':
+            # Streaming answer, must not hold the engine lock
+            engine.requests.append((method, path))
+            self.api_events(engine)
+            return
+        with engine.lock:
+            engine.requests.append((method, path))
+            for meth, regex, func in self.routes:
+                match = re.match(regex, path)
+                if meth == method and match:
+                    getattr(self, 'api_' + func)(engine, *match.groups())
+                    return
+        self.reply(404, {'message': 'page not found'})
+
+    def reply(self, code, data=None, raw=None):
+        if raw is None:
+            raw = json.dumps(data) if data is not None else ''
+            ctype = 'application/json'
+        else:
+            ctype = 'text/plain'
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def _get(self, engine, name):
+        cont = engine.containers.get(name)
+        if cont is None:
+            cont = dict((item['Id'], item)
+                        for item in engine.containers.values()).get(name)
+        if cont is None:
+            self.reply(404, {'message': 'No such container: %s' % name})
+        return cont
+
+    def api_ping(self, engine):
+        self.reply(200, raw='OK')
+
+    def api_info(self, engine):
+        self.reply(200, {'NCPU': 8, 'MemTotal': 16 * 1024 ** 3,
+                         'Containers': len(engine.containers)})
+
+    def api_list(self, engine):
+        res = []
+        for cont in engine.containers.values():
+            if not self.query.get('all') and not cont['State']['Running']:
+                continue
+            res.append({
+                'Id': cont['Id'],
+                'Names': ['/' + cont['Name']],
+                'Image': cont['Config']['Image'],
+                'State': cont['State']['Status'],
+                'Status': 'Up 2 minutes' if cont['State']['Running'] else 'Created',
+                'Labels': cont['Config'].get('Labels') or {},
+                'NetworkSettings': cont['NetworkSettings'],
+            })
+        self.reply(200, res)
+
+    def api_create(self, engine):
+        name = self.query['name']
+        if self.data['Image'] not in engine.images:
+            self.reply(404, {'message': 'No such image: %s' % self.data['Image']})
+            return
+        if name in engine.containers:
+            self.reply(409, {'message': 'Conflict. name %s already in use' % name})
+            return
+        engine.counter += 1
+        engine.containers[name] = {
+            'Id': '%064x' % engine.counter,
+            'Name': name,
+            'Config': self.data,
+            'HostConfig': self.data.get('HostConfig', {}),
+            'State': {'Status': 'created', 'Running': False, 'Pid': 0},
+            'NetworkSettings': {'Networks': {}},
+        }
+        self.reply(201, {'Id': engine.containers[name]['Id'], 'Warnings': None})
+        engine.emit('create', name)
+
+    def api_start(self, engine, name):
+        cont = self._get(engine, name)
+        if cont is None:
+            return
+        cont['State'] = {'Status': 'running', 'Running': True,
+                         'Pid': 1000 + engine.counter}
+        cont['NetworkSettings']['Networks']['bridge'] = {
+            'IPAddress': '172.17.0.%d' % (engine.counter + 1),
+            'MacAddress': '02:42:ac:11:00:%02x' % (engine.counter + 1),
+        }
+        self.reply(204)
+        engine.emit('start', cont['Name'])
+
+    def api_inspect(self, engine, name):
+        cont = self._get(engine, name)
+        if cont is not None:
+            self.reply(200, cont)
+
+    def api_remove(self, engine, name):
+        cont = self._get(engine, name)
+        if cont is not None:
+            del engine.containers[cont['Name']]
+            self.reply(204)
+            engine.emit('destroy', cont['Name'], cont['Id'])
+
+    def api_exec_create(self, engine, name):
+        if self._get(engine, name) is None:
+            return
+        engine.counter += 1
+        exec_id = 'exec%d' % engine.counter
+        engine.execs[exec_id] = {'Container': name, 'Cmd': self.data['Cmd'],
+                                 'ExitCode': None}
+        self.reply(201, {'Id': exec_id})
+
+    def api_exec_start(self, engine, exec_id):
+        exe = engine.execs[exec_id]
+        rc, out, err = engine.exec_handler(exe['Container'], exe['Cmd'])
+        exe['ExitCode'] = rc
+        raw = ''
+        if out:
+            raw += struct.pack('>BxxxL', 1, len(out)) + out
+        if err:
+            raw += struct.pack('>BxxxL', 2, len(err)) + err
+        # The real engine hijacks the connexion: no length, closed at the end
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        self.end_headers()
+        self.wfile.write(raw)
+        self.close_connection = 1
+
+    def api_events(self, engine):
+        events = Queue.Queue()
+        engine.subscribers.append(events)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        while not engine.stopping:
+            try:
+                event = events.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            data = json.dumps(event) + '\n'
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write('0\r\n\r\n')
+        engine.subscribers.remove(events)
+        self.close_connection = 1
+
+    def api_exec_inspect(self, engine, exec_id):
+        self.reply(200, engine.execs[exec_id])
+
+    def api_image_inspect(self, engine, name):
+        if name not in engine.images and "%s:latest" % name not in engine.images:
+            self.reply(404, {'message': 'No such image: %s' % name})
+            return
+        self.reply(200, {'Id': 'sha256:%064x' % abs(hash(name))})
+
+    def api_pull(self, engine):
+        engine.images.add("%s:%s" % (self.query['fromImage'],
+                                     self.query.get('tag', 'latest')))
+        engine.images.add(self.query['fromImage'])
+        self.reply(200, {'status': 'Downloaded newer image'})
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = SocketServer.UnixStreamServer.get_request(self)
+        return request, ('local', 0)
+
+
+class FakeDockerEngine(object):
+    '''Fake docker engine listening on a unix socket or on localhost'''
+
+    def __init__(self, socket_path=None):
+        self.lock = threading.RLock()
+        self.containers = {}
+        self.execs = {}
+        self.images = set()
+        self.requests = []
+        self.subscribers = []
+        self.stopping = False
+        self.counter = 0
+        self.socket_path = socket_path
+        if socket_path is not None:
+            self.server = _UnixServer(socket_path, FakeDockerHandler)
+            self.url = "unix://%s" % socket_path
+        else:
+            self.server = _TCPServer(('127.0.0.1', 0), FakeDockerHandler)
+            self.url = "tcp://127.0.0.1:%d" % self.server.server_address[1]
+        self.server.engine = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def exec_handler(self, name, cmd):
+        """Result of commands executed inside containers"""
+        cont = self.containers[name]
+        ip = cont['NetworkSettings']['Networks'].get('bridge', {}).get('IPAddress')
+        if ip:
+            return (0, "    inet %s/16 scope global eth0\n" % ip, '')
+        return (1, '', 'no ip\n')
+
+    def emit(self, action, name, cont_id=None):
+        """Send container event to subscribers"""
+        if cont_id is None:
+            cont_id = self.containers[name]['Id']
+        event = {'Type': 'container', 'Action': action, 'status': action,
+                 'id': cont_id, 'time': int(time.time()),
+                 'Actor': {'ID': cont_id, 'Attributes': {'name': name}}}
+        for events in self.subscribers:
+            events.put(event)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.server.shutdown()
+        self.server.server_close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
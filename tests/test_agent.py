@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Host agent testsuite'''
+
+import os
+import shutil
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+import clustdock.agent as agent
+import clustdock.server as server
+from tests.test_provision import FAKE_QEMU_IMG
+
+# Overlays named slow* take half a second
+FAKE_SLOW_QEMU_IMG = FAKE_QEMU_IMG.replace('#!/bin/sh\n', '#!/bin/sh\n'
+                                           'case "$*" in *slow*) sleep 0.5;; esac\n')
+
+
+class AgentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="clustdock-agent-")
+        fake = os.path.join(self.tmpdir, 'qemu-img')
+        with open(fake, 'w') as fake_file:
+            fake_file.write(FAKE_SLOW_QEMU_IMG)
+        os.chmod(fake, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, self.path)
+        # Local agent, stopped by writing in the pipe
+        self.agents = []
+        self.port = self.start_agent(allowed=['127.0.0.1'])
+        self.client = agent.AgentClient('127.0.0.1', self.port, timeout=5)
+
+    def start_agent(self, **kwargs):
+        """Start a local agent, stopped by writing in a pipe. Return its port"""
+        local = agent.Agent('tcp://127.0.0.1:0', max_parallel=4,
+                            storage_dirs=[self.tmpdir], **kwargs)
+        local.bind()
+        rfd, stop_fd = os.pipe()
+        stop_file = os.fdopen(rfd)
+        thread = threading.Thread(target=local.serve, args=(stop_file,))
+        thread.start()
+        self.agents.append((thread, stop_file, stop_fd))
+        return int(local.url.rsplit(':', 1)[1])
+
+    def tearDown(self):
+        self.client.close()
+        for thread, stop_file, stop_fd in self.agents:
+            os.write(stop_fd, 'x')
+            thread.join()
+            stop_file.close()
+            os.close(stop_fd)
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def test_batch(self):
+        """Test operations run in parallel and streamed back"""
+        done = []
+        paths = [os.path.join(self.tmpdir, name) for name in ('slow.qcow2', 'bad.qcow2',
+                                                                'fast.qcow2')]
+        start = time.time()
+        results = self.client.batch([agent.operation('overlay', base='/mnt/base.img',
+                                                     path=path)
+                                     for path in paths],
+                                    callback=lambda idx, res, err: done.append(idx))
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(results[0], (paths[0], None))
+        self.assertIsNone(results[1][0])
+        self.assertIn("cannot create", results[1][1])
+        self.assertEqual(results[2], (paths[2], None))
+        self.assertEqual(done[-1], 0)
+        self.assertEqual(sorted(done), [0, 1, 2])
+
+    def test_files(self):
+        """Test overlay creation and disk removal"""
+        paths = [os.path.join(self.tmpdir, name) for name in ('vm0.qcow2', 'bad.qcow2')]
+        results = self.client.batch([agent.operation('overlay', base='/mnt/base.img',
+                                                     path=path)
+                                     for path in paths])
+        self.assertEqual(results[0], (paths[0], None))
+        self.assertIn("cannot create", results[1][1])
+        results = self.client.batch([agent.operation('remove', path=path)
+                                     for path in paths])
+        self.assertEqual(results, [(True, None), (False, None)])
+        self.assertFalse(os.path.exists(paths[0]))
+
+    def test_errors(self):
+        """Test rejected batches and failed operations"""
+        self.assertRaises(agent.AgentError, self.client.batch,
+                          [agent.operation('format', disk='/dev/sda')])
+        ((result, err),) = self.client.batch([agent.operation('remove', disk='/tmp/x')])
+        self.assertIsNone(result)
+        self.assertIn("unexpected keyword", err)
+        self.assertEqual(self.client.batch([]), [])
+        client = agent.AgentClient('127.0.0.1', 1, timeout=0.2)
+        try:
+            self.assertRaises(agent.AgentError, client.batch,
+                              [agent.operation('neighbours')])
+        finally:
+            client.close()
+
+    def test_storage_dirs(self):
+        """Test files outside storage directories neither written nor removed"""
+        outside = mkdtemp(prefix="clustdock-outside-")
+        try:
+            path = os.path.join(outside, 'vm0.qcow2')
+            open(path, 'w').close()
+            escaping = os.path.join(self.tmpdir, '..', os.path.basename(outside),
+                                    'vm1.qcow2')
+            results = self.client.batch([agent.operation('remove', path=path),
+                                         agent.operation('overlay', base='/mnt/base.img',
+                                                         path=escaping)])
+            self.assertTrue(all(result is None and "not in a storage directory" in err
+                                for result, err in results))
+            self.assertTrue(os.path.exists(path))
+            self.assertFalse(os.path.exists(escaping))
+        finally:
+            shutil.rmtree(outside)
+        self.assertRaises(AttributeError, getattr, agent, 'op_run')
+        self.assertRaises(agent.AgentError, self.client.batch,
+                          [agent.operation('run', command='id')])
+
+    def test_authentication(self):
+        """Test peers rejected unless allowed or holding the daemon certificate"""
+        self.assertRaises(agent.AgentError, agent.Agent('tcp://127.0.0.1:0').bind)
+        port = self.start_agent(allowed=['10.0.0.1'])
+        client = agent.AgentClient('127.0.0.1', port, timeout=0.5)
+        try:
+            self.assertRaises(agent.AgentError, client.batch,
+                              [agent.operation('neighbours')])
+        finally:
+            client.close()
+        curve_dir = os.path.join(self.tmpdir, 'curve')
+        agent.create_certificates(curve_dir)
+        port = self.start_agent(curve_dir=curve_dir)
+        client = agent.AgentClient('127.0.0.1', port, timeout=0.5)
+        try:
+            self.assertRaises(agent.AgentError, client.batch,
+                              [agent.operation('neighbours')])
+        finally:
+            client.close()
+        client = agent.AgentClient('127.0.0.1', port, timeout=5, curve_dir=curve_dir)
+        try:
+            path = os.path.join(self.tmpdir, 'vm0.qcow2')
+            self.assertEqual(client.batch([agent.operation('remove', path=path)]),
+                             [(False, None)])
+        finally:
+            client.close()
+
+    def test_worker_overlays(self):
+        """Test disks of a spawn created by the agents of their hosts"""
+        worker = server.ClustdockWorker('inproc://test', 0, {}, ['127.0.0.1', 'nohost'],
+                                        None, agent_port=self.port)
+        disks = [('/mnt/base.img', os.path.join(self.tmpdir, "vm%d.qcow2" % idx))
+                 for idx in range(3)]
+        hosts = dict((path, '127.0.0.1') for _, path in disks)
+        results = worker._create_overlays(disks, hosts)
+        self.assertEqual(results, dict((path, None) for _, path in disks))
+        self.assertTrue(all(os.path.exists(path) for _, path in disks))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Bridge topology cache testsuite'''
+
+import threading
+import time
+import unittest
+import mock
+import clustdock.bridges as bridges
+import clustdock.docker_node as dnode
+
+PROBE_OUTPUT = """[ovs]
+ovsbr0
+[bridge]
+3: br0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc noqueue state UP mode DEFAULT
+5: br1: <NO-CARRIER,BROADCAST,MULTICAST,UP> mtu 1500 qdisc noqueue state DOWN mode DEFAULT
+[inet]
+1: lo    inet 127.0.0.1/8 scope host lo\\       valid_lft forever preferred_lft forever
+3: br0    inet 10.0.0.1/24 brd 10.0.0.255 scope global br0\\       valid_lft forever
+3: br0    inet 10.0.1.1/24 brd 10.0.1.255 scope global br0\\       valid_lft forever
+4: ovsbr0    inet 10.1.0.1/16 brd 10.1.255.255 scope global ovsbr0\\       valid_lft
+"""
+
+
+class BridgesTest(unittest.TestCase):
+
+    def test_parse_topology(self):
+        """Test bridge types and addresses read from one probe"""
+        topology = bridges.parse_topology(PROBE_OUTPUT)
+        self.assertEqual(topology['br0'], ('br0', bridges.BRIDGE_SYSTEM, '10.0.0.1/24'))
+        self.assertEqual(topology['br1'], ('br1', bridges.BRIDGE_SYSTEM, None))
+        self.assertEqual(topology['ovsbr0'], ('ovsbr0', bridges.BRIDGE_OVS,
+                                              '10.1.0.1/16'))
+        self.assertEqual(sorted(topology), ['br0', 'br1', 'lo', 'ovsbr0'])
+
+    def test_cache(self):
+        """Test hosts probed once by concurrent lookups, again on invalidation"""
+        probes = []
+
+        def probe(host):
+            probes.append(host)
+            time.sleep(0.1)
+            return bridges.parse_topology(PROBE_OUTPUT)
+
+        cache = bridges.BridgeCache(probe=probe)
+        threads = [threading.Thread(target=cache.lookup, args=('host1', 'br0'))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache.lookup('host1', 'ovsbr0').kind, bridges.BRIDGE_OVS)
+        self.assertEqual(cache.lookup('host2', 'br1').ip, None)
+        self.assertEqual(probes, ['host1', 'host2'])
+        # An unknown bridge is only probed again after REFRESH_DELAY
+        self.assertIsNone(cache.lookup('host1', 'br2'))
+        self.assertEqual(len(probes), 2)
+        cache.invalidate('host1')
+        cache.lookup('host1', 'br0')
+        cache.lookup('host2', 'br0')
+        self.assertEqual(probes, ['host1', 'host2', 'host1'])
+        cache.invalidate()
+        cache.lookup('host2', 'br0')
+        self.assertEqual(probes[-1], 'host2')
+
+    @mock.patch('clustdock.bridges.TOPOLOGY', new_callable=lambda: bridges.BridgeCache(
+        probe=lambda host: bridges.parse_topology(PROBE_OUTPUT)))
+    def test_bridge_checks(self, _):
+        """Test interfaces checked against the cached bridges"""
+        node = dnode.DockerNode('cn0', 'test/example', host='host1')
+        self.assertTrue(node._is_ovs_bridge('ovsbr0'))
+        self.assertFalse(node._is_ovs_bridge('br0'))
+        self.assertFalse(node._is_ovs_bridge('br2'))
+        self.assertEqual(node._bridge('br0').ip, '10.0.0.1/24')
+        with self.assertRaisesRegexp(dnode.AddIfaceException, "Cannot find ip"):
+            node._bridge('br1')
+        with self.assertRaisesRegexp(dnode.AddIfaceException, "does not exist"):
+            node._bridge('br2')
+
+
+if __name__ == '__main__':
+    unittest.main()
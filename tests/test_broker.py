@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Worker pool broker testsuite'''
+
+import os
+import time
+import threading
+import unittest
+import zmq
+import clustdock.broker as broker
+import clustdock.client_protocol as proto
+
+FRONTEND = "inproc://frontend"
+BACKEND = "inproc://backend"
+
+
+class FakeWorker(threading.Thread):
+    '''Worker thread answering 'done <cmd>', spawn requests are slow'''
+
+    def __init__(self, ctx, worker_id):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.ctx = ctx
+        self.worker_id = worker_id
+        self.killed = False
+        self.retired = False
+        self.start()
+
+    def run(self):
+        sock = self.ctx.socket(zmq.DEALER)
+        sock.setsockopt(zmq.IDENTITY, broker.worker_identity(self.worker_id))
+        sock.connect(BACKEND)
+        sock.send_multipart(['', broker.WORKER_READY])
+        while not self.killed:
+            if not sock.poll(50):
+                continue
+            frames = sock.recv_multipart()
+            if frames[-1] == broker.WORKER_STOP:
+                self.retired = True
+                break
+            if frames[-1].startswith('spawn'):
+                time.sleep(0.5)
+            sock.send_multipart(['', frames[1], '', 'done %s' % frames[-1]])
+            sock.send_multipart(['', broker.WORKER_READY])
+        sock.close()
+
+    def terminate(self):
+        self.killed = True
+
+
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = zmq.Context()
+        self.spawned = []
+        self.broker = None
+
+    def tearDown(self):
+        if self.broker is not None:
+            os.write(self.stop_w, 'x')
+            self.thread.join()
+            self.broker.stop()
+        for worker in self.spawned:
+            worker.join()
+        self.ctx.term()
+
+    def start_broker(self, **kwargs):
+        def spawn_worker(worker_id, lane):
+            worker = FakeWorker(self.ctx, worker_id)
+            self.spawned.append(worker)
+            return worker
+        self.broker = broker.Broker(self.ctx, FRONTEND, BACKEND, spawn_worker, **kwargs)
+        self.broker.start_workers()
+        stop_r, self.stop_w = os.pipe()
+        self.thread = threading.Thread(target=self.broker.run,
+                                       args=(os.fdopen(stop_r), 50))
+        self.thread.start()
+
+    def client(self, cmd):
+        sock = self.ctx.socket(zmq.REQ)
+        sock.connect(FRONTEND)
+        sock.send(cmd)
+        return sock
+
+    def test_request_lane(self):
+        """Test classification of requests"""
+        self.assertEqual(broker.request_lane('list False'), broker.FAST_LANE)
+        self.assertEqual(broker.request_lane('get_ip node[1-3]'), broker.FAST_LANE)
+        self.assertEqual(broker.request_lane('status 12'), broker.FAST_LANE)
+        self.assertEqual(broker.request_lane('spawn prof test 3 None'), broker.SLOW_LANE)
+        self.assertEqual(broker.request_lane('stop_nodes test1'), broker.SLOW_LANE)
+        fast = proto.new_request([proto.operation('list'),
+                                  proto.operation('get_ip', nodeset='test[0-3]')])
+        self.assertEqual(broker.request_lane(proto.pack_request(fast)), broker.FAST_LANE)
+        mixed = proto.new_request([proto.operation('list'),
+                                   proto.operation('stop_nodes', nodeset='test0')])
+        self.assertEqual(broker.request_lane(proto.pack_request(mixed)), broker.SLOW_LANE)
+        self.assertEqual(broker.request_lane('\x93garbage'), broker.SLOW_LANE)
+
+    def test_fast_lane(self):
+        """Test that list requests do not wait behind spawns"""
+        self.start_broker(min_workers=1, max_workers=1, fast_workers=1)
+        spawn = self.client('spawn prof test 1 None')
+        time.sleep(0.1)
+        lister = self.client('list False')
+        self.assertTrue(lister.poll(300))
+        self.assertEqual(lister.recv(), 'done list False')
+        self.assertFalse(spawn.poll(0))
+        self.assertTrue(spawn.poll(2000))
+        self.assertEqual(spawn.recv(), 'done spawn prof test 1 None')
+        spawn.close()
+        lister.close()
+
+    def test_elastic_pool(self):
+        """Test that the pool grows under load and shrinks when idle"""
+        self.start_broker(min_workers=1, max_workers=3, fast_workers=0,
+                          idle_timeout=0.3)
+        clients = [self.client('spawn prof test%d 1 None' % idx) for idx in range(5)]
+        for idx, sock in enumerate(clients):
+            self.assertTrue(sock.poll(3000))
+            self.assertEqual(sock.recv(), 'done spawn prof test%d 1 None' % idx)
+            sock.close()
+        self.assertEqual(len(self.spawned), 3)
+        time.sleep(1)
+        self.assertEqual(len([wrk for wrk in self.spawned if wrk.retired]), 2)
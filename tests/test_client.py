@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Client testsuite'''
+
+import sys
+import threading
+import unittest
+from StringIO import StringIO
+import zmq
+import msgpack
+import clustdock.client as client
+import clustdock.client_protocol as proto
+
+
+class ClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ctx = zmq.Context.instance()
+        self.server = self.ctx.socket(zmq.ROUTER)
+        port = self.server.bind_to_random_port('tcp://127.0.0.1')
+        self.requests = []
+        self.client = client.ClustdockClient('tcp://127.0.0.1:%d' % port, timeout=0.3)
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        self.client.socket.close()
+        self.server.close()
+
+    def serve(self, answers):
+        """Answer each request with the results and the list of messages given"""
+        def run():
+            for results, messages in answers:
+                frames = self.server.recv_multipart()
+                request = proto.unpack_request(frames[-1])
+                self.requests.append(request['ops'])
+                self.server.send_multipart([frames[0], '',
+                                            proto.pack_reply(request, results)])
+                for msg in messages:
+                    self.server.send_multipart([frames[0], ''] + msg)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def test_spawn_stream(self):
+        """Test that node events are printed as they come"""
+        def event(data):
+            return [client.STREAM_EVENT, msgpack.packb(data)]
+
+        thread = self.serve([([('4', [])], [
+            event({'job': '4', 'node': 'test0', 'status': 'done',
+                   'elapsed': 1.25, 'error': None}),
+            event({'job': '4', 'node': 'test1', 'status': 'failed',
+                   'elapsed': 2.0, 'error': "Error when spawning 'test1'\n"}),
+            event({'job': '4', 'end': True, 'result': 'test0', 'hosts': 'host1:test0',
+                   'errors': ["Error when spawning 'test1'\n"]}),
+        ])])
+        rc = self.client.spawn('prof', 'test', 2, 'None')
+        thread.join()
+        out, err = sys.stdout.getvalue(), sys.stderr.getvalue()
+        self.assertEqual(rc, 1)
+        self.assertEqual(self.requests, [[proto.operation('spawn', profile='prof',
+                                                          name='test', nb_nodes=2,
+                                                          host=None, stream=True,
+                                                          placement=None)]])
+        self.assertEqual(out, "test0\n")
+        self.assertEqual(err, "test0\tdone\t1.2s\n"
+                              "test1\tfailed\t2.0s\n"
+                              "Error when spawning 'test1'\n"
+                              "host1:test0\n")
+
+    def test_stop_detach(self):
+        """Test that detached commands only print the job ids"""
+        thread = self.serve([([('7', []), ('', ["Error: 'foo' not found"])], [])])
+        rc = self.client.stop(['test[0-1]', 'foo'], detach=True)
+        thread.join()
+        self.assertEqual(rc, 0)
+        self.assertEqual(self.requests, [[
+            proto.operation('stop_nodes', nodeset='test[0-1]', stream=False),
+            proto.operation('stop_nodes', nodeset='foo', stream=False),
+        ]])
+        self.assertEqual(sys.stdout.getvalue(), "7\n")
+        self.assertEqual(sys.stderr.getvalue(), "Error: 'foo' not found\n")
+
+    def test_stale_reply(self):
+        """Test that replies to older requests are dropped"""
+        def run():
+            frames = self.server.recv_multipart()
+            request = proto.unpack_request(frames[-1])
+            stale = {'v': proto.PROTOCOL_VERSION, 'id': 'old',
+                     'results': [('', ['stale'])]}
+            self.server.send_multipart([frames[0], '', msgpack.packb(stale)])
+            results = [([('test0', '10.0.0.2'), ('test1', '10.0.0.3')], [])]
+            self.server.send_multipart([frames[0], '',
+                                        proto.pack_reply(request, results)])
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        rc = self.client.getip('test[0-1]')
+        thread.join()
+        self.assertEqual(rc, 0)
+        self.assertEqual(sys.stdout.getvalue(), "test0\t10.0.0.2\ntest1\t10.0.0.3\n")
+        self.assertEqual(sys.stderr.getvalue(), "")
+
+    def test_pipelining(self):
+        """Test that outstanding requests are matched with their reply"""
+        nodes = ['test%d' % idx for idx in range(5)]
+        req_ids = [self.client.submit([proto.operation('get_ip', nodeset=node)])
+                   for node in nodes]
+        received = [self.server.recv_multipart() for _ in nodes]
+        # Answer in reverse order
+        for frames in reversed(received):
+            request = proto.unpack_request(frames[-1])
+            node = request['ops'][0]['args']['nodeset']
+            self.server.send_multipart([frames[0], '',
+                                        proto.pack_reply(request, [(node, [])])])
+        for node, req_id in reversed(zip(nodes, req_ids)):
+            self.assertEqual(self.client.result(req_id), [[node, []]])
+        self.assertEqual(self.client.pending, {})
+
+    def test_retry(self):
+        """Test that read-only requests are sent again on a new connexion"""
+        def run():
+            # First try is left unanswered
+            self.requests.append(self.server.recv_multipart())
+            frames = self.server.recv_multipart()
+            self.requests.append(frames)
+            request = proto.unpack_request(frames[-1])
+            self.server.send_multipart([frames[0], '',
+                                        proto.pack_reply(request, [({}, [])])])
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        results = self.client.call([proto.operation('list')])
+        thread.join()
+        self.assertEqual(results, [[{}, []]])
+        self.assertEqual(self.requests[0][-1], self.requests[1][-1])
+        self.assertNotEqual(self.requests[0][0], self.requests[1][0])
+
+    def test_timeout(self):
+        """Test that other requests are not sent again"""
+        self.assertRaises(client.ClientTimeout, self.client.call,
+                          [proto.operation('stop_nodes', nodeset='test0')])
+        self.server.recv_multipart()
+        self.assertFalse(self.server.poll(500))
+        self.assertEqual(self.client.stop('test0'), 2)
+        self.assertEqual(sys.stderr.getvalue(), "Error when trying to contact server.\n")
+
+    def test_default_timeout(self):
+        """Test that requests wait as long as the server may take by default"""
+        waiting = client.ClustdockClient(self.client.server, host_timeout=5)
+        try:
+            req_id = waiting.submit([proto.operation('list')])
+            self.assertEqual(waiting.pending[req_id]['timeout'], 5 + proto.REPLY_MARGIN)
+            req_id = waiting.submit([proto.operation('get_ip', nodeset='test0')])
+            self.assertEqual(waiting.pending[req_id]['timeout'], 10 + proto.REPLY_MARGIN)
+        finally:
+            waiting.socket.close()
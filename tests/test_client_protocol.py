@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Client/server protocol testsuite'''
+
+import time
+import unittest
+import msgpack
+import clustdock.client_protocol as proto
+
+
+class ProtocolTest(unittest.TestCase):
+
+    def test_envelope(self):
+        """Test round trip of a request with several operations"""
+        request = proto.new_request([
+            proto.operation('spawn', profile=u'prof', name='test', nb_nodes=2),
+            proto.operation('stop_nodes', nodeset='old[0-3]', stream=True),
+        ], timeout=10)
+        decoded = proto.unpack_request(proto.pack_request(request))
+        self.assertEqual(decoded['id'], request['id'])
+        self.assertFalse(proto.expired(decoded))
+        self.assertEqual(decoded['ops'], [
+            {'cmd': 'spawn', 'args': {'profile': 'prof', 'name': 'test', 'nb_nodes': 2,
+                                      'host': None, 'stream': False, 'placement': None}},
+            {'cmd': 'stop_nodes', 'args': {'nodeset': 'old[0-3]', 'stream': True}},
+        ])
+        self.assertEqual(proto.request_commands(proto.pack_request(request)),
+                         ['spawn', 'stop_nodes'])
+        reply = proto.unpack_reply(proto.pack_reply(decoded, [('1', []), ('2', [])]))
+        self.assertEqual(reply['id'], request['id'])
+        self.assertEqual(reply['results'], [['1', []], ['2', []]])
+
+    def test_legacy(self):
+        """Test conversion of legacy string requests"""
+        request = proto.unpack_request('spawn prof test 3 None stream')
+        self.assertIsNone(request['id'])
+        self.assertEqual(request['ops'][0]['args'],
+                         {'profile': 'prof', 'name': 'test', 'nb_nodes': 3,
+                          'host': None, 'stream': True, 'placement': None})
+        request = proto.unpack_request('list True')
+        self.assertEqual(request['ops'][0]['args'], {'allnodes': True})
+        self.assertEqual(msgpack.unpackb(proto.pack_reply(request, [('a', [])])),
+                         ['a', []])
+        for raw in ('list __import__("os")', 'spawn prof', 'unknown cmd'):
+            self.assertRaises(proto.ProtocolError, proto.unpack_request, raw)
+
+    def test_invalid(self):
+        """Test rejection of malformed requests"""
+        bad_ops = [
+            proto.operation('format', disk='/dev/sda'),
+            proto.operation('get_ip'),
+            proto.operation('get_ip', nodeset=3),
+            proto.operation('status', job='1', force=True),
+        ]
+        for op in bad_ops:
+            raw = proto.pack_request(proto.new_request([op]))
+            self.assertRaises(proto.ProtocolError, proto.unpack_request, raw)
+            self.assertEqual(proto.request_commands(raw), [])
+        request = proto.new_request([])
+        self.assertRaises(proto.ProtocolError, proto.unpack_request,
+                          proto.pack_request(request))
+        reply = proto.unpack_reply(proto.pack_error(proto.pack_request(request), "Error"))
+        self.assertEqual(reply['id'], request['id'])
+        self.assertEqual(reply['results'], [['', ["Error"]]])
+
+    def test_deadline(self):
+        """Test expiry of requests, counted from their reception"""
+        request = proto.new_request([proto.operation('list')], timeout=-1)
+        self.assertTrue(proto.expired(proto.unpack_request(proto.pack_request(request))))
+        request = proto.new_request([proto.operation('list')], timeout=10)
+        self.assertNotIn('deadline', request)
+        raw = proto.pack_request(request)
+        self.assertFalse(proto.expired(proto.unpack_request(raw)))
+        self.assertTrue(proto.expired(proto.unpack_request(raw, time.time() - 11)))
+        request = proto.unpack_request(proto.pack_request(proto.new_request(
+            [proto.operation('list')])))
+        self.assertFalse(proto.expired(request))
+
+    def test_reply_timeout(self):
+        """Test client timeouts above the time the server may take"""
+        ops = [proto.operation('list')]
+        self.assertEqual(proto.reply_timeout(ops), 30 + proto.REPLY_MARGIN)
+        ops = [proto.operation('spawn', profile='prof', name='test')]
+        self.assertEqual(proto.reply_timeout(ops, host_timeout=5),
+                         10 + proto.REPLY_MARGIN)
+        ops = [proto.operation('status', job='1')]
+        self.assertEqual(proto.reply_timeout(ops), proto.REPLY_MARGIN)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Docker Engine API client testsuite'''
+
+import os
+import unittest
+from tempfile import mktemp
+import clustdock.docker_api as docker_api
+import clustdock.docker_node as dnode
+from tests.fake_docker_engine import FakeDockerEngine
+
+
+class DockerClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeDockerEngine().start()
+        self.engine.images.add('test/example')
+        self.client = docker_api.DockerClient(self.engine.url)
+
+    def tearDown(self):
+        self.client.close()
+        self.engine.stop()
+
+    def test_connexion_reused(self):
+        """Test that consecutive requests share one connexion"""
+        self.assertTrue(self.client.ping())
+        for _ in range(10):
+            self.client.containers()
+        self.assertEqual(self.client.stats['created'], 1)
+        self.assertEqual(self.client.stats['reused'], 10)
+
+    def test_container_lifecycle(self):
+        """Test create/start/inspect/remove of a container"""
+        config = docker_api.build_config('test/example', 'cn0')
+        self.client.create('cn0', config)
+        self.client.start('cn0')
+        info = self.client.inspect('cn0')
+        self.assertTrue(info['State']['Running'])
+        self.assertEqual(info['Config']['Hostname'], 'cn0')
+        self.assertEqual(len(self.client.containers(allnodes=False)), 1)
+        self.client.remove('cn0')
+        self.assertEqual(self.client.containers(), [])
+        with self.assertRaises(docker_api.DockerAPIError) as ctx:
+            self.client.inspect('cn0')
+        self.assertEqual(ctx.exception.status, 404)
+
+    def test_create_pulls_missing_image(self):
+        """Test that a missing image is pulled before creation"""
+        self.client.create('cn0', docker_api.build_config('other/image:1.0', 'cn0'))
+        self.assertIn(('POST', '/images/create'), self.engine.requests)
+        self.assertIn('cn0', self.engine.containers)
+
+    def test_execute(self):
+        """Test command execution inside a container"""
+        self.client.create('cn0', docker_api.build_config('test/example', 'cn0'))
+        self.client.start('cn0')
+        rc, out, err = self.client.execute('cn0', 'ip a')
+        self.assertEqual(rc, 0)
+        self.assertIn('inet 172.17.0.2/16', out)
+        self.assertEqual(err, '')
+        # the hijacked connexion must not be reused
+        self.assertTrue(self.client.ping())
+
+    def test_unix_socket(self):
+        """Test client over unix socket"""
+        path = mktemp(prefix="clustdock-docker-")
+        engine = FakeDockerEngine(path).start()
+        try:
+            client = docker_api.DockerClient("unix://%s" % path)
+            self.assertTrue(client.ping())
+            self.assertEqual(client.info()['NCPU'], 8)
+            self.assertEqual(client.stats['created'], 1)
+        finally:
+            engine.stop()
+        self.assertFalse(os.path.exists(path))
+
+    def test_build_config(self):
+        """Test translation of docker run options"""
+        config = docker_api.build_config(
+            'test/example', 'cn0',
+            "--net=none -v /tmp/:/tmp/ -e FOO=bar --privileged -m 512m",
+            cap_add=['net_admin'], labels={'clustdock.ifaces': 'eth1=10.0.0.5'})
+        self.assertEqual(config['Env'], ['FOO=bar'])
+        self.assertEqual(config['Labels'], {'clustdock.ifaces': 'eth1=10.0.0.5'})
+        self.assertEqual(config['HostConfig']['NetworkMode'], 'none')
+        self.assertEqual(config['HostConfig']['Binds'], ['/tmp/:/tmp/'])
+        self.assertEqual(config['HostConfig']['Memory'], 512 * 1024 ** 2)
+        self.assertEqual(config['HostConfig']['CapAdd'], ['net_admin'])
+        self.assertTrue(config['HostConfig']['Privileged'])
+        with self.assertRaises(docker_api.DockerOptsError):
+            docker_api.build_config('test/example', 'cn0', '--unknown-opt 3')
+
+
+class DockerConnexionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeDockerEngine().start()
+        self.engine.images.add('test/example')
+        port = int(self.engine.url.rsplit(':', 1)[1])
+        self.cnx = dnode.DockerConnexion('127.0.0.1', port)
+
+    def tearDown(self):
+        self.cnx.client.close()
+        self.engine.stop()
+
+    def test_list_containers(self):
+        """Test inventory of containers in a single request"""
+        for name in ('cn0', 'cn1', 'cn2'):
+            self.cnx.client.create(name, docker_api.build_config('test/example', name))
+        self.cnx.client.start('cn0')
+        self.cnx.client.start('cn2')
+        del self.engine.requests[:]
+        records = sorted(self.cnx.list_containers())
+        self.assertEqual(self.engine.requests, [('GET', '/containers/json')])
+        self.assertEqual([rec.name for rec in records], ['cn0', 'cn1', 'cn2'])
+        self.assertEqual([rec.status for rec in records],
+                         [dnode.STATUS['up'], dnode.STATUS['created'],
+                          dnode.STATUS['up']])
+        self.assertEqual(records[0].ips, ['172.17.0.4'])
+        self.assertEqual(records[1].ips, [])
+        running = self.cnx.list_containers(allnodes=False)
+        self.assertEqual(sorted(rec.name for rec in running), ['cn0', 'cn2'])
+
+        node = records[0].to_node()
+        self.assertIsInstance(node, dnode.DockerNode)
+        self.assertEqual((node.name, node.img, node.host, node.ip),
+                         ('cn0', 'test/example', '127.0.0.1', '172.17.0.4'))
+        self.assertEqual(records[0].to_dict()['status'], dnode.STATUS['up'])
+
+    def test_run_and_remove(self):
+        """Test container creation and removal through the connexion"""
+        rc, _, err = self.cnx.run('cn0', 'test/example', '--net=none')
+        self.assertEqual((rc, err), (0, ''))
+        config = self.engine.containers['cn0']['Config']
+        self.assertEqual(config['HostConfig']['CapAdd'], ['net_raw', 'net_admin'])
+        self.assertEqual(config['HostConfig']['NetworkMode'], 'none')
+        rc, _, _ = self.cnx.remove('cn0')
+        self.assertEqual(rc, 0)
+        rc, _, err = self.cnx.remove('cn0')
+        self.assertEqual(rc, 1)
+        self.assertIn('No such container', err)
+
+    def test_get_ips(self):
+        """Test IP lookup of several containers in a single request"""
+        labels = {dnode.IFACES_LABEL: 'eth1=10.0.0.5/24 eth2=10.1.0.5'}
+        self.cnx.run('cn0', 'test/example', labels=labels)
+        self.cnx.run('cn1', 'test/example')
+        self.cnx.client.create('cn2', docker_api.build_config('test/example', 'cn2'))
+        self.cnx.run('cn10', 'test/example')
+        del self.engine.requests[:]
+        ips = self.cnx.get_ips(['cn0', 'cn1', 'cn2', 'cn3'])
+        self.assertEqual(self.engine.requests, [('GET', '/containers/json')])
+        self.assertEqual(ips, {'cn0': ['172.17.0.2', '10.0.0.5', '10.1.0.5'],
+                               'cn1': ['172.17.0.3']})
+        node = dnode.DockerNode('cn1', 'test/example', host='127.0.0.1')
+        self.assertEqual(node.get_ip(cnx=self.cnx), '172.17.0.3')
+
+    def test_iface_labels(self):
+        """Test that only static IPs on openvswitch bridges are recorded"""
+        node = dnode.DockerNode('cn0', 'test/example', host='127.0.0.1',
+                                add_iface=[('ovsbr0', 'eth1', '10.0.0.5/24'),
+                                           ('ovsbr1', 'eth2', 'dhcp')])
+        labels = node.iface_labels(set(['ovsbr0', 'ovsbr1']))
+        self.assertEqual(labels, {dnode.IFACES_LABEL: 'eth1=10.0.0.5/24'})
+        self.assertEqual(dnode.label_ips(labels), ['10.0.0.5'])
+        node.add_iface.append(('br0', 'eth3', '10.2.0.5/24'))
+        self.assertEqual(node.iface_labels(set(['ovsbr0'])), labels)
+        self.assertEqual(node.iface_labels(set()), {})
+
+    def test_node_start_stop(self):
+        """Test node operations run without forking"""
+        node = dnode.DockerNode('cn0', 'test/example', host='127.0.0.1')
+        self.assertEqual(node.start(fork=False, cnx=self.cnx), (0, 'OK'))
+        self.assertTrue(self.engine.containers['cn0']['State']['Running'])
+        self.assertEqual(node.stop(fork=False, cnx=self.cnx), (0, 'OK'))
+        self.assertNotIn('cn0', self.engine.containers)
+        rc, msg = node.stop(fork=False, cnx=self.cnx)
+        self.assertEqual(rc, 1)
+        self.assertIn("Error when stopping 'cn0'", msg)
+
+
+if __name__ == "__main__":
+    unittest.main()
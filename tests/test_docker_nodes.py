@@ -34,6 +34,7 @@ class DockerNodeTest(unittest.TestCase):
             'before_start': None,
             'after_start': None,
             'after_end': None,
+            'hook_timeout': None,
             'docker_opts': '',
             'host': 'localhost',
             'idx': 0,
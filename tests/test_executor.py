@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Bounded executor testsuite'''
+
+import os
+import signal
+import time
+import threading
+import unittest
+from multiprocessing import Event, Process
+import clustdock.executor as executor
+import clustdock.inventory as inv
+
+
+class Probe(object):
+    '''Record the maximum number of concurrent calls, overall and by host'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+
+    def _update(self, host, incr):
+        with self.lock:
+            self.running[host] = self.running.get(host, 0) + incr
+            total = sum(self.running.values())
+            self.peak[host] = max(self.peak.get(host, 0), self.running[host])
+            self.peak['all'] = max(self.peak.get('all', 0), total)
+
+    def __call__(self, host, value):
+        self._update(host, 1)
+        time.sleep(0.05)
+        self._update(host, -1)
+        if value == 'boom':
+            raise RuntimeError(value)
+        return value
+
+
+class ExecutorTest(unittest.TestCase):
+
+    def test_limits(self):
+        """Test global and per host limits"""
+        probe = Probe()
+        execu = executor.Executor(max_parallel=6, max_per_host=2)
+        hosts = ['host%d' % (idx % 4) for idx in range(24)]
+        results = execu.run([(host, probe, (host, idx))
+                             for idx, host in enumerate(hosts)])
+        self.assertEqual(results, [(idx, None) for idx in range(24)])
+        self.assertLessEqual(probe.peak['all'], 6)
+        self.assertGreater(probe.peak['all'], 2)
+        for host in set(hosts):
+            self.assertLessEqual(probe.peak[host], 2)
+
+    def test_run_limits(self):
+        """Test limits lowered for one run, threads are reused"""
+        probe = Probe()
+        execu = executor.Executor(max_parallel=8, max_per_host=8)
+        results = execu.run([('host0', probe, ('host0', 'boom'))] +
+                            [('host0', probe, ('host0', idx)) for idx in range(5)],
+                            max_parallel=4, max_per_host=1)
+        self.assertEqual(probe.peak['all'], 1)
+        self.assertIsInstance(results[0][1], RuntimeError)
+        self.assertEqual([res for res, _ in results[1:]], range(5))
+        threads = list(execu._threads)
+        execu.run([('host1', probe, ('host1', 0))])
+        self.assertEqual(execu._threads, threads)
+
+    def test_shared_slots(self):
+        """Test limits shared by the executors of several workers"""
+        probe = Probe()
+        slots = executor.HostSlots(max_parallel=3, max_per_host=2)
+        executors = [executor.Executor(max_parallel=4, max_per_host=2, slots=slots)
+                     for _ in range(3)]
+        results = {}
+
+        def run(idx):
+            results[idx] = executors[idx].run([('host%d' % (task % 2), probe,
+                                                ('host%d' % (task % 2), task))
+                                               for task in range(8)])
+
+        threads = [threading.Thread(target=run, args=(idx,)) for idx in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for idx in range(3):
+            self.assertEqual(results[idx], [(task, None) for task in range(8)])
+        self.assertLessEqual(probe.peak['all'], 3)
+        self.assertLessEqual(probe.peak['host0'], 2)
+        self.assertLessEqual(probe.peak['host1'], 2)
+        # All slots given back
+        pid = os.getpid()
+        self.assertTrue(slots.acquire('host0', pid) and slots.acquire('host0', pid))
+        self.assertFalse(slots.acquire('host0', pid))
+
+    def test_dead_holder(self):
+        """Test slots of a killed worker process taken back"""
+        manager = inv.InventoryManager()
+        manager.start()
+        try:
+            slots = manager.HostSlots(4, 1)
+            held = Event()
+
+            def hold():
+                slots.acquire('host0', os.getpid())
+                held.set()
+                time.sleep(60)
+
+            proc = Process(target=hold)
+            proc.start()
+            self.assertTrue(held.wait(5))
+            self.assertFalse(slots.acquire('host0', os.getpid()))
+            os.kill(proc.pid, signal.SIGKILL)
+            proc.join()
+            self.assertTrue(slots.acquire('host0', os.getpid()))
+            # A live holder keeps its slot
+            self.assertFalse(slots.acquire('host0', os.getpid()))
+        finally:
+            manager.shutdown()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Per-host fan-out testsuite'''
+
+import time
+import unittest
+import clustdock.fanout as fanout
+
+
+class FanOutTest(unittest.TestCase):
+
+    def test_parallel(self):
+        """Test that hosts are processed concurrently"""
+        hosts = ["host%d" % idx for idx in range(20)]
+        start = time.time()
+        results, errors = fanout.fan_out(lambda host: time.sleep(0.2) or host.upper(),
+                                         hosts, timeout=5)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(errors, {})
+        self.assertEqual(results, dict((host, host.upper()) for host in hosts))
+
+    def test_timeout_and_errors(self):
+        """Test partial results with per-host errors"""
+        def func(host):
+            if host == 'slow':
+                time.sleep(2)
+            elif host == 'broken':
+                raise RuntimeError("connexion refused")
+            return host
+
+        start = time.time()
+        results, errors = fanout.fan_out(func, ['ok', 'slow', 'broken'], timeout=0.3)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(results, {'ok': 'ok'})
+        self.assertEqual(sorted(errors), ['broken', 'slow'])
+        self.assertEqual(errors['broken'], "connexion refused")
+        self.assertIn("timeout", errors['slow'])
+
+    def test_bounded_threads(self):
+        """Test that stuck calls do not starve remaining hosts"""
+        def func(host):
+            if host.startswith('stuck'):
+                time.sleep(2)
+            return host
+
+        hosts = ['stuck1', 'stuck2', 'ok1', 'ok2']
+        results, errors = fanout.fan_out(func, hosts, timeout=0.2, max_threads=2)
+        self.assertEqual(sorted(results), ['ok1', 'ok2'])
+        self.assertEqual(sorted(errors), ['stuck1', 'stuck2'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Hook engine testsuite'''
+
+import os
+import shutil
+import time
+import unittest
+from tempfile import mkdtemp
+import mock
+import clustdock
+import clustdock.docker_node as dnode
+import clustdock.hooks as hooks
+import clustdock.server as server
+
+# Records its arguments and standard input, fails when given cn3
+HOOK = """#!/bin/sh
+sleep 0.3
+{ echo "$@"; case "$3" in *:*) cat;; esac; } >> "%(log)s"
+case "$1" in *cn3*|*-3]*) echo "cn3 rejected" >&2; exit 1;; esac
+"""
+
+
+class HooksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="clustdock-hooks-")
+        self.log = os.path.join(self.tmpdir, 'log')
+        self.hook = os.path.join(self.tmpdir, 'hook')
+        with open(self.hook, 'w') as hook:
+            hook.write(HOOK % {'log': self.log})
+        os.chmod(self.hook, 0o755)
+        self.nodes = [dnode.DockerNode("cn%d" % idx, 'test/example',
+                                       host="host%d" % (idx % 2))
+                      for idx in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def calls(self, nodes):
+        return [(self.hook, clustdock.DOCKER_NODE, node) for node in nodes]
+
+    def test_run_command_timeout(self):
+        """Test command and its children killed after the timeout"""
+        start = time.time()
+        rc, out, err = clustdock.run_command("sleep 5 | cat; echo done", timeout=0.2)
+        self.assertLess(time.time() - start, 2)
+        self.assertNotEqual(rc, 0)
+        self.assertEqual(out, "")
+        self.assertIn("killed after 0.2s", err)
+        self.assertEqual(clustdock.run_command("cat", timeout=5, stdin="in"),
+                         (0, "in", ""))
+
+    def test_from_profile(self):
+        """Test engine built from the profile keys"""
+        self.assertIsNone(hooks.HookEngine.from_profile({}))
+        self.assertIsNone(hooks.HookEngine.from_profile({'hook_mode': 'unknown'}))
+        engine = hooks.HookEngine.from_profile({'hook_mode': 'parallel',
+                                                'hook_timeout': '30',
+                                                'hook_max_parallel': '2'})
+        self.assertEqual((engine.mode, engine.timeout, engine.max_parallel),
+                         (hooks.HOOK_MODE_PARALLEL, '30', 2))
+
+    def test_batch(self):
+        """Test hook called once with the nodeset and the hosts of the nodes"""
+        engine = hooks.HookEngine(hooks.HOOK_MODE_BATCH)
+        results = engine.run(self.calls(self.nodes[:3]))
+        self.assertEqual(sorted(results), ['cn0', 'cn1', 'cn2'])
+        self.assertTrue(all(rc == 0 for rc, _, _ in results.values()))
+        with open(self.log) as log:
+            lines = log.read().splitlines()
+        self.assertEqual(lines[0].split(' ', 2)[:2], ['cn[0-2]', 'docker'])
+        self.assertEqual(sorted(lines[0].split(' ', 2)[2].split(' - ')),
+                         ['host0:cn[0,2]', 'host1:cn1'])
+        self.assertEqual(lines[1:], ["cn0 docker host0", "cn1 docker host1",
+                                     "cn2 docker host0"])
+        results = engine.run(self.calls(self.nodes))
+        self.assertEqual(set(results.values()), set([results['cn3']]))
+        self.assertEqual(results['cn3'][:2], (1, "cn3 rejected\n"))
+
+    def test_parallel(self):
+        """Test hook called once per node, with a concurrency cap and timings"""
+        engine = hooks.HookEngine(hooks.HOOK_MODE_PARALLEL, max_parallel=2)
+        start = time.time()
+        results = engine.run(self.calls(self.nodes))
+        self.assertGreaterEqual(time.time() - start, 0.6)
+        with open(self.log) as log:
+            self.assertEqual(sorted(log.read().splitlines()),
+                             ["cn%d docker host%d" % (idx, idx % 2) for idx in range(4)])
+        self.assertEqual(results['cn3'][:2], (1, "cn3 rejected\n"))
+        self.assertEqual([results['cn%d' % idx][0] for idx in range(3)], [0, 0, 0])
+        self.assertGreaterEqual(results['cn0'][2], 0.3)
+        engine.timeout = 0.1
+        self.assertIn("killed", engine.run(self.calls(self.nodes[:1]))['cn0'][1])
+
+    @mock.patch('clustdock.server.ClustdockWorker._get_cnx')
+    @mock.patch('clustdock.docker_node.DockerNode.start')
+    def test_start_with_hooks(self, start, _):
+        """Test spawn hooks run by the engine around the node starts"""
+        start.side_effect = lambda **kwargs: (0, 'OK')
+        worker = server.ClustdockWorker('inproc://test', 0, {}, ['host0', 'host1'], None)
+        for node in self.nodes:
+            node.after_start = self.hook
+        self.nodes[3].before_start = self.hook
+        job_id = worker.jobs.create('spawn', [node.name for node in self.nodes])
+        engine = hooks.HookEngine(hooks.HOOK_MODE_BATCH)
+        spawned = worker._start_with_hooks(job_id, self.nodes, engine, {})
+        self.assertEqual(sorted(spawned), ['cn0', 'cn1', 'cn2'])
+        self.assertEqual(start.call_count, 3)
+        with open(self.log) as log:
+            self.assertTrue(log.read().startswith("cn3 docker host1:cn3\n"
+                                                  "cn3 docker host1\n"
+                                                  "cn[0-2] docker "))
+        job = worker.jobs.get(job_id)
+        self.assertEqual(job['nodes']['cn3']['status'], 'failed')
+        self.assertIn("cn3 rejected", job['nodes']['cn3']['error'])
+        self.assertEqual(job['nodes']['cn0']['status'], 'done')
+        self.assertGreaterEqual(job['nodes']['cn0']['stages']['hooks'], 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
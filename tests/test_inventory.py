@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Node inventory testsuite'''
+
+import time
+import unittest
+import clustdock
+import clustdock.inventory as inv
+
+
+def node(name, host, status=inv.STATUS_RUNNING):
+    """Return node description"""
+    return {'name': name, 'host': host, 'status': status}
+
+
+class InventoryTest(unittest.TestCase):
+
+    def test_host_content(self):
+        """Test listing and lookup of nodes"""
+        inventory = inv.Inventory(ttl=60)
+        self.assertEqual(inventory.stale_hosts(['host1', 'host2']), ['host1', 'host2'])
+        inventory.set_host('host1', [node('cn0', 'host1'), node('cn1', 'host1', 5)])
+        inventory.set_host('host2', [node('vm0', 'host2')])
+        self.assertEqual(inventory.stale_hosts(['host1', 'host2']), [])
+        self.assertEqual(sorted(inventory.names()), ['cn0', 'cn1', 'vm0'])
+        self.assertEqual(sorted(inventory.lookup(['cn0', 'cn1', 'cn5'])), ['cn0', 'cn1'])
+        self.assertEqual(sorted(inventory.lookup(['cn0', 'cn1'], running=True)), ['cn0'])
+        nodes = inventory.nodes(['host1'], running=True)
+        self.assertEqual(nodes, {'host1': [node('cn0', 'host1')]})
+        # listing again a host replaces its content
+        inventory.set_host('host1', [node('cn2', 'host1')])
+        self.assertEqual(sorted(inventory.names()), ['cn2', 'vm0'])
+
+    def test_updates(self):
+        """Test spawned/stopped nodes and invalidation"""
+        inventory = inv.Inventory(ttl=60)
+        inventory.set_host('host1', [])
+        generation = inventory.generation()
+        inventory.add_nodes([node('cn0', 'host1'), node('cn1', 'host1')])
+        inventory.remove_nodes(['cn0'])
+        self.assertEqual(inventory.names(['host1']), ['cn1'])
+        self.assertGreater(inventory.generation(), generation)
+        self.assertTrue(inventory.is_fresh('host1'))
+        inventory.invalidate('host1')
+        self.assertFalse(inventory.is_fresh('host1'))
+
+    def test_ttl(self):
+        """Test expiration of host content"""
+        inventory = inv.Inventory(ttl=0.1)
+        inventory.set_host('host1', [node('cn0', 'host1')])
+        self.assertTrue(inventory.is_fresh('host1'))
+        time.sleep(0.15)
+        self.assertFalse(inventory.is_fresh('host1'))
+
+    def test_watch_lease(self):
+        """Test watched hosts fresh until their lease expires"""
+        inventory = inv.Inventory(ttl=0)
+        inventory.set_host('host1', [node('cn0', 'host1')])
+        inventory.watch('host1', clustdock.DOCKER_NODE, lease=0.1)
+        self.assertFalse(inventory.is_fresh('host1'))
+        inventory.watch('host1', clustdock.LIBVIRT_NODE, lease=0.1)
+        self.assertTrue(inventory.is_fresh('host1'))
+        generation = inventory.generation()
+        inventory.watch('host1', clustdock.LIBVIRT_NODE, lease=0.3)
+        self.assertEqual(inventory.generation(), generation)
+        time.sleep(0.15)
+        self.assertFalse(inventory.is_fresh('host1'))
+        inventory.watch('host1', clustdock.DOCKER_NODE, lease=0.1)
+        self.assertTrue(inventory.is_fresh('host1'))
+        inventory.watch('host1', clustdock.DOCKER_NODE, False)
+        self.assertFalse(inventory.is_fresh('host1'))
+
+    def test_shared(self):
+        """Test inventory shared through the manager"""
+        manager = inv.InventoryManager()
+        manager.start()
+        try:
+            inventory = manager.Inventory(60)
+            inventory.set_host('host1', [node('cn0', 'host1')])
+            self.assertEqual(inventory.lookup(['cn0']), {'cn0': node('cn0', 'host1')})
+            self.assertEqual(inventory.reserve('cn', 2), [1, 2])
+        finally:
+            manager.shutdown()
+
+    def test_index_set(self):
+        """Test indexes stored as intervals"""
+        indexes = inv.IndexSet([5, 0, 1, 3, 2])
+        self.assertEqual(list(indexes), [0, 1, 2, 3, 5])
+        self.assertEqual(indexes._starts, [0, 5])
+        self.assertEqual(indexes.lowest_free(3), [4, 6, 7])
+        indexes.add(4)
+        self.assertEqual(indexes._starts, [0])
+        indexes.discard(2)
+        indexes.discard(9)
+        self.assertNotIn(2, indexes)
+        self.assertEqual(len(indexes), 5)
+        self.assertEqual(indexes.lowest_free(2), [2, 6])
+        self.assertEqual(inv.IndexSet().lowest_free(2), [0, 1])
+
+    def test_reserve(self):
+        """Test lowest free indexes reserved until released"""
+        inventory = inv.Inventory(ttl=60)
+        inventory.set_host('host1', [node('cn0', 'host1'), node('cn2', 'host1')])
+        self.assertEqual(inventory.reserve('cn', 2), [1, 3])
+        self.assertEqual(inventory.reserve('cn', 1), [4])
+        # cn1 was spawned, cn3 failed
+        inventory.add_nodes([node('cn1', 'host1')])
+        inventory.release('cn', [1, 3])
+        self.assertEqual(inventory.reserve('cn', 2), [3, 5])
+        inventory.remove_nodes(['cn0'])
+        self.assertEqual(inventory.reserve('cn', 1), [0])
+        # reservations of dead workers expire
+        self.assertEqual(inventory.reserve('vm', 2, ttl=-1), [0, 1])
+        self.assertEqual(inventory.reserve('vm', 1), [0])
+
+    def test_reserve_padded_names(self):
+        """Test indexes of nodes with zero-padded names kept on release"""
+        inventory = inv.Inventory(ttl=60)
+        self.assertEqual(inventory.reserve('cn', 2), [0, 1])
+        # Node named by another tool while the spawn was running
+        inventory.add_nodes([node('cn01', 'host1')])
+        inventory.release('cn', [0, 1])
+        self.assertEqual(inventory.reserve('cn', 2), [0, 2])
+        inventory.add_nodes([node('cn1', 'host2')])
+        inventory.remove_nodes(['cn1'])
+        self.assertEqual(inventory.reserve('cn', 1), [3])
+        inventory.remove_nodes(['cn01'])
+        self.assertEqual(inventory.reserve('cn', 1), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
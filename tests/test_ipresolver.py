@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Bulk IP resolution testsuite'''
+
+import unittest
+import mock
+import libvirt
+import clustdock.ipresolver as ipresolver
+
+NEIGHBOURS = """192.168.122.10 dev virbr0 lladdr 52:54:00:00:00:00 REACHABLE
+fe80::5054:ff:fe00:1 dev virbr0 lladdr 52:54:00:00:00:01 STALE
+192.168.122.11 dev virbr0 lladdr 52:54:00:00:00:01 STALE
+192.168.122.99 dev virbr0  FAILED
+10.0.0.1 dev eth0 lladdr 00:1A:2B:3C:4D:5E router REACHABLE
+"""
+DOMAIN_XML = """<domain type="kvm">
+  <name>%s</name>
+  <devices>
+    <interface type="bridge">
+      <mac address="%s"/>
+      <source bridge="virbr0"/>
+    </interface>
+  </devices>
+</domain>
+"""
+
+
+class FakeDomain(object):
+
+    def __init__(self, name, mac, leases=None):
+        self._name = name
+        self.mac = mac
+        self.leases = leases or {}
+        self.sources = []
+
+    def name(self):
+        return self._name
+
+    def XMLDesc(self):
+        return DOMAIN_XML % (self._name, self.mac)
+
+    def interfaceAddresses(self, source):
+        self.sources.append(source)
+        if source not in self.leases:
+            raise libvirt.libvirtError("no address")
+        return {'vnet0': {'hwaddr': self.mac,
+                          'addrs': [{'addr': self.leases[source], 'prefix': 24}]}}
+
+
+class FakeConnexion(object):
+
+    def __init__(self, domains):
+        self.instance = mock.Mock()
+        self.instance.listAllDomains.return_value = domains
+
+
+class IPResolverTest(unittest.TestCase):
+
+    def test_parse_neighbours(self):
+        """Test parsing of the neighbour table"""
+        table = ipresolver.parse_neighbours(NEIGHBOURS)
+        self.assertEqual(table['52:54:00:00:00:01'],
+                         ['fe80::5054:ff:fe00:1', '192.168.122.11'])
+        self.assertEqual(table['00:1a:2b:3c:4d:5e'], ['10.0.0.1'])
+        self.assertEqual(len(table), 3)
+        self.assertEqual(ipresolver.choose_ip(table['52:54:00:00:00:01']),
+                         '192.168.122.11')
+
+    @mock.patch('clustdock.ipresolver.read_neighbours')
+    def test_resolve(self, read_neighbours):
+        """Test that the neighbour table is read once per host"""
+        read_neighbours.return_value = ipresolver.parse_neighbours(NEIGHBOURS)
+        lease = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE
+        agent = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_AGENT
+        domains = [
+            FakeDomain('vm0', '52:54:00:00:00:00'),
+            FakeDomain('vm1', '52:54:00:00:00:01'),
+            FakeDomain('vm2', '52:54:00:00:00:02', {agent: '192.168.122.12'}),
+            FakeDomain('vm3', '52:54:00:00:00:03'),
+            FakeDomain('other', '52:54:00:00:00:04'),
+        ]
+        cnx = FakeConnexion(domains)
+        ips = ipresolver.resolve(cnx, 'host1', ['vm0', 'vm1', 'vm2', 'vm3', 'vm4'])
+        self.assertEqual(ips, {'vm0': '192.168.122.10',
+                               'vm1': '192.168.122.11',
+                               'vm2': '192.168.122.12',
+                               'vm3': '',
+                               'vm4': ''})
+        read_neighbours.assert_called_once_with('host1')
+        self.assertEqual(cnx.instance.listAllDomains.call_count, 1)
+        self.assertEqual(domains[0].sources, [])
+        self.assertEqual(domains[2].sources, [lease, agent])
+        self.assertEqual(domains[3].sources, [lease, agent])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Job store testsuite'''
+
+import unittest
+import clustdock.jobs as jobs
+import clustdock.client as client
+
+
+class JobStoreTest(unittest.TestCase):
+
+    def test_job_progress(self):
+        """Test recording of per-node results"""
+        store = jobs.JobStore()
+        job_id = store.create('spawn', ['test0', 'test1', 'test2'])
+        self.assertEqual(store.get(job_id)['state'], jobs.JOB_RUNNING)
+        store.node_done(job_id, 'test0', True, elapsed=1.5)
+        store.node_done(job_id, 'test1', False, "Error: no space left", 2.0)
+        job = store.get(job_id)
+        self.assertEqual(client.job_summary(job), (1, 1, 1))
+        self.assertEqual(job['nodes']['test0']['elapsed'], 1.5)
+        self.assertEqual(job['errors'], ["Error: no space left"])
+        store.node_done(job_id, 'test2', True)
+        store.finish(job_id, 'test[0,2]')
+        job = store.get(job_id)
+        self.assertEqual(job['state'], jobs.JOB_DONE)
+        self.assertEqual(job['result'], 'test[0,2]')
+        self.assertIsNone(store.get('unknown'))
+
+    def test_purge(self):
+        """Test that finished jobs are forgotten after ttl"""
+        store = jobs.JobStore(ttl=-1)
+        first = store.create('stop', ['test0'], ["Error: node 'test1' does not exist"])
+        self.assertEqual(store.get(first)['errors'],
+                         ["Error: node 'test1' does not exist"])
+        store.finish(first, 'test0')
+        second = store.create('stop', ['test2'])
+        self.assertNotEqual(first, second)
+        self.assertIsNone(store.get(first))
+        self.assertIsNotNone(store.get(second))
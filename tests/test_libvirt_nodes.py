@@ -15,13 +15,15 @@
 '''Clustdock server testsuite'''
 
 import unittest
+import mock
 import clustdock
 import os
+import shutil
 import clustdock.libvirt_node as lnode
 import clustdock.server as server
 import libvirt
 from lxml import etree
-from tempfile import mktemp
+from tempfile import mkdtemp, mktemp
 
 
 class LibvirtNodeTest(unittest.TestCase):
@@ -175,6 +177,44 @@ class LibvirtNodeTest(unittest.TestCase):
         new_dom = node.build_xml(dom)
         self.assertEqual(new_dom, expected_dom)
 
+    def test_template_cache(self):
+        '''Test that base descriptions are parsed once and copied for each node'''
+        dom = """<domain type="kvm">
+  <name>base</name>
+  <uuid>81b20639-dba5-477e-a2da-07c88ad33f86</uuid>
+  <memory unit="KiB">9194496</memory>
+  <vcpu placement="static">8</vcpu>
+  <devices>
+    <disk type="file" device="disk">
+      <source file="/mnt/vms/base.img"/>
+    </disk>
+    <interface type="bridge">
+      <mac address="52:54:00:d1:e0:44"/>
+      <source bridge="br0"/>
+    </interface>
+  </devices>
+</domain>"""
+        template = lnode.get_template("base", dom)
+        self.assertIs(lnode.get_template("base", dom), template)
+        self.assertIsNot(lnode.get_template("base", dom.replace("8", "4")), template)
+        template = lnode.get_template("base", dom)
+        nodes = [lnode.LibvirtNode("vnode%d" % idx, "base", "/mnt/vms",
+                                   add_iface="brama%d" % idx, mem=1024 * idx, cpu=idx)
+                 for idx in range(1, 3)]
+        descs = [etree.fromstring(node.build_xml(dom)) for node in nodes]
+        self.assertIs(lnode.get_template("base", dom), template)
+        for idx, desc in enumerate(descs, 1):
+            self.assertEqual(desc.findtext("name"), "vnode%d" % idx)
+            self.assertEqual(desc.find("devices/disk/source").get("file"),
+                             "/mnt/vms/vnode%d.qcow2" % idx)
+            self.assertEqual([iface.get("bridge") for iface in desc.iterfind(
+                "devices/interface/source")], ["br0", "brama%d" % idx])
+            self.assertEqual(desc.findtext("memory"), str(1024 * idx))
+            self.assertEqual(desc.findtext("vcpu"), str(idx))
+            self.assertIsNone(desc.find("uuid"))
+            self.assertIsNone(desc.find("devices/interface/mac"))
+        self.assertEqual(nodes[0].baseimg_path, "/mnt/vms/base.img")
+
     def test_set_memory(self):
         '''Test the memory setting'''
 
@@ -263,6 +303,7 @@ class LibvirtNodeTest(unittest.TestCase):
                     'before_start': None,
                     'after_start': None,
                     'after_end': None,
+                    'hook_timeout': None,
                     'cpu': None,
                     'host': 'localhost',
                     'idx': 0,
@@ -272,6 +313,9 @@ class LibvirtNodeTest(unittest.TestCase):
                     'mem': None,
                     'name': 'vnode0',
                     'add_iface': None,
+                    'hostname': 'virt-customize',
+                    'disk_ready': False,
+                    'timings': {},
                     'status': libvirt.VIR_DOMAIN_NOSTATE
                     }
         self.assertDictEqual(expected, node_desc)
@@ -310,6 +354,99 @@ echo -n "$1 $2 $3"
             except OSError:
                 pass
 
+    @mock.patch('clustdock.libvirt_node.get_connexion')
+    @mock.patch('clustdock.provision.create_overlays')
+    @mock.patch('clustdock.libvirt_node.LibvirtNode.base_description')
+    def test_provision_disks(self, base_description, create_overlays, get_connexion):
+        """Test that disks of a spawn are created in one stage"""
+        base_description.return_value = """<domain><name>base</name><devices>
+<disk><source file="/mnt/vms/base.img"/></disk></devices></domain>"""
+        create_overlays.side_effect = lambda disks: dict(
+            (path, "no space left" if 'vnode1' in path else None) for _, path in disks)
+        vnode3 = mock.Mock()
+        vnode3.name.return_value = 'vnode3'
+        get_connexion.return_value.instance.listAllDomains.return_value = [vnode3]
+        worker = server.ClustdockWorker('inproc://test', 0, {}, ['localhost'], None)
+        nodes = [lnode.LibvirtNode("vnode%d" % idx, "base", "/nonexistent")
+                 for idx in range(4)]
+        job_id = worker.jobs.create('spawn', [node.name for node in nodes])
+        ready = worker._provision_disks(job_id, nodes)
+        self.assertEqual([node.name for node in ready], ['vnode0', 'vnode2'])
+        self.assertEqual(base_description.call_count, 1)
+        # No disk for the domain which already exists
+        create_overlays.assert_called_once_with(
+            [('/mnt/vms/base.img', '/nonexistent/vnode%d.qcow2' % idx)
+             for idx in range(3)])
+        self.assertTrue(ready[0].disk_ready)
+        self.assertIn('disk', ready[0].timings)
+        job = worker.jobs.get(job_id)
+        self.assertEqual(job['nodes']['vnode1']['status'], 'failed')
+        self.assertEqual(job['nodes']['vnode3']['status'], 'failed')
+        self.assertTrue(any("no space left" in err for err in job['errors']))
+        self.assertTrue(any("'vnode3' already exists" in err for err in job['errors']))
+
+    @mock.patch('clustdock.libvirt_node.get_connexion')
+    @mock.patch('clustdock.provision.create_overlays')
+    @mock.patch('clustdock.libvirt_node.LibvirtNode.base_description')
+    def test_provision_orphaned_disk(self, base_description, create_overlays,
+                                     get_connexion):
+        """Test that a disk left by a failed spawn is overwritten"""
+        base_description.return_value = """<domain><name>base</name><devices>
+<disk><source file="/mnt/vms/base.img"/></disk></devices></domain>"""
+        create_overlays.side_effect = lambda disks: dict((path, None)
+                                                         for _, path in disks)
+        get_connexion.return_value.instance.listAllDomains.return_value = []
+        storage_dir = mkdtemp(prefix="clustdock-disks-")
+        self.addCleanup(shutil.rmtree, storage_dir)
+        orphan = os.path.join(storage_dir, 'vnode0.qcow2')
+        open(orphan, 'w').close()
+        worker = server.ClustdockWorker('inproc://test', 0, {}, ['localhost'], None)
+        node = lnode.LibvirtNode("vnode0", "base", storage_dir)
+        job_id = worker.jobs.create('spawn', [node.name])
+        self.assertEqual(worker._provision_disks(job_id, [node]), [node])
+        create_overlays.assert_called_once_with([('/mnt/vms/base.img', orphan)])
+
+    @mock.patch('clustdock.libvirt_node.LibvirtNode.remove_disk')
+    @mock.patch('clustdock.libvirt_node.LibvirtNode.base_description')
+    def test_start_existing_domain(self, base_description, remove_disk):
+        """Test that the provisioned disk of a domain defined meanwhile is removed"""
+        base_description.return_value = "<domain><name>base</name></domain>"
+        cnx = mock.Mock()
+        cnx.instance.listDefinedDomains.return_value = ['vnode0']
+        node = lnode.LibvirtNode("vnode0", "base", "/nonexistent")
+        self.assertEqual(node.start(fork=False, cnx=cnx)[0], 1)
+        self.assertFalse(remove_disk.called)
+        node.disk_ready = True
+        self.assertEqual(node.start(fork=False, cnx=cnx)[0], 1)
+        remove_disk.assert_called_once_with()
+        self.assertFalse(cnx.instance.defineXML.called)
+
+
+class ConnexionPoolTest(unittest.TestCase):
+
+    @mock.patch('clustdock.libvirt_node.libvirt.virEventRunDefaultImpl')
+    @mock.patch('clustdock.libvirt_node.libvirt.virEventRegisterDefaultImpl')
+    @mock.patch('clustdock.libvirt_node.libvirt.open')
+    def test_pool(self, libvirt_open, register, run_loop):
+        """Test that connexions are shared, kept alive and reopened when dead"""
+        libvirt_open.side_effect = lambda uri: mock.Mock(uri=uri)
+        pool = lnode.ConnexionPool()
+        cnx = pool.get('host1')
+        self.assertIs(pool.get('host1'), cnx)
+        self.assertEqual(register.call_count, 1)
+        self.assertEqual(libvirt_open.call_count, 1)
+        first = cnx.instance
+        self.assertEqual(first.uri, 'qemu+ssh://host1/system')
+        first.setKeepAlive.assert_called_once_with(lnode.KEEPALIVE_INTERVAL,
+                                                   lnode.KEEPALIVE_COUNT)
+        first.isAlive.return_value = False
+        self.assertIsNot(cnx.instance, first)
+        self.assertEqual(libvirt_open.call_count, 2)
+        first.close.assert_called_once_with()
+        self.assertIsNone(pool.get('localhost').instance.uri)
+        pool.close()
+        self.assertIsNone(cnx.cnx)
+
 
 if __name__ == "__main__":
     unittest.main()
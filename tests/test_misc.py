@@ -77,16 +77,6 @@ hosts = "localhost", "host[2-4]"
         result = server.extract_hosts(hosts)
         self.assertEquals(sorted(list(result)), ["host2", "host3", "host4", "localhost"])
 
-    def test_choose_host(self):
-        """Test choose host"""
-        host_choice = server._choose_host(None)
-        self.assertEquals(host_choice, None)
-        host_choice = server._choose_host([])
-        self.assertEquals(host_choice, None)
-        hosts = "localhost, host[2-4]"
-        result = server.extract_hosts(hosts)
-        self.assertEquals(sorted(list(result)), ["host2", "host3", "host4", "localhost"])
-
 
 if __name__ == "__main__":
     unittest.main()
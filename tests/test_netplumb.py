@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Interface plumbing testsuite'''
+
+import os
+import shutil
+import threading
+import time
+import unittest
+from tempfile import mkdtemp
+import clustdock.netplumb as netplumb
+
+# Log commands with their batch input, fail batches enslaving to 'badbr'
+FAKE_IP = """#!/bin/sh
+input=""
+if [ "$1" = "-batch" ]; then input=$(tr "\\n" ";"); fi
+echo "ip $* $input" >> "$FAKE_LOG"
+case "$input" in *badbr*) echo "cannot enslave" >&2; exit 1;; esac
+"""
+FAKE_NSENTER = """#!/bin/sh
+echo "nsenter $1 $2 $3" >> "$FAKE_LOG"
+shift 3
+exec "$@"
+"""
+
+
+class NetplumbTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="clustdock-netplumb-")
+        for name, content in (('ip', FAKE_IP), ('nsenter', FAKE_NSENTER)):
+            fake = os.path.join(self.tmpdir, name)
+            with open(fake, 'w') as fake_file:
+                fake_file.write(content)
+            os.chmod(fake, 0o755)
+        self.log = os.path.join(self.tmpdir, 'log')
+        self.environ = os.environ.copy()
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, os.environ['PATH'])
+        os.environ['FAKE_LOG'] = self.log
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def commands(self):
+        with open(self.log) as log:
+            return log.read().splitlines()
+
+    def test_plumb(self):
+        """Test interfaces of several containers plumbed in one transaction"""
+        links = [netplumb.new_link(100, 'br0', 'eth1'),
+                 netplumb.new_link(100, 'br1', 'eth2'),
+                 netplumb.new_link(200, 'br0', 'eth1')]
+        self.assertEqual(links[0], ('100', 'br0', 'eth1', 'veth1pl100'))
+        self.assertEqual(netplumb.plumb('localhost', links), (0, ''))
+        self.assertEqual(self.commands(), [
+            "ip -batch - link add veth1pl100 type veth peer name eth1 netns 100;"
+            "link set veth1pl100 master br0 up;"
+            "link add veth2pl100 type veth peer name eth2 netns 100;"
+            "link set veth2pl100 master br1 up;"
+            "link add veth1pl200 type veth peer name eth1 netns 200;"
+            "link set veth1pl200 master br0 up;",
+            "nsenter -t 100 -n",
+            "ip -batch - link set eth1 up;link set eth2 up;",
+            "nsenter -t 200 -n",
+            "ip -batch - link set eth1 up;"])
+
+    def test_rollback(self):
+        """Test host side interfaces removed when the transaction fails"""
+        links = [netplumb.new_link(100, 'br0', 'eth1'),
+                 netplumb.new_link(100, 'badbr', 'eth2')]
+        rc, err = netplumb.plumb('localhost', links)
+        self.assertEqual((rc, err), (1, "cannot enslave\n"))
+        commands = self.commands()
+        self.assertEqual(commands[1:], ["ip link del veth1pl100 ",
+                                        "ip link del veth2pl100 "])
+
+    def test_batcher(self):
+        """Test links of concurrent containers gathered, failures isolated"""
+        calls = []
+
+        def run(host, links):
+            calls.append((host, [link.pid for link in links]))
+            if '2' in [link.pid for link in links]:
+                return (1, "error")
+            return (0, "")
+
+        batcher = netplumb.Batcher(max_wait=5, run=run)
+        tickets = dict((pid, batcher.announce('host1')) for pid in range(4))
+        results = {}
+
+        def submit(pid):
+            time.sleep(0.1 * pid)
+            links = [netplumb.new_link(pid, 'br0', 'eth1')]
+            results[pid] = batcher.submit('host1', links, tickets[pid])
+
+        threads = [threading.Thread(target=submit, args=(pid,)) for pid in range(3)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        # Container 3 failed before plumbing
+        time.sleep(0.3)
+        batcher.withdraw(tickets[3])
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(sorted(calls[0][1]), ['0', '1', '2'])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(results, {0: (0, ""), 1: (0, ""), 2: (1, "error")})
+
+    def test_batcher_max_wait(self):
+        """Test a batch not delayed by a start which never submits"""
+        calls = []
+        batcher = netplumb.Batcher(max_wait=0.2,
+                                   run=lambda host, links: calls.append(links) or (0, ""))
+        batcher.announce('host1')
+        self.assertEqual(batcher.submit('host1', [netplumb.new_link(0, 'br0', 'eth1')]),
+                         (0, ""))
+        self.assertEqual(len(calls), 1)
+        # Unannounced starts do not wait
+        start = time.time()
+        batcher = netplumb.Batcher(max_wait=5, run=lambda host, links: (0, ""))
+        batcher.submit('host1', [netplumb.new_link(0, 'br0', 'eth1')])
+        self.assertLess(time.time() - start, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Node provisioning testsuite'''
+
+import os
+import shutil
+import stat
+import time
+import unittest
+from tempfile import mkdtemp
+from lxml import etree
+import clustdock.provision as provision
+
+# Records its arguments in the overlay, fails for overlays named 'bad*'
+FAKE_QEMU_IMG = """#!/bin/sh
+for path; do :; done
+case "$(basename $path)" in bad*) echo "cannot create $path" >&2; exit 1;; esac
+echo "$@" > $path
+"""
+
+
+class ProvisionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="clustdock-provision-")
+        fake = os.path.join(self.tmpdir, 'qemu-img')
+        with open(fake, 'w') as fake_file:
+            fake_file.write(FAKE_QEMU_IMG)
+        os.chmod(fake, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, self.path)
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def test_create_overlays(self):
+        """Test creation of several overlays, failures are reported by disk"""
+        disks = [('/mnt/vms/base.img', os.path.join(self.tmpdir, name))
+                 for name in ('vm0.qcow2', 'bad.qcow2', 'vm1.qcow2')]
+        results = provision.create_overlays(disks, max_parallel=2)
+        self.assertIsNone(results[disks[0][1]])
+        self.assertIsNone(results[disks[2][1]])
+        self.assertIn("cannot create", results[disks[1][1]])
+        with open(disks[0][1]) as overlay:
+            self.assertEqual(overlay.read().split(),
+                             ['create', '-q', '-f', 'qcow2', '-b', '/mnt/vms/base.img',
+                              disks[0][1]])
+        mode = os.stat(disks[2][1]).st_mode
+        self.assertTrue(mode & stat.S_IWOTH)
+
+    def test_create_overlays_no_qemu_img(self):
+        """Test overlays failing when qemu-img cannot be run"""
+        os.environ['PATH'] = '/nonexistent'
+        disks = [('/mnt/vms/base.img', os.path.join(self.tmpdir, name))
+                 for name in ('vm0.qcow2', 'vm1.qcow2')]
+        results = provision.create_overlays(disks)
+        self.assertEqual(sorted(results), sorted(path for _, path in disks))
+        self.assertTrue(all("No such file" in err for err in results.values()))
+
+    def test_set_hostname(self):
+        """Test hostname given through SMBIOS data"""
+        tree = etree.fromstring("<domain><name>vm0</name>"
+                                "<os><type>hvm</type></os></domain>")
+        provision.set_hostname(tree, 'vm0')
+        provision.set_hostname(tree, 'vm0')
+        self.assertEqual(len(tree.findall('sysinfo')), 1)
+        self.assertEqual(tree.find('sysinfo').get('type'), 'smbios')
+        self.assertEqual(tree.findtext("sysinfo/system/entry[@name='serial']"),
+                         'ds=nocloud;h=vm0;i=vm0')
+        self.assertEqual(tree.find('os/smbios').get('mode'), 'sysinfo')
+        self.assertEqual(tree.findtext('os/type'), 'hvm')
+
+    def test_timed(self):
+        """Test timings of stages"""
+        timings = {}
+        with provision.timed(timings, 'disk'):
+            time.sleep(0.05)
+        with self.assertRaises(RuntimeError):
+            with provision.timed(timings, 'boot'):
+                raise RuntimeError()
+        self.assertGreaterEqual(timings['disk'], 0.05)
+        self.assertIn('boot', timings)
+        self.assertEqual(provision.format_timings({'disk': 0.25, 'boot': 1}),
+                         "boot 1.0s, disk 0.2s")
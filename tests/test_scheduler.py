@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Node placement testsuite'''
+
+import unittest
+import mock
+from lxml import etree
+import clustdock.docker_node as dnode
+import clustdock.libvirt_node as lnode
+import clustdock.scheduler as scheduler
+import clustdock.server as server
+
+
+def _hosts():
+    return [scheduler.HostResources('host1', 16, 32768, 2),
+            scheduler.HostResources('host2', 8, 16384, 0)]
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def test_spread(self):
+        """Test nodes spread on the hosts with the fewest nodes"""
+        hosts = scheduler.place([(2, 4096)] * 4, _hosts(), scheduler.POLICY_SPREAD)
+        self.assertEqual(hosts, ['host2', 'host2', 'host1', 'host2'])
+
+    def test_pack(self):
+        """Test nodes packed on the host with the least memory left"""
+        resources = _hosts()
+        hosts = scheduler.place([(2, 4096)] * 5, resources, scheduler.POLICY_PACK)
+        self.assertEqual(hosts, ['host2'] * 4 + ['host1'])
+        self.assertEqual((resources[1].cpus, resources[1].mem, resources[1].nodes),
+                         (0, 0, 4))
+
+    def test_split(self):
+        """Test cluster too large for one host split between hosts, largest first"""
+        hosts = scheduler.place([(1, 1024), (8, 20000), (8, 16000)], _hosts(),
+                                scheduler.POLICY_PACK)
+        self.assertEqual(hosts, ['host1', 'host1', 'host2'])
+        self.assertRaises(scheduler.NoCapacity, scheduler.place, [(4, 40000)], _hosts())
+
+    def test_probe_libvirt(self):
+        """Test free resources of a libvirt host"""
+        cnx = mock.Mock()
+        cnx.instance.getInfo.return_value = ['x86_64', 65536, 32, 2400, 1, 2, 8, 2]
+        cnx.instance.getFreeMemory.return_value = 60000 * scheduler.MIB
+        running = mock.Mock(**{'isActive.return_value': True,
+                               'info.return_value': [1, 8388608, 8388608, 4, 0]})
+        stopped = mock.Mock(**{'isActive.return_value': False})
+        cnx.instance.listAllDomains.return_value = [running, stopped]
+        res = scheduler.probe_libvirt(cnx, 'host1', cpu_overcommit=1)
+        self.assertEqual((res.host, res.cpus, res.mem, res.nodes),
+                         ('host1', 28, 57344, 1))
+        res = scheduler.probe_libvirt(cnx, 'host1')
+        self.assertEqual(res.cpus, 32 * scheduler.CPU_OVERCOMMIT - 4)
+
+    def test_overcommitted_host(self):
+        """Test vcpus of running domains beyond the host cpus"""
+        cnx = mock.Mock()
+        cnx.instance.getInfo.return_value = ['x86_64', 65536, 8, 2400, 1, 1, 8, 1]
+        cnx.instance.getFreeMemory.return_value = 30000 * scheduler.MIB
+        running = mock.Mock(**{'isActive.return_value': True,
+                               'info.return_value': [1, 4194304, 4194304, 4, 0]})
+        cnx.instance.listAllDomains.return_value = [running] * 5
+        res = scheduler.probe_libvirt(cnx, 'host1')
+        self.assertEqual(scheduler.place([(2, 1024)], [res]), ['host1'])
+        res = scheduler.probe_libvirt(cnx, 'host1', cpu_overcommit='1.0')
+        self.assertEqual(res.cpus, -12)
+        self.assertRaises(scheduler.NoCapacity, scheduler.place, [(2, 1024)], [res])
+
+    def test_node_request(self):
+        """Test resources needed by libvirt and docker nodes"""
+        tree = etree.fromstring("<domain><memory unit='GiB'>2</memory>"
+                                "<vcpu>2</vcpu></domain>")
+        node = lnode.LibvirtNode("vnode0", "base", "/nonexistent", mem=4096)
+        self.assertEqual(scheduler.node_request(node, tree), (2, 4096))
+        self.assertEqual(scheduler.node_request(node), (1, 4096))
+        node = dnode.DockerNode("cnode0", "test/example",
+                                docker_opts="--memory 512m --cpuset-cpus 0-2,5")
+        self.assertEqual(scheduler.node_request(node), (4, 512))
+
+    @mock.patch('clustdock.server.ClustdockWorker._probe_host')
+    def test_place_nodes(self, probe_host):
+        """Test spawn without host placing nodes on managed hosts"""
+        probe_host.side_effect = lambda vtype, host, overcommit: dict(
+            (res.host, res) for res in _hosts())[host]
+        profiles = {'prof': {'vtype': 'docker', 'img': 'test/example',
+                             'docker_opts': '-m 8g', 'placement': 'pack'}}
+        worker = server.ClustdockWorker('inproc://test', 0, profiles, ['host1', 'host2'],
+                                        None)
+        nodes = [dnode.DockerNode("cnode%d" % idx, "test/example", docker_opts='-m 8g')
+                 for idx in range(5)]
+        errors = []
+        self.assertTrue(worker.place_nodes('prof', nodes, errors))
+        self.assertEqual([node.host for node in nodes], ['host2'] * 2 + ['host1'] * 3)
+        self.assertFalse(worker.place_nodes('prof', nodes + nodes, errors))
+        self.assertIn("cannot place", errors[0])
+
+    @mock.patch('clustdock.server.ClustdockWorker.refresh_inventory')
+    @mock.patch('clustdock.server.ClustdockWorker._probe_host')
+    def test_spawn_hosts(self, probe_host, refresh_inventory):
+        """Test spawn on a nodeset of hosts"""
+        probe_host.side_effect = lambda vtype, host, overcommit: dict(
+            (res.host, res) for res in _hosts())[host]
+        profiles = {'prof': {'vtype': 'docker', 'img': 'test/example',
+                             'docker_opts': '-m 8g'}}
+        worker = server.ClustdockWorker('inproc://test', 0, profiles,
+                                        server.extract_hosts('host[1-3]'), None)
+        errors = []
+        nodes = worker.select_nodes('prof', 'test', 4, 'host[1-2]', errors)
+        self.assertEqual(errors, [])
+        self.assertEqual([node.host for node in nodes],
+                         ['host2', 'host2', 'host1', 'host1'])
+        self.assertEqual(sorted(call[0][1] for call in probe_host.call_args_list),
+                         ['host1', 'host2'])
+        nodes = worker.select_nodes('prof', 'test', 2, 'host3', errors)
+        self.assertEqual([node.host for node in nodes], ['host3', 'host3'])
+        self.assertEqual(probe_host.call_count, 2)
+        self.assertNotIn('host', profiles['prof'])
+        self.assertEqual(worker.cmd_spawn('prof', 'test', 1, 'host[3-4]', False),
+                         ('', ["Error: host 'host4' is not managed"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
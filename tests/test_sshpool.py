@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''ssh session pool testsuite'''
+
+import os
+import shutil
+import unittest
+from tempfile import mkdtemp
+import clustdock.sshpool as sshpool
+
+# Runs the command locally, the control socket stands for the master session
+FAKE_SSH = """#!/bin/sh
+echo "$@" >> "$FAKE_SSH_LOG"
+while [ $# -gt 0 ]; do
+  case "$1" in
+    -o) case "$2" in ControlPath=*) ctl="${2#ControlPath=}";; esac; shift 2;;
+    -O) op="$2"; shift 2;;
+    -T) shift;;
+    *) break;;
+  esac
+done
+sock=$(echo "$ctl" | sed "s/%h/$1/")
+if [ "$op" = exit ]; then rm -f "$sock"; exit 0; fi
+touch "$sock"
+exec sh -c "$2"
+"""
+
+
+class SSHPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="clustdock-sshpool-")
+        fake = os.path.join(self.tmpdir, 'ssh')
+        with open(fake, 'w') as fake_file:
+            fake_file.write(FAKE_SSH)
+        os.chmod(fake, 0o755)
+        self.log = os.path.join(self.tmpdir, 'ssh.log')
+        self.environ = os.environ.copy()
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, os.environ['PATH'])
+        os.environ['FAKE_SSH_LOG'] = self.log
+        self.pool = sshpool.SSHPool(os.path.join(self.tmpdir, 'control'), 60)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def ssh_calls(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as log:
+            return log.read().splitlines()
+
+    def test_run(self):
+        """Test commands sharing the master session of a host"""
+        self.assertEqual(self.pool.run('host1', 'echo one; echo two >&2'),
+                         (0, "one\n", "two\n"))
+        self.assertEqual(self.pool.run('host1', 'cat; exit 3', stdin="data"),
+                         (3, "data", ""))
+        calls = self.ssh_calls()
+        self.assertEqual(len(calls), 2)
+        self.assertIn("ControlMaster=auto", calls[0])
+        self.assertIn("ControlPersist=60", calls[0])
+        stats = self.pool.stats['host1']
+        self.assertEqual((stats['commands'], stats['reused']), (2, 1))
+        self.assertIn("host1: 2 commands, 1 reused sessions", self.pool.report())
+
+    def test_localhost(self):
+        """Test commands on localhost run without ssh"""
+        self.assertEqual(self.pool.run('localhost', 'echo local'), (0, "local\n", ""))
+        self.assertEqual(self.ssh_calls(), [])
+        self.assertEqual(self.pool.stats, {})
+
+    def test_close(self):
+        """Test master sessions closed"""
+        self.pool.run('host1', 'true')
+        self.pool.run('host2', 'true')
+        self.assertTrue(os.path.exists(self.pool.control_path('host2')))
+        self.pool.close()
+        self.assertEqual(os.listdir(self.pool.control_dir), [])
+        self.assertIn("-O exit host1", self.ssh_calls()[2])
+
+    def test_configure(self):
+        """Test pool of the process and ssh command given to hooks"""
+        pool = sshpool.configure(self.pool.control_dir, 30)
+        try:
+            self.assertIs(sshpool.POOL, pool)
+            self.assertIn("ControlPersist=30", os.environ[sshpool.HOOK_ENV])
+            self.assertEqual(sshpool.run('host1', 'echo ok'), (0, "ok\n", ""))
+        finally:
+            sshpool.POOL = sshpool.SSHPool()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''Warm pool testsuite'''
+
+import os
+import shutil
+import time
+import unittest
+from tempfile import mkdtemp
+import mock
+import clustdock.warmpool as warmpool
+from tests.fake_docker_engine import FakeDockerEngine
+from tests.test_provision import FAKE_QEMU_IMG
+
+
+class WarmPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix="clustdock-warmpool-")
+        fake = os.path.join(self.tmpdir, 'qemu-img')
+        with open(fake, 'w') as fake_file:
+            fake_file.write(FAKE_QEMU_IMG)
+        os.chmod(fake, 0o755)
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = "%s:%s" % (self.tmpdir, self.path)
+        self.storage_dir = os.path.join(self.tmpdir, 'vms')
+        os.mkdir(self.storage_dir)
+        self.baseimg = os.path.join(self.tmpdir, 'base.img')
+        open(self.baseimg, 'w').close()
+        self.profiles = {
+            'vms': {'vtype': 'libvirt', 'base_domain': 'base', 'warm_pool': 3,
+                    'storage_dir': self.storage_dir},
+            'cold': {'vtype': 'libvirt', 'base_domain': 'base',
+                     'storage_dir': self.storage_dir},
+        }
+        self.pool = warmpool.WarmPool(self.profiles, ['localhost'])
+        template = mock.Mock(baseimg_path=self.baseimg)
+        self.patches = [mock.patch('clustdock.libvirt_node.get_connexion'),
+                        mock.patch('clustdock.libvirt_node.get_template',
+                                   return_value=template)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.tmpdir)
+
+    def test_enabled(self):
+        """Test warm pool enabled only if a profile has a size"""
+        self.assertTrue(warmpool.WarmPool.enabled(self.profiles))
+        self.assertFalse(warmpool.WarmPool.enabled({'cold': self.profiles['cold']}))
+
+    def test_refill_and_claim(self):
+        """Test overlays created up to the pool size and claimed by nodes"""
+        self.pool.refill()
+        key = warmpool.pool_key(self.baseimg)
+        self.assertEqual(len(warmpool.warm_files(self.storage_dir, key)), 3)
+        self.assertEqual(self.pool.refill_libvirt('vms', 'base', self.storage_dir, 3), 0)
+        paths = [os.path.join(self.storage_dir, "vm%d.qcow2" % idx) for idx in range(4)]
+        claimed = warmpool.claim(self.baseimg, self.storage_dir, paths)
+        self.assertEqual(claimed, set(paths[:3]))
+        for path in paths[:3]:
+            with open(path) as overlay:
+                self.assertIn(self.baseimg, overlay.read().split())
+        self.assertEqual(warmpool.warm_files(self.storage_dir), [])
+        self.assertEqual(self.pool.refill_libvirt('vms', 'base', self.storage_dir, 3), 3)
+
+    def test_stale_overlays(self):
+        """Test overlays of a modified base image are replaced"""
+        self.pool.refill()
+        old = warmpool.warm_files(self.storage_dir)
+        left = os.path.join(self.storage_dir, warmpool.TMP_PREFIX + 'left.qcow2')
+        open(left, 'w').close()
+        mtime = time.time() + 10
+        os.utime(self.baseimg, (mtime, mtime))
+        self.assertEqual(warmpool.claim(self.baseimg, self.storage_dir, ['vm0.qcow2']),
+                         set())
+        self.pool.refill()
+        new = warmpool.warm_files(self.storage_dir)
+        self.assertEqual(len(new), 3)
+        self.assertFalse(set(old) & set(new))
+        self.assertEqual(sorted(os.listdir(self.storage_dir)),
+                         [os.path.basename(path) for path in new])
+
+    def test_shared_storage_dir(self):
+        """Test profiles sharing a storage directory keep their pools"""
+        other = os.path.join(self.tmpdir, 'other.img')
+        open(other, 'w').close()
+        images = {'base': self.baseimg, 'other': other}
+        patch = mock.patch('clustdock.libvirt_node.get_template',
+                                 side_effect=lambda domain, desc:
+                                 mock.Mock(baseimg_path=images[domain]))
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.profiles['others'] = {'vtype': 'libvirt', 'base_domain': 'other',
+                                   'warm_pool': 2, 'storage_dir': self.storage_dir}
+        self.pool.refill()
+        self.pool.refill()
+        self.assertEqual(len(warmpool.warm_files(self.storage_dir,
+                                                 warmpool.pool_key(self.baseimg))), 3)
+        self.assertEqual(len(warmpool.warm_files(self.storage_dir,
+                                                 warmpool.pool_key(other))), 2)
+        # Overlays of a base image no profile uses anymore are removed
+        del self.profiles['others']
+        self.pool.refill()
+        self.assertEqual(len(warmpool.warm_files(self.storage_dir)), 3)
+
+    def test_refill_docker(self):
+        """Test image pulled on hosts where it is missing"""
+        engine = FakeDockerEngine().start()
+        try:
+            port = int(engine.url.rsplit(':', 1)[1])
+            pool = warmpool.WarmPool({}, ['127.0.0.1'], port)
+            pool.refill_docker('containers', 'test/example')
+            self.assertIn('test/example:latest', engine.images)
+            del engine.requests[:]
+            pool.refill_docker('containers', 'test/example')
+            self.assertIn(('GET', '/images/test/example/json'), engine.requests)
+            self.assertNotIn(('POST', '/images/create'), engine.requests)
+        finally:
+            engine.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+###############################################################################
+# Author : Antoine Sax <antoine.sax@bull.net>
+# Contributors :
+###############################################################################
+# Copyright (C) 2018 Bull S.A.S.  -  All rights reserved
+# Bull
+# Rue Jean Jaurès
+# B.P. 68
+# 78340 Les Clayes-sous-Bois
+# This is not Free or Open Source software.
+# Please contact Bull S. A. S. for details about its license.
+###############################################################################
+'''State watcher testsuite'''
+
+import time
+import threading
+import unittest
+import clustdock
+import clustdock.docker_api as docker_api
+import clustdock.docker_node as dnode
+import clustdock.inventory as inv
+import clustdock.watcher as watcher
+from tests.fake_docker_engine import FakeDockerEngine
+
+
+class StateWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = FakeDockerEngine().start()
+        self.engine.images.add('test/example')
+        self.port = int(self.engine.url.rsplit(':', 1)[1])
+        self.client = docker_api.DockerClient(self.engine.url)
+
+    def tearDown(self):
+        self.client.close()
+        self.engine.stop()
+
+    def wait_for(self, func, timeout=5):
+        """Wait until func returns True"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if func():
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_docker_events(self):
+        """Test inventory updates from docker events"""
+        self.client.create('cn0', docker_api.build_config('test/example', 'cn0'))
+        inventory = inv.Inventory(ttl=0)
+        state = watcher.StateWatcher(['127.0.0.1'], inventory, self.port)
+        thread = threading.Thread(target=state._watch_docker, args=('127.0.0.1',))
+        thread.daemon = True
+        thread.start()
+        # initial listing
+        self.assertTrue(self.wait_for(lambda: inventory.names() == ['cn0']))
+        inventory.watch('127.0.0.1', clustdock.LIBVIRT_NODE)
+        self.assertTrue(inventory.is_fresh('127.0.0.1'))
+
+        self.client.start('cn0')
+        self.assertTrue(self.wait_for(
+            lambda: inventory.lookup(['cn0'], running=True).keys() == ['cn0']))
+        self.assertEqual(inventory.lookup(['cn0'])['cn0']['ips'], ['172.17.0.2'])
+        self.client.create('cn1', docker_api.build_config('test/example', 'cn1'))
+        self.assertTrue(self.wait_for(lambda: sorted(inventory.names()) ==
+                                      ['cn0', 'cn1']))
+        self.assertEqual(inventory.lookup(['cn1'])['cn1']['status'],
+                         dnode.STATUS['created'])
+        self.client.remove('cn0')
+        self.assertTrue(self.wait_for(lambda: inventory.names() == ['cn1']))
+
+        state._stop.set()
+        self.engine.stopping = True
+        thread.join(5)
+        self.assertFalse(inventory.is_fresh('127.0.0.1'))
+
+    def test_unreachable_engine(self):
+        """Test host left to the listing of workers while its engine is down"""
+        inventory = inv.Inventory(ttl=0)
+        inventory.set_host('127.0.0.1', [{'name': 'cn0', 'host': '127.0.0.1', 'status': 1,
+                                          'labels': {}}])
+        inventory.watch('127.0.0.1', clustdock.LIBVIRT_NODE)
+        self.engine.stop()
+        state = watcher.StateWatcher(['127.0.0.1'], inventory, self.port,
+                                     retry_delay=0.05)
+        thread = threading.Thread(target=state._watch_docker, args=('127.0.0.1',))
+        thread.daemon = True
+        thread.start()
+        time.sleep(0.3)
+        state._stop.set()
+        thread.join(5)
+        self.assertEqual(inventory.names(), ['cn0'])
+        self.assertFalse(inventory.is_fresh('127.0.0.1'))
+
+    def test_renew_leases(self):
+        """Test watch marks of the streams which are up renewed"""
+        inventory = inv.Inventory(ttl=0)
+        state = watcher.StateWatcher(['host1', 'host2'], inventory, lease=0.1)
+        state.libvirt_cnx['host1'] = None
+        state._docker_watched.update(['host1', 'host2'])
+        state.renew_leases()
+        self.assertTrue(inventory.is_fresh('host1'))
+        self.assertFalse(inventory.is_fresh('host2'))
+        time.sleep(0.15)
+        self.assertFalse(inventory.is_fresh('host1'))
+
+
+if __name__ == "__main__":
+    unittest.main()